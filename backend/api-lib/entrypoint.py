@@ -1,4 +1,12 @@
 from api_lib.main import app
+from api_lib.stripe import events
 from mangum import Mangum
 
-handler = Mangum(app, lifespan="off")
\ No newline at end of file
+http_handler = Mangum(app, lifespan="off")
+
+
+def handler(event, context):
+    # the webhook worker shares this code and is invoked with sqs records
+    if events.is_sqs_event(event):
+        return events.handle_sqs_event(event)
+    return http_handler(event, context)
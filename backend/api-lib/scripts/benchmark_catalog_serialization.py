@@ -0,0 +1,111 @@
+"""
+Compare the cost of serving the product catalog per request.
+
+``/validated`` returns the cached items and lets FastAPI validate and serialize
+them against the response model on every request, how /stripe/products used to
+respond. ``/prepared`` sends the json the catalog cache encodes once per
+snapshot. Both are called through the ASGI app so routing is included.
+
+    python scripts/benchmark_catalog_serialization.py --products 10 1000 10000
+"""
+
+import argparse
+import asyncio
+import time
+from decimal import Decimal
+from typing import Any, Dict, List
+
+import httpx
+from fastapi import FastAPI, Response
+
+from api_lib.stripe import catalog, schemas, tables
+
+app = FastAPI()
+
+ITEMS: List[Dict[str, Any]] = []
+BODY = b"[]"
+
+
+@app.get("/validated")
+async def validated() -> List[schemas.Product]:
+    return ITEMS
+
+
+@app.get("/prepared", response_model=List[schemas.Product])
+async def prepared() -> Response:
+    return Response(content=BODY, media_type="application/json")
+
+
+def product(i: int) -> Dict[str, Any]:
+    # shaped like a product read back from dynamodb, numbers are decimals
+    return {
+        "id": f"prod_{i}",
+        "object": "product",
+        "active": True,
+        "attributes": [],
+        "created": Decimal(1700000000 + i),
+        "default_price": f"price_{i}",
+        "description": f"description of product {i}",
+        "images": [f"https://example.com/{i}.png"],
+        "livemode": False,
+        "marketing_features": [{"name": "feature"}],
+        "metadata": {"rank": Decimal(i)},
+        "name": f"Product {i}",
+        "package_dimensions": None,
+        "shippable": None,
+        "statement_descriptor": None,
+        "tax_code": None,
+        "type": "service",
+        "unit_label": None,
+        "updated": Decimal(1700000000 + i),
+        "url": None,
+    }
+
+
+async def run(route: str, total: int) -> float:
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+        (await c.get(route)).raise_for_status()
+
+        start = time.perf_counter()
+        for _ in range(total):
+            response = await c.get(route)
+            response.raise_for_status()
+        return (time.perf_counter() - start) / total * 1e6
+
+
+async def main(product_counts: List[int], total: int):
+    global ITEMS, BODY
+
+    print(
+        f"{'products':>10}{'validated':>14}{'prepared':>14}{'speedup':>10}"
+        f"{'encode once':>14}"
+    )
+    for count in product_counts:
+        ITEMS = [product(i) for i in range(count)]
+
+        start = time.perf_counter()
+        BODY = catalog.join_catalog_items(
+            catalog.encode_catalog_item(tables.PRODUCT_TABLE_NAME, item)
+            for item in ITEMS
+        )
+        encode_us = (time.perf_counter() - start) * 1e6
+
+        # fewer rounds for large catalogs, the per request cost is what matters
+        rounds = max(5, total // max(1, count // 100))
+        validated_us = await run("/validated", rounds)
+        prepared_us = await run("/prepared", rounds)
+        print(
+            f"{count:>10}{f'{validated_us:.0f} us':>14}{f'{prepared_us:.0f} us':>14}"
+            f"{f'{validated_us / prepared_us:.1f}x':>10}{f'{encode_us:.0f} us':>14}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.products, args.requests))
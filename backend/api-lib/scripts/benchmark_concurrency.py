@@ -0,0 +1,75 @@
+"""
+Measure request throughput as the number of in-flight requests grows.
+
+Each route simulates a downstream call of ``--latency`` seconds, either made
+directly on the event loop (how the handlers used to call boto3, requests and
+stripe), offloaded to the bounded thread pool, or awaited asynchronously.
+
+    python scripts/benchmark_concurrency.py --requests 256 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from api_lib import aio
+
+app = FastAPI()
+
+LATENCY = 0.05
+
+
+@app.get("/blocking")
+async def blocking():
+    time.sleep(LATENCY)
+    return {}
+
+
+@app.get("/offloaded")
+async def offloaded():
+    await aio.run_blocking(time.sleep, LATENCY)
+    return {}
+
+
+@app.get("/async")
+async def non_blocking():
+    await asyncio.sleep(LATENCY)
+    return {}
+
+
+async def run(route: str, total: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+
+        async def request():
+            async with semaphore:
+                response = await c.get(route)
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(request() for _ in range(total)))
+        return total / (time.perf_counter() - start)
+
+
+async def main(total: int, concurrency_levels: list):
+    print(f"{'route':<12}" + "".join(f"{f'c={c}':>12}" for c in concurrency_levels))
+    for route in ("/blocking", "/offloaded", "/async"):
+        throughput = [await run(route, total, c) for c in concurrency_levels]
+        print(f"{route:<12}" + "".join(f"{f'{t:.1f}/s':>12}" for t in throughput))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 128])
+    args = parser.parse_args()
+
+    LATENCY = args.latency
+
+    asyncio.run(main(args.requests, args.concurrency))
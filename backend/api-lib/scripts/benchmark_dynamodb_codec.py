@@ -0,0 +1,166 @@
+"""
+Compare the boto3 TypeDeserializer and TypeSerializer with ``api_lib.dynamodb``.
+
+Items are shaped like the stripe objects the tables hold, a product and a
+completed checkout session with its line items. ``projected`` decodes only the
+attributes the past purchases and popularity paths read.
+
+    python scripts/benchmark_dynamodb_codec.py --line-items 1 20 100
+"""
+
+import argparse
+import time
+from typing import Any, Callable, Dict, List
+
+import boto3.dynamodb.types
+
+from api_lib import dynamodb
+
+type_deserializer = boto3.dynamodb.types.TypeDeserializer()
+type_serializer = boto3.dynamodb.types.TypeSerializer()
+
+
+def product(i: int) -> Dict[str, Any]:
+    return {
+        "id": f"prod_{i}",
+        "object": "product",
+        "active": True,
+        "attributes": [],
+        "created": 1700000000 + i,
+        "default_price": f"price_{i}",
+        "description": f"description of product {i}",
+        "images": [f"https://example.com/{i}.png"],
+        "livemode": False,
+        "marketing_features": [{"name": "feature"}],
+        "metadata": {"rank": str(i)},
+        "name": f"Product {i}",
+        "package_dimensions": None,
+        "shippable": None,
+        "statement_descriptor": None,
+        "tax_code": None,
+        "type": "service",
+        "unit_label": None,
+        "updated": 1700000000 + i,
+        "url": None,
+    }
+
+
+def line_item(i: int) -> Dict[str, Any]:
+    return {
+        "id": f"li_{i}",
+        "object": "item",
+        "amount_discount": 0,
+        "amount_subtotal": 1000 * i,
+        "amount_tax": 0,
+        "amount_total": 1000 * i,
+        "currency": "usd",
+        "description": f"Product {i}",
+        "price": {
+            "id": f"price_{i}",
+            "object": "price",
+            "active": True,
+            "billing_scheme": "per_unit",
+            "created": 1700000000 + i,
+            "currency": "usd",
+            "livemode": False,
+            "lookup_key": None,
+            "metadata": {},
+            "nickname": None,
+            "product": f"prod_{i}",
+            "recurring": None,
+            "tax_behavior": "unspecified",
+            "tiers_mode": None,
+            "transform_quantity": None,
+            "type": "one_time",
+            "unit_amount": 1000,
+            "unit_amount_decimal": "1000",
+        },
+        "quantity": i,
+    }
+
+
+def checkout_session(line_items: int) -> Dict[str, Any]:
+    return {
+        "id": "cs_test",
+        "object": "checkout.session",
+        "amount_subtotal": 1000 * line_items,
+        "amount_total": 1000 * line_items,
+        "created": 1700000000,
+        "currency": "usd",
+        "customer": "cus_test",
+        "customer_details": {
+            "address": {"city": None, "country": "US", "postal_code": "10001"},
+            "email": "customer@example.com",
+            "name": "Customer",
+            "tax_exempt": "none",
+            "tax_ids": [],
+        },
+        "livemode": False,
+        "line_items": [line_item(i) for i in range(1, line_items + 1)],
+        "metadata": {},
+        "mode": "payment",
+        "payment_status": "paid",
+        "status": "complete",
+        "total_details": {"amount_discount": 0, "amount_shipping": 0, "amount_tax": 0},
+    }
+
+
+def boto3_decode(item: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: type_deserializer.deserialize(v) for k, v in item.items()}
+
+
+def boto3_encode(value: Dict[str, Any]) -> Dict[str, Any]:
+    return type_serializer.serialize(value)["M"]
+
+
+def timeit(fn: Callable[[Any], Any], arg: Any, total: int) -> float:
+    fn(arg)
+    start = time.perf_counter()
+    for _ in range(total):
+        fn(arg)
+    return (time.perf_counter() - start) / total * 1e6
+
+
+def report(name: str, value: Dict[str, Any], total: int, projection: List[str]):
+    item = boto3_encode(value)
+    assert dynamodb.encode_item(value) == item
+    assert dynamodb.decode_item(item) == boto3_decode(item)
+
+    rows = [
+        ("decode", boto3_decode, dynamodb.decode_item, item),
+        ("encode", boto3_encode, dynamodb.encode_item, value),
+        (
+            "projected",
+            boto3_decode,
+            lambda i: dynamodb.decode_item(i, projection),
+            item,
+        ),
+    ]
+    for operation, old, new, arg in rows:
+        old_us = timeit(old, arg, total)
+        new_us = timeit(new, arg, total)
+        print(
+            f"{name:>18}{operation:>11}{f'{old_us:.1f} us':>12}"
+            f"{f'{new_us:.1f} us':>12}{f'{old_us / new_us:.1f}x':>10}"
+        )
+
+
+def main(line_item_counts: List[int], total: int):
+    print(f"{'item':>18}{'operation':>11}{'boto3':>12}{'codec':>12}{'speedup':>10}")
+    report("product", product(1), total, ["id", "images", "name"])
+    for count in line_item_counts:
+        report(
+            f"session {count} li",
+            checkout_session(count),
+            max(10, total // count),
+            ["id", "line_items"],
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--line-items", type=int, nargs="+", default=[1, 20, 100])
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    main(args.line_items, args.rounds)
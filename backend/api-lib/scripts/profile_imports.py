@@ -0,0 +1,87 @@
+"""
+Report where the cold start import time of the api goes.
+
+Every run imports ``--module`` in a fresh interpreter with ``-X importtime`` and
+prints the wall time of the import together with the slowest modules by
+cumulative and by self time, so regressions show up when a heavy dependency is
+imported at module level again.
+
+    python scripts/profile_imports.py --module api_lib.main --top 20 --runs 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# (self us, cumulative us) per module, the same module imported by several
+# runs is averaged
+ImportTimes = Dict[str, Tuple[float, float]]
+
+
+def profile(module: str) -> Tuple[float, ImportTimes]:
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; "
+        "print(time.perf_counter() - start)"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    if completed.returncode != 0:
+        sys.exit(completed.stderr)
+
+    times: ImportTimes = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times[name.strip()] = (float(self_us), float(cumulative_us))
+    return float(completed.stdout.strip().splitlines()[-1]), times
+
+
+def average(runs: List[ImportTimes]) -> ImportTimes:
+    names = set().union(*runs)
+    return {
+        name: (
+            statistics.mean(run[name][0] for run in runs if name in run),
+            statistics.mean(run[name][1] for run in runs if name in run),
+        )
+        for name in names
+    }
+
+
+def print_top(title: str, times: ImportTimes, index: int, top: int):
+    print(f"\n{title}")
+    print(f"{'module':<60}{'self ms':>10}{'cumul ms':>10}")
+    for name, (self_us, cumulative_us) in sorted(
+        times.items(), key=lambda t: t[1][index], reverse=True
+    )[:top]:
+        print(f"{name:<60}{self_us / 1000:>10.1f}{cumulative_us / 1000:>10.1f}")
+
+
+def main(module: str, top: int, runs: int):
+    walls, profiles = zip(*(profile(module) for _ in range(runs)))
+    times = average(list(profiles))
+
+    print(
+        f"import {module}: {statistics.median(walls) * 1000:.0f} ms median of "
+        f"{runs} runs, {len(times)} modules"
+    )
+    print_top("slowest by cumulative time", times, 1, top)
+    print_top("slowest by self time", times, 0, top)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="api_lib.main")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    main(args.module, args.top, args.runs)
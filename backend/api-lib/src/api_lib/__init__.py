@@ -1,4 +1,5 @@
 from . import utils
 from . import oauth2
+from . import identity
 from . import user
 from . import main
@@ -0,0 +1,95 @@
+import asyncio
+import functools
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Iterator,
+    Optional,
+    TypeVar,
+)
+
+if TYPE_CHECKING:
+    import httpx
+
+T = TypeVar("T")
+
+# blocking sdk calls (boto3) are offloaded to this pool so that a slow
+# downstream never stalls the event loop
+ASYNC_THREAD_POOL_SIZE = int(os.environ.get("ASYNC_THREAD_POOL_SIZE", 32))
+
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 10))
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 100))
+
+
+# ---------------------------------------------------------------------------- #
+#                              bounded thread pool                             #
+# ---------------------------------------------------------------------------- #
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=ASYNC_THREAD_POOL_SIZE,
+                    thread_name_prefix="api-lib-blocking",
+                )
+    return _executor
+
+
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+_exhausted = object()
+
+
+async def iterate_blocking(iterator: Iterator[T]) -> AsyncIterator[T]:
+    # pull each element of a blocking iterator from the thread pool, callers
+    # should yield pages rather than single items to keep the hops cheap
+    iterator = iter(iterator)
+    while True:
+        element = await run_blocking(next, iterator, _exhausted)
+        if element is _exhausted:
+            return
+        yield element
+
+
+# ---------------------------------------------------------------------------- #
+#                               async http client                              #
+# ---------------------------------------------------------------------------- #
+
+# httpx clients are bound to the loop they first ran on, keep one per loop
+_http_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_http_client() -> "httpx.AsyncClient":
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None:
+        # imported here so that cold starts of routes without outbound http
+        # calls skip it
+        import httpx
+
+        client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+            ),
+        )
+        _http_clients[loop] = client
+    return client
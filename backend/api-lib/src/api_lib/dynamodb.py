@@ -0,0 +1,125 @@
+import math
+from decimal import Decimal
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+# decoder and encoder for the dynamodb attribute value format, used instead of
+# the boto3 TypeDeserializer and TypeSerializer on the hot read and write paths.
+# numbers decode to int, or float when they have a fraction or exponent, rather
+# than Decimal, and floats encode directly. a float holds about 15 significant
+# digits, fractional numbers with more than that, which dynamodb stores up to 38,
+# come back rounded. stripe amounts are integers or decimal strings.
+
+AttributeValue = Dict[str, Any]
+Item = Dict[str, AttributeValue]
+
+
+# ---------------------------------------------------------------------------- #
+#                                    decoding                                  #
+# ---------------------------------------------------------------------------- #
+
+
+def decode_number(value: str) -> Any:
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def decode_value(value: AttributeValue) -> Any:
+    # membership tests on the single key dict, most common types first
+    if "S" in value:
+        return value["S"]
+    if "M" in value:
+        return {k: decode_value(v) for k, v in value["M"].items()}
+    if "N" in value:
+        return decode_number(value["N"])
+    if "L" in value:
+        return [decode_value(v) for v in value["L"]]
+    if "NULL" in value:
+        return None
+    if "BOOL" in value:
+        return value["BOOL"]
+    if "SS" in value:
+        return set(value["SS"])
+    if "NS" in value:
+        return {decode_number(v) for v in value["NS"]}
+    if "B" in value:
+        return bytes(value["B"])
+    if "BS" in value:
+        return {bytes(v) for v in value["BS"]}
+    raise TypeError(f"unknown dynamodb attribute value {value}")
+
+
+def decode_item(
+    item: Item, attributes: Optional[Iterable[str]] = None
+) -> Dict[str, Any]:
+    # only the listed attributes are decoded when given
+    if attributes is None:
+        return {k: decode_value(v) for k, v in item.items()}
+    return {k: decode_value(item[k]) for k in attributes if k in item}
+
+
+# ---------------------------------------------------------------------------- #
+#                                    encoding                                  #
+# ---------------------------------------------------------------------------- #
+
+
+def encode_number(value: Any) -> str:
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise TypeError(f"dynamodb does not store {value}")
+        return repr(value)
+    if isinstance(value, Decimal) and not value.is_finite():
+        raise TypeError(f"dynamodb does not store {value}")
+    return str(value)
+
+
+def encode_value(value: Any) -> AttributeValue:
+    value_type = type(value)
+    if value_type is str:
+        return {"S": value}
+    if value_type is dict:
+        return {"M": {k: encode_value(v) for k, v in value.items()}}
+    if value_type is bool:
+        return {"BOOL": value}
+    if value_type is int or value_type is float or value_type is Decimal:
+        return {"N": encode_number(value)}
+    if value is None:
+        return {"NULL": True}
+    if value_type is list or value_type is tuple:
+        return {"L": [encode_value(v) for v in value]}
+    # subclasses such as stripe objects and enums
+    if isinstance(value, Mapping):
+        return {"M": {k: encode_value(v) for k, v in value.items()}}
+    if isinstance(value, bool):
+        return {"BOOL": bool(value)}
+    if isinstance(value, str):
+        return {"S": str(value)}
+    if isinstance(value, (int, float, Decimal)):
+        return {"N": encode_number(value)}
+    if isinstance(value, (bytes, bytearray)):
+        return {"B": bytes(value)}
+    if isinstance(value, (list, tuple)):
+        return {"L": [encode_value(v) for v in value]}
+    if isinstance(value, (set, frozenset)):
+        return _encode_set(value)
+    raise TypeError(f"unsupported type {value_type} for dynamodb")
+
+
+def _encode_set(value: Any) -> AttributeValue:
+    # dynamodb rejects empty sets
+    if not value:
+        raise TypeError("dynamodb sets cannot be empty")
+    if all(isinstance(v, str) for v in value):
+        return {"SS": list(value)}
+    if all(isinstance(v, (bytes, bytearray)) for v in value):
+        return {"BS": [bytes(v) for v in value]}
+    if all(
+        isinstance(v, (int, float, Decimal)) and not isinstance(v, bool) for v in value
+    ):
+        return {"NS": [encode_number(v) for v in value]}
+    raise TypeError("dynamodb sets hold only strings, numbers or binary")
+
+
+def encode_item(value: Mapping[str, Any]) -> Item:
+    return {k: encode_value(v) for k, v in value.items()}
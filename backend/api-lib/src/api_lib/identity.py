@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from starlette.status import HTTP_400_BAD_REQUEST
+
+from api_lib import aio, utils
+
+# claim added to access tokens by the cognito pre token generation trigger
+STRIPE_CUSTOMER_ID_CLAIM = "stripe_customer_id"
+STRIPE_CUSTOMER_ID_ATTRIBUTE = "custom:stripe_customer_id"
+
+CUSTOMER_ID_CACHE_TTL = float(os.environ.get("CUSTOMER_ID_CACHE_TTL", 3600))
+CUSTOMER_ID_CACHE_SIZE = int(os.environ.get("CUSTOMER_ID_CACHE_SIZE", 4096))
+
+
+# ---------------------------------------------------------------------------- #
+#                          customer identity resolver                          #
+# ---------------------------------------------------------------------------- #
+
+# resolves the stripe customer id of a verified access token, in order from the
+# token claims, a per sub cache and finally a cognito get_user call
+
+
+class CustomerIdentityResolver:
+    def __init__(
+        self,
+        ttl: float = CUSTOMER_ID_CACHE_TTL,
+        maxsize: int = CUSTOMER_ID_CACHE_SIZE,
+    ):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.from_claims = 0
+        self.from_cache = 0
+        self.from_cognito = 0
+
+    def _cached(self, sub: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(sub)
+            if entry is None:
+                return None
+            cached_at, customer_id = entry
+            if time.monotonic() - cached_at >= self.ttl:
+                del self._entries[sub]
+                return None
+            self._entries.move_to_end(sub)
+            return customer_id
+
+    def remember(self, sub: str, customer_id: str):
+        with self._lock:
+            self._entries[sub] = (time.monotonic(), customer_id)
+            self._entries.move_to_end(sub)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def forget(self, sub: str):
+        with self._lock:
+            self._entries.pop(sub, None)
+
+    async def resolve(self, access_token: str) -> Optional[str]:
+        claims = await utils.verify_and_decode_jwt_async(access_token)
+
+        customer_id = claims.get(STRIPE_CUSTOMER_ID_CLAIM)
+        if customer_id:
+            self.from_claims += 1
+            return customer_id
+
+        sub = claims["sub"]
+
+        customer_id = self._cached(sub)
+        if customer_id is not None:
+            self.from_cache += 1
+            return customer_id
+
+        self.from_cognito += 1
+
+        user_attributes = utils.parse_user_attributes(
+            await aio.run_blocking(
+                utils.get_client("cognito-idp").get_user, AccessToken=access_token
+            )
+        )
+
+        customer_id = user_attributes.get(STRIPE_CUSTOMER_ID_ATTRIBUTE)
+        if customer_id:
+            self.remember(sub, customer_id)
+
+        return customer_id
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "from_claims": self.from_claims,
+            "from_cache": self.from_cache,
+            "from_cognito": self.from_cognito,
+        }
+
+
+customer_identity_resolver = CustomerIdentityResolver()
+
+
+async def get_stripe_customer_id(access_token: str) -> str:
+    customer_id = await customer_identity_resolver.resolve(access_token)
+
+    if customer_id is None:
+        raise HTTPException(
+            status_code=HTTP_400_BAD_REQUEST,
+            detail="No stripe customer is linked to this user",
+        )
+
+    return customer_id
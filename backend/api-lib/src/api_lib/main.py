@@ -1,8 +1,8 @@
 from fastapi import Depends, FastAPI
 from fastapi.responses import JSONResponse
 
-from api_lib import oauth2, user, utils, stripe
-
+from api_lib import aio, identity, oauth2, user, utils, stripe
+from api_lib.stripe import cart, catalog, events, popularity
 
 app = FastAPI()
 
@@ -17,7 +17,7 @@ if utils.DEVELOPMENT_LOCATION == "local":
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
-        expose_headers=["Content-Type", "Authorization"],
+        expose_headers=["Content-Type", "Authorization", "X-Next-Cursor", "ETag"],
     )
 
 
@@ -31,6 +31,33 @@ async def root() -> JSONResponse:
     )
 
 
+# internal counters and a queue lookup per request, kept behind authentication
+@app.get("/metrics", dependencies=[Depends(oauth2.validate_bearer)])
+async def metrics() -> JSONResponse:
+    try:
+        queue_depth = await aio.run_blocking(events.get_event_queue().depth)
+    except Exception:
+        queue_depth = None
+
+    return JSONResponse(
+        content={
+            "jwks_key_store": utils.jwks_key_store.stats(),
+            "verified_token_cache": utils.verified_token_cache.stats(),
+            "ssm_parameter_store": utils.ssm_parameter_store.stats(),
+            "client_registry": utils.client_registry.stats(),
+            "customer_identity_resolver": identity.customer_identity_resolver.stats(),
+            "catalog_cache": catalog.catalog_cache.stats(),
+            "product_detail_cache": catalog.product_detail_cache.stats(),
+            "popularity_counters_cache": popularity.popularity_counters_cache.stats(),
+            "cart": cart.cart_metrics.stats(),
+            "webhook_queue": {
+                "depth": queue_depth,
+                **events.event_queue_metrics.stats(),
+            },
+        }
+    )
+
+
 app.include_router(oauth2.router, prefix="/oauth2", tags=["oauth2"])
 app.include_router(
     user.router,
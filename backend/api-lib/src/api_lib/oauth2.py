@@ -1,7 +1,6 @@
-import time
+import asyncio
 from typing import Annotated, Dict, Literal, Optional
 
-import requests
 from fastapi import Cookie, Depends, Form, HTTPException, Response
 from fastapi.requests import Request
 from fastapi.responses import RedirectResponse
@@ -11,27 +10,34 @@ from fastapi.security.utils import get_authorization_scheme_param
 from pydantic import BaseModel
 from starlette.status import HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED
 
-from api_lib import utils
+from api_lib import aio, utils
 
 router = APIRouter()
 
-cognito_domain_url = utils.get_ssm_parameter_value(
-    utils.SSMParameterName.SSM_COGNITO_DOMAIN_URL.value
-)
+# resolved from ssm on first use rather than at import, so a cold start does not
+# wait on parameters the invoked route never reads
 
-cognito_authorize_url = f"{cognito_domain_url}/oauth2/authorize"
-cognito_revoke_url = f"{cognito_domain_url}/oauth2/revoke"
-cognito_token_url = f"{cognito_domain_url}/oauth2/token"
 
-client_id = utils.get_ssm_parameter_value(
-    utils.SSMParameterName.USER_POOL_CLIENT_ID.value
-)
+async def get_cognito_url(endpoint: Literal["authorize", "revoke", "token"]) -> str:
+    cognito_domain_url = await utils.get_ssm_parameter_value_async(
+        utils.SSMParameterName.SSM_COGNITO_DOMAIN_URL.value
+    )
+    return f"{cognito_domain_url}/oauth2/{endpoint}"
 
-token_redirect_uri = (
-    "https://0.0.0.0:8000/docs"
-    if utils.DEVELOPMENT_LOCATION == "local"
-    else f"{utils.get_api_url()}docs"
-)
+
+async def get_client_id() -> str:
+    return await utils.get_ssm_parameter_value_async(
+        utils.SSMParameterName.USER_POOL_CLIENT_ID.value
+    )
+
+
+async def get_token_redirect_uri() -> str:
+    if utils.DEVELOPMENT_LOCATION == "local":
+        return "https://0.0.0.0:8000/docs"
+    api_url = await utils.get_ssm_parameter_value_async(
+        utils.SSMParameterName.SSM_API_FUNCTION_URL.value
+    )
+    return f"{api_url}docs"
 
 
 class OAuth2AuthorizationCodeBearerWithCookie(OAuth2AuthorizationCodeBearer):
@@ -66,9 +72,9 @@ class TokenResponse(BaseModel):
 
 @router.post("/revoke")
 async def revoke(token: str):
-    response = requests.post(
-        cognito_revoke_url,
-        data={"token": token, "client_id": client_id},
+    response = await aio.get_http_client().post(
+        await get_cognito_url("revoke"),
+        data={"token": token, "client_id": await get_client_id()},
         headers={"Content-Type": "application/x-www-form-urlencoded"},
     )
     return response.text
@@ -83,7 +89,11 @@ async def authorize(
         Literal["Facebook", "Google", "LoginWithAmazon", "SignInWithApple"]
     ] = None,
 ) -> RedirectResponse:
-    url = f"{cognito_authorize_url}?response_type=code&client_id={client_id}&redirect_uri={token_redirect_uri if redirect_uri is None else redirect_uri}"
+    cognito_authorize_url = await get_cognito_url("authorize")
+    client_id = await get_client_id()
+    if redirect_uri is None:
+        redirect_uri = await get_token_redirect_uri()
+    url = f"{cognito_authorize_url}?response_type=code&client_id={client_id}&redirect_uri={redirect_uri}"
     if identity_provider is not None:
         url += f"&identity_provider={identity_provider}"
     if state is not None:
@@ -117,11 +127,14 @@ async def token(
 
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
+    cognito_token_url = await get_cognito_url("token")
+    client_id = await get_client_id()
+
     max_retries = 3
     retries = 0
 
     while retries < max_retries:
-        cognito_response = requests.post(
+        cognito_response = await aio.get_http_client().post(
             cognito_token_url,
             data={
                 k: v
@@ -135,13 +148,14 @@ async def token(
                 if v is not None
             },
             headers=headers,
-        ).json()
+        )
+        cognito_response = cognito_response.json()
 
         if "id_token" in cognito_response:
             token_response = TokenResponse(**cognito_response)
             break
 
-        time.sleep(2**retries)
+        await asyncio.sleep(2**retries)
 
         retries += 1
 
@@ -151,7 +165,7 @@ async def token(
                 detail=cognito_response,
             )
 
-    if not utils.verify_jwt(token_response.access_token):
+    if not await utils.verify_jwt_async(token_response.access_token):
         raise HTTPException(
             status_code=HTTP_401_UNAUTHORIZED,
             detail="Unverified JWT",
@@ -190,7 +204,7 @@ async def validate_bearer(
             detail="No token provided",
         )
 
-    if not utils.verify_jwt(access_token):
+    if not await utils.verify_jwt_async(access_token):
         raise HTTPException(
             status_code=HTTP_401_UNAUTHORIZED,
             detail="Invalid token",
@@ -207,4 +221,4 @@ async def validate_auth_cookie(
     authorization = request.cookies.get("Authorization")
     if authorization is None:
         return {"valid": False}
-    return {"valid": utils.verify_jwt(authorization.split(" ")[-1])}
+    return {"valid": await utils.verify_jwt_async(authorization.split(" ")[-1])}
@@ -1,17 +1,22 @@
+import itertools
+import json
 import os
 from typing import Annotated, Any, Dict, List, Literal, Optional
 
-import stripe
-from fastapi import Depends, HTTPException, Request
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi import BackgroundTasks, Depends, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.routing import APIRouter
-from pydantic import BaseModel
-from starlette.status import HTTP_400_BAD_REQUEST
+from starlette.status import (
+    HTTP_400_BAD_REQUEST,
+    HTTP_422_UNPROCESSABLE_ENTITY,
+    HTTP_502_BAD_GATEWAY,
+)
 
-from api_lib import oauth2
+from api_lib import aio, identity, oauth2
 from api_lib import utils as general_utils
 from api_lib.stripe import utils as stripe_utils
-from api_lib.stripe import schemas, tables
+from api_lib.stripe import cart, catalog, events, popularity, schemas, tables
 
 router = APIRouter()
 
@@ -21,15 +26,30 @@ router = APIRouter()
 # ---------------------------------------------------------------------------- #
 
 
-class PriceItem(BaseModel):
-    price: str
-    quantity: int
+async def check_cart(line_items: List[schemas.PriceItem]) -> List[Dict[str, Any]]:
+    # bad carts are turned away before they cost a stripe call
+    try:
+        return await cart.check_cart_async(line_items)
+    except cart.CartError as e:
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY, detail=e.errors)
+
+
+def stripe_error(stripe: Any, e: Exception) -> HTTPException:
+    # requests stripe rejects are the caller's, anything else is an upstream error
+    if isinstance(e, stripe.InvalidRequestError):
+        status_code = HTTP_400_BAD_REQUEST
+    else:
+        status_code = HTTP_502_BAD_GATEWAY
+    return HTTPException(
+        status_code=status_code,
+        detail={"type": e.code or "stripe_error", "msg": e.user_message or str(e)},
+    )
 
 
 @router.post("/create-user-checkout-session")
 async def create_user_checkout_session(
     access_token: Annotated[str, Depends(oauth2.validate_bearer)],
-    line_items: List[PriceItem],
+    line_items: List[schemas.PriceItem],
     return_type: Literal["redirect", "json"] = "json",
     success_url: Optional[str] = None,
     cancel_url: Optional[str] = None,
@@ -43,16 +63,14 @@ async def create_user_checkout_session(
         success_url = domain_url + "?success=true"
         cancel_url = domain_url + "?success=true"
 
-    client = general_utils.get_client("cognito-idp")
+    await check_cart(line_items)
+
+    customer_id = await identity.get_stripe_customer_id(access_token)
 
-    customer_id = [
-        k
-        for k in client.get_user(AccessToken=access_token)["UserAttributes"]
-        if k["Name"] == "custom:stripe_customer_id"
-    ][0]["Value"]
+    stripe = await general_utils.get_stripe_async()
 
     try:
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = await stripe.checkout.Session.create_async(
             line_items=[p.dict() for p in line_items],
             customer=customer_id,
             mode="payment",
@@ -60,8 +78,8 @@ async def create_user_checkout_session(
             cancel_url=cancel_url,
             payment_method_types=[],
         )
-    except Exception as e:
-        return str(e)
+    except stripe.StripeError as e:
+        raise stripe_error(stripe, e)
 
     if return_type == "redirect":
         return RedirectResponse(url=checkout_session.url)
@@ -71,7 +89,7 @@ async def create_user_checkout_session(
 
 @router.post("/create-public-checkout-session")
 async def create_public_checkout_session(
-    line_items: List[PriceItem],
+    line_items: List[schemas.PriceItem],
     return_type: Literal["redirect", "json"] = "json",
     success_url: Optional[str] = None,
     cancel_url: Optional[str] = None,
@@ -85,16 +103,20 @@ async def create_public_checkout_session(
         success_url = domain_url + "?success=true"
         cancel_url = domain_url + "?success=true"
 
+    await check_cart(line_items)
+
+    stripe = await general_utils.get_stripe_async()
+
     try:
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = await stripe.checkout.Session.create_async(
             line_items=[p.dict() for p in line_items],
             mode="payment",
             success_url=success_url,
             cancel_url=cancel_url,
             payment_method_types=[],
         )
-    except Exception as e:
-        return str(e)
+    except stripe.StripeError as e:
+        raise stripe_error(stripe, e)
 
     if return_type == "redirect":
         return RedirectResponse(url=checkout_session.url)
@@ -102,54 +124,103 @@ async def create_public_checkout_session(
         return JSONResponse(content={"url": f"{checkout_session.url}"})
 
 
+@router.post("/checkout-quote")
+async def get_checkout_quote(
+    line_items: List[schemas.PriceItem],
+) -> schemas.CartQuote:
+    # the cart total priced from the mirrored prices, without calling stripe
+    prices = await check_cart(line_items)
+    return cart.quote_cart(line_items, prices)
+
+
+PAST_PURCHASES_PAGE_SIZE = 20
+PAST_PURCHASES_MAX_PAGE_SIZE = 100
+
+
+def format_past_purchase_line_items(
+    item: Dict[str, Any], products: Dict[str, Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    output = []
+    for l in item["line_items"]:
+        o = {
+            "quantity": l["quantity"],
+            "product": l["price"]["product"],
+            "unit_amount": l["price"]["unit_amount"],
+            "currency": l["price"]["currency"],
+            "created": l["price"]["created"],
+        }
+        if o["product"] in products:
+            o["details"] = {
+                n: products[o["product"]][n] for n in catalog.PRODUCT_DETAIL_ATTRIBUTES
+            }
+        output.append(o)
+    return output
+
+
+def purchased_product_ids(items: List[Dict[str, Any]]) -> List[str]:
+    return [l["price"]["product"] for item in items for l in item["line_items"]]
+
+
 @router.get("/current-user-past-purchases")
 async def get_current_user_past_purchase(
     access_token: Annotated[str, Depends(oauth2.validate_bearer)],
+    response: Response,
+    limit: Annotated[
+        int, Query(ge=1, le=PAST_PURCHASES_MAX_PAGE_SIZE)
+    ] = PAST_PURCHASES_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    stream: bool = False,
 ):
-    cognito_client = general_utils.get_client("cognito-idp")
     dynamodb_client = general_utils.get_client(service_name="dynamodb")
 
-    customer_id = [
-        v
-        for v in cognito_client.get_user(AccessToken=access_token)["UserAttributes"]
-        if v["Name"] == "custom:stripe_customer_id"
-    ][0]["Value"]
+    customer_id = await identity.get_stripe_customer_id(access_token)
 
-    products = {
-        s["id"]: s for s in stripe_utils.get_table_items(tables.PRODUCT_TABLE_NAME)
-    }
+    try:
+        exclusive_start_key = (
+            stripe_utils.decode_cursor(cursor) if cursor is not None else None
+        )
+        pages = stripe_utils.iter_purchase_history_pages(
+            dynamodb_client,
+            customer_id,
+            page_size=limit,
+            exclusive_start_key=exclusive_start_key,
+        )
+        first_page = await aio.run_blocking(next, pages)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
 
-    output = []
+    if stream:
+        # stream the remaining history page by page from the cursor onwards
 
-    def process_list_item(item):
-        created_date = item["created"]
-        for l in item["line_items"]:
-            l["created"] = created_date
+        async def ndjson_lines():
+            async for items, _ in aio.iterate_blocking(
+                itertools.chain([first_page], pages)
+            ):
+                products = await catalog.product_detail_cache.get_many_async(
+                    purchased_product_ids(items)
+                )
+                for item in items:
+                    for o in format_past_purchase_line_items(item, products):
+                        yield json.dumps(jsonable_encoder(o)) + "\n"
 
-        return item["line_items"]
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
 
-    [
-        output.extend(process_list_item(i))
-        for i in stripe_utils.query_and_extract_items_from_statement(
-            dynamodb_client,
-            f"""select created, line_items from "{tables.CHECKOUT_SESSION_COMPLETE_TABLE}" where customer='{customer_id}'""",
+    items, last_evaluated_key = first_page
+
+    if last_evaluated_key is not None:
+        response.headers["X-Next-Cursor"] = stripe_utils.encode_cursor(
+            last_evaluated_key
         )
-    ]
-
-    output = [
-        {c: o[c] for c in ["quantity", "price", "created", "currency"]} for o in output
-    ]
-    for o in output:
-        o["product"] = o["price"]["product"]
-        o["unit_amount"] = o["price"]["unit_amount"]
-        o["currency"] = o["price"]["currency"]
-        o["created"] = o["price"]["created"]
-        if o["product"] in products:
-            o["details"] = {n: products[o["product"]][n] for n in ["images", "name"]}
-        del o["price"]
 
-    cognito_client.close()
-    dynamodb_client.close()
+    products = await catalog.product_detail_cache.get_many_async(
+        purchased_product_ids(items)
+    )
+
+    output = []
+
+    for item in items:
+        output.extend(format_past_purchase_line_items(item, products))
+
     return output
 
 
@@ -159,11 +230,13 @@ async def get_current_user_past_purchase(
 
 
 @router.post("/webhook")
-async def webhook(request: Request) -> Dict[str, Any]:
+async def webhook(
+    request: Request, background_tasks: BackgroundTasks
+) -> Dict[str, Any]:
     if general_utils.DEVELOPMENT_LOCATION == "local":
         webhook_secret = os.environ["STRIPE_WEBHOOK_SECRET_LOCAL"]
     else:
-        webhook_secret = general_utils.get_ssm_parameter_value(
+        webhook_secret = await general_utils.get_ssm_parameter_value_async(
             general_utils.SSMParameterName.SSM_STRIPE_WEBHOOK_SECRET.value
         )
 
@@ -172,6 +245,8 @@ async def webhook(request: Request) -> Dict[str, Any]:
 
     data = await request.body()
 
+    stripe = await general_utils.get_stripe_async()
+
     try:
         event = stripe.Webhook.construct_event(
             payload=data.decode("utf-8"),
@@ -182,61 +257,89 @@ async def webhook(request: Request) -> Dict[str, Any]:
         print("Error parsing payload: {}".format(str(e)))
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST)
 
-    event_type, *fields = event["type"].split(".")
-
-    response = {"message": f"event type {event['type']} not handled"}
-
-    if event_type in ("product", "price", "customer"):
-        response = stripe_utils.process_stripe_crud_event(
-            event_data=event,
-            table=f"{general_utils.COMPANY}-{general_utils.DEVELOPMENT_ENVIRONMENT}-{event_type}",
-            operation=fields[-1],
-        )
-
-    if event["type"] == "checkout.session.completed":
-        response = stripe_utils.process_checkout_session_completed_event(
-            event_data=event
-        )
-
-    return response
+    # acknowledge as soon as the event is durably queued, the worker applies it
+    queue = events.get_event_queue()
+    message_id = await aio.run_blocking(queue.send, data.decode("utf-8"))
+    events.event_queue_metrics.record_enqueued()
+
+    if isinstance(queue, events.SQLiteEventQueue):
+        background_tasks.add_task(aio.run_blocking, events.drain_event_queue, queue)
+
+    return {"message": "queued", "id": event["id"], "message_id": message_id}
+
+
+# cache headers of the public catalog routes, clients revalidate with the etag
+PRODUCTS_CACHE_CONTROL = os.environ.get(
+    "PRODUCTS_CACHE_CONTROL", "public, max-age=30, stale-while-revalidate=300"
+)
+PRICES_CACHE_CONTROL = os.environ.get(
+    "PRICES_CACHE_CONTROL", "public, max-age=30, stale-while-revalidate=300"
+)
+PRODUCT_POPULARITY_CACHE_CONTROL = os.environ.get(
+    "PRODUCT_POPULARITY_CACHE_CONTROL",
+    "public, max-age=300, stale-while-revalidate=3600",
+)
+
+
+async def catalog_response(
+    request: Request, table_name: str, active_only: bool, cache_control: str
+) -> Response:
+    # the catalog is validated and encoded by the cache, the response models of
+    # the routes only document the bodies. a revalidation only needs the version.
+    version = await catalog.catalog_cache.get_version_async()
+    etag = catalog.catalog_etag(table_name, active_only, version)
+    if general_utils.etag_matches(request.headers.get("if-none-match"), etag):
+        return general_utils.not_modified_response(etag, cache_control)
+
+    body, version = await catalog.catalog_cache.get_body_async(table_name, active_only)
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers=general_utils.cache_headers(
+            catalog.catalog_etag(table_name, active_only, version), cache_control
+        ),
+    )
 
 
-@router.get("/products")
-async def get_products(active_only: bool = True) -> List[schemas.Product]:
-    return stripe_utils.get_table_items(
-        tables.PRODUCT_TABLE_NAME,
-        schemas.Product,
+@router.get("/products", response_model=List[schemas.Product])
+async def get_products(request: Request, active_only: bool = True) -> Response:
+    return await catalog_response(
+        request, tables.PRODUCT_TABLE_NAME, active_only, PRODUCTS_CACHE_CONTROL
     )
 
 
-@router.get("/prices")
-async def get_prices(active_only: bool = True) -> List[schemas.Price]:
-    return stripe_utils.get_table_items(
-        tables.PRICE_TABLE_NAME,
-        schemas.Price,
+@router.get("/prices", response_model=List[schemas.Price])
+async def get_prices(request: Request, active_only: bool = True) -> Response:
+    return await catalog_response(
+        request, tables.PRICE_TABLE_NAME, active_only, PRICES_CACHE_CONTROL
     )
 
 
 @router.get("/product-popularity")
-async def get_product_popularity() -> List[schemas.RankedProduct]:
-    product_counter = {
-        p["id"]: ({c: p[c] for c in ["id", "images", "name"]} | {"quantity": 0})
-        for p in stripe_utils.get_table_items(
-            tables.PRODUCT_TABLE_NAME,
+async def get_product_popularity(
+    request: Request, response: Response
+) -> List[schemas.RankedProduct]:
+    counters, counters_digest = await popularity.popularity_counters_cache.get_async()
+    version = await catalog.catalog_cache.get_version_async()
+    etag = f'"popularity-{version}-{counters_digest}"'
+    if general_utils.etag_matches(request.headers.get("if-none-match"), etag):
+        return general_utils.not_modified_response(
+            etag, PRODUCT_POPULARITY_CACHE_CONTROL
         )
-        if p["active"]
-    }
 
-    line_items = stripe_utils.get_line_items()
-
-    for item in line_items:
-        product_id = item["price"]["product"]
-        if product_id in product_counter:
-            product_counter[product_id]["quantity"] += int(item["quantity"])
+    response.headers.update(
+        general_utils.cache_headers(etag, PRODUCT_POPULARITY_CACHE_CONTROL)
+    )
 
     return list(
         sorted(
-            [p for p in product_counter.values()],
+            [
+                {c: p[c] for c in ["id", "images", "name"]}
+                | {"quantity": counters.get(p["id"], 0)}
+                for p in await catalog.catalog_cache.get_items_async(
+                    tables.PRODUCT_TABLE_NAME
+                )
+            ],
             key=lambda x: x["quantity"],
             reverse=True,
         )
@@ -0,0 +1,256 @@
+import math
+import os
+import threading
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+from api_lib.stripe import catalog, schemas, tables
+
+# checkout sessions in payment mode take at most 100 line items
+CART_MAX_LINE_ITEMS = int(os.environ.get("CART_MAX_LINE_ITEMS", 100))
+CART_MAX_QUANTITY = int(os.environ.get("CART_MAX_QUANTITY", 999999))
+
+
+# ---------------------------------------------------------------------------- #
+#                                  validation                                  #
+# ---------------------------------------------------------------------------- #
+
+# carts are checked against the mirrored price and product tables before stripe
+# is called, the errors are shaped like the request validation errors of fastapi
+
+
+class CartError(ValueError):
+    def __init__(self, errors: List[Dict[str, Any]]):
+        super().__init__("; ".join(e["msg"] for e in errors))
+        self.errors = errors
+
+
+def cart_error(error_type: str, loc: Tuple[Any, ...], msg: str, value: Any):
+    return {"type": error_type, "loc": ["body", *loc], "msg": msg, "input": value}
+
+
+def validate_cart_size(line_items: List[schemas.PriceItem]):
+    # checked before the catalog is read
+    if not line_items:
+        raise CartError([cart_error("cart_empty", (), "the cart is empty", [])])
+    if len(line_items) > CART_MAX_LINE_ITEMS:
+        raise CartError(
+            [
+                cart_error(
+                    "cart_too_large",
+                    (),
+                    f"a cart holds at most {CART_MAX_LINE_ITEMS} line items",
+                    len(line_items),
+                )
+            ]
+        )
+
+
+def validate_cart(
+    line_items: List[schemas.PriceItem],
+    prices: Dict[str, Dict[str, Any]],
+    products: Dict[str, Dict[str, Any]],
+) -> List[Dict[str, Any]]:
+    # the price of every line item, or a CartError listing every problem found
+    validate_cart_size(line_items)
+
+    errors = []
+    currency = None
+    for i, line_item in enumerate(line_items):
+        if not 1 <= line_item.quantity <= CART_MAX_QUANTITY:
+            errors.append(
+                cart_error(
+                    "quantity_out_of_range",
+                    (i, "quantity"),
+                    f"quantity must be between 1 and {CART_MAX_QUANTITY}",
+                    line_item.quantity,
+                )
+            )
+
+        price = prices.get(line_item.price)
+        if price is None:
+            errors.append(
+                cart_error(
+                    "price_not_found",
+                    (i, "price"),
+                    "unknown price",
+                    line_item.price,
+                )
+            )
+            continue
+        if not price.get("active"):
+            errors.append(
+                cart_error(
+                    "price_inactive",
+                    (i, "price"),
+                    "the price is no longer available",
+                    line_item.price,
+                )
+            )
+        # products missing from the mirror are left for stripe to check
+        product = products.get(price["product"])
+        if product is not None and not product.get("active"):
+            errors.append(
+                cart_error(
+                    "product_inactive",
+                    (i, "price"),
+                    "the product is no longer available",
+                    line_item.price,
+                )
+            )
+        if price.get("recurring") is not None:
+            errors.append(
+                cart_error(
+                    "price_recurring",
+                    (i, "price"),
+                    "subscription prices cannot be bought in a one time payment",
+                    line_item.price,
+                )
+            )
+        if currency is None:
+            currency = price["currency"]
+        elif price["currency"] != currency:
+            errors.append(
+                cart_error(
+                    "currency_mismatch",
+                    (i, "price"),
+                    f"the cart is priced in {currency}, not {price['currency']}",
+                    line_item.price,
+                )
+            )
+
+    if errors:
+        raise CartError(errors)
+    return [prices[line_item.price] for line_item in line_items]
+
+
+async def check_cart_async(
+    line_items: List[schemas.PriceItem],
+) -> List[Dict[str, Any]]:
+    cart_metrics.record_checked()
+    try:
+        validate_cart_size(line_items)
+        prices = await catalog.catalog_cache.get_items_by_id_async(
+            tables.PRICE_TABLE_NAME, {line_item.price for line_item in line_items}
+        )
+        products = await catalog.catalog_cache.get_items_by_id_async(
+            tables.PRODUCT_TABLE_NAME,
+            {price["product"] for price in prices.values()},
+        )
+        return validate_cart(line_items, prices, products)
+    except CartError:
+        cart_metrics.record_rejected()
+        raise
+
+
+class CartMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.rejected = 0
+
+    def record_checked(self):
+        with self._lock:
+            self.checked += 1
+
+    def record_rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"checked": self.checked, "rejected": self.rejected}
+
+
+cart_metrics = CartMetrics()
+
+
+# ---------------------------------------------------------------------------- #
+#                                    pricing                                   #
+# ---------------------------------------------------------------------------- #
+
+# amounts are in the smallest currency unit like stripe's. a line without a
+# known amount, a customer chosen amount or tiers missing from the mirror, makes
+# the cart total unknown rather than wrong.
+
+
+def _amount(o: Dict[str, Any], name: str) -> Optional[Decimal]:
+    # the decimal string carries sub unit amounts
+    value = o.get(f"{name}_decimal")
+    if value is None:
+        value = o.get(name)
+    if value is None:
+        return None
+    return Decimal(str(value))
+
+
+def _round(amount: Decimal) -> int:
+    return int(amount.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def _tier_amount(tier: Dict[str, Any], quantity: int) -> Decimal:
+    unit_amount = _amount(tier, "unit_amount") or Decimal(0)
+    flat_amount = _amount(tier, "flat_amount") or Decimal(0)
+    return unit_amount * quantity + flat_amount
+
+
+def tiered_amount(price: Dict[str, Any], quantity: int) -> Optional[int]:
+    tiers = price.get("tiers")
+    if not tiers:
+        return None
+
+    if price.get("tiers_mode") == "volume":
+        # the whole quantity is priced at the tier it falls in
+        for tier in tiers:
+            if tier["up_to"] is None or quantity <= tier["up_to"]:
+                return _round(_tier_amount(tier, quantity))
+        return None
+
+    # graduated, each tier prices the units that fall in it
+    total = Decimal(0)
+    lower = 0
+    for tier in tiers:
+        upper = quantity if tier["up_to"] is None else min(quantity, tier["up_to"])
+        if upper <= lower:
+            break
+        total += _tier_amount(tier, upper - lower)
+        lower = upper
+    return _round(total)
+
+
+def line_item_amount(price: Dict[str, Any], quantity: int) -> Optional[int]:
+    if price.get("custom_unit_amount") is not None:
+        return None
+
+    if price.get("billing_scheme") == "tiered":
+        return tiered_amount(price, quantity)
+
+    transform_quantity = price.get("transform_quantity")
+    if transform_quantity is not None:
+        rounding = math.ceil if transform_quantity["round"] == "up" else math.floor
+        quantity = rounding(quantity / transform_quantity["divide_by"])
+
+    unit_amount = _amount(price, "unit_amount")
+    if unit_amount is None:
+        return None
+    return _round(unit_amount * quantity)
+
+
+def quote_cart(
+    line_items: List[schemas.PriceItem], prices: List[Dict[str, Any]]
+) -> Dict[str, Any]:
+    # prices are the validated prices of the line items, in the same order
+    quoted = [
+        {
+            "price": line_item.price,
+            "product": price["product"],
+            "quantity": line_item.quantity,
+            "amount": line_item_amount(price, line_item.quantity),
+        }
+        for line_item, price in zip(line_items, prices)
+    ]
+    amounts = [q["amount"] for q in quoted]
+    return {
+        "currency": prices[0]["currency"],
+        "amount_total": None if None in amounts else sum(amounts),
+        "line_items": quoted,
+    }
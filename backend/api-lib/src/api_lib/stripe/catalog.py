@@ -0,0 +1,492 @@
+import functools
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Literal, Optional, Tuple
+
+from pydantic import TypeAdapter
+
+from api_lib import aio, dynamodb
+from api_lib import utils as U
+from api_lib.stripe import schemas, tables
+from api_lib.stripe import utils as stripe_utils
+
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb import DynamoDBClient
+
+# how long a catalog snapshot is served before the version item is checked again
+CATALOG_VERSION_CHECK_INTERVAL = float(
+    os.environ.get("CATALOG_VERSION_CHECK_INTERVAL", 1)
+)
+
+
+# ---------------------------------------------------------------------------- #
+#                                catalog version                               #
+# ---------------------------------------------------------------------------- #
+
+
+def get_catalog_version(client: "DynamoDBClient") -> int:
+    item = client.get_item(
+        TableName=tables.STATE_TABLE_NAME,
+        Key={"id": {"S": tables.CATALOG_VERSION_ID}},
+        ProjectionExpression="#version",
+        ExpressionAttributeNames={"#version": "version"},
+    ).get("Item")
+    if item is None:
+        return 0
+    return int(item["version"]["N"])
+
+
+def bump_catalog_version(client: "DynamoDBClient") -> int:
+    updated = client.update_item(
+        TableName=tables.STATE_TABLE_NAME,
+        Key={"id": {"S": tables.CATALOG_VERSION_ID}},
+        UpdateExpression="ADD #version :one SET updated_at = :now",
+        ExpressionAttributeNames={"#version": "version"},
+        ExpressionAttributeValues={
+            ":one": {"N": "1"},
+            ":now": {"N": str(int(time.time()))},
+        },
+        ReturnValues="UPDATED_NEW",
+    )
+    return int(updated["Attributes"]["version"]["N"])
+
+
+# ---------------------------------------------------------------------------- #
+#                                catalog encoding                              #
+# ---------------------------------------------------------------------------- #
+
+# response models of the tables served as prepared json, every item is validated
+# and encoded once when it enters a snapshot instead of on every request
+CATALOG_RESPONSE_MODELS = {
+    tables.PRODUCT_TABLE_NAME: schemas.Product,
+    tables.PRICE_TABLE_NAME: schemas.Price,
+}
+
+_catalog_adapters = {
+    table_name: TypeAdapter(model)
+    for table_name, model in CATALOG_RESPONSE_MODELS.items()
+}
+
+
+def encode_catalog_item(table_name: str, item: Dict[str, Any]) -> bytes:
+    # same json as the response model would produce for the item
+    adapter = _catalog_adapters[table_name]
+    return adapter.dump_json(adapter.validate_python(item))
+
+
+def join_catalog_items(encoded_items: Iterable[bytes]) -> bytes:
+    return b"[" + b",".join(encoded_items) + b"]"
+
+
+@functools.lru_cache(maxsize=None)
+def _response_schema_digest(table_name: str) -> str:
+    schema = _catalog_adapters[table_name].json_schema()
+    return hashlib.blake2b(
+        json.dumps(schema, sort_keys=True).encode(), digest_size=4
+    ).hexdigest()
+
+
+def catalog_etag(table_name: str, active_only: bool, version: int) -> str:
+    # every product and price write bumps the version, so the tag is known
+    # without reading the table. the schema digest keeps bodies cached before a
+    # response model change from matching after a deploy.
+    return (
+        f'"{table_name.rsplit("-", 1)[-1]}-{"active" if active_only else "all"}'
+        f'-{version}-{_response_schema_digest(table_name)}"'
+    )
+
+
+# ---------------------------------------------------------------------------- #
+#                                 catalog cache                                #
+# ---------------------------------------------------------------------------- #
+
+# read through cache of the product and price tables, snapshots are dropped when
+# the catalog version changes and patched in place by webhooks in this process.
+# the encoded items and the response bodies built from them live and die with
+# the snapshot they were made from.
+
+
+class CatalogCache:
+    def __init__(self, check_interval: float = CATALOG_VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._snapshots: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._encoded: Dict[str, Dict[str, bytes]] = {}
+        self._bodies: Dict[Tuple[str, bool], Tuple[bytes, int]] = {}
+        self._version: Optional[int] = None
+        self._checked_at: Optional[float] = None
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.version_checks = 0
+        self.loads = 0
+        self.patches = 0
+        self.invalidations = 0
+        self.encodes = 0
+
+    def _fresh(self, table_name: str, now: float) -> bool:
+        return (
+            table_name in self._snapshots
+            and self._checked_at is not None
+            and now - self._checked_at < self.check_interval
+        )
+
+    def _items(self, table_name: str, active_only: bool) -> List[Dict[str, Any]]:
+        items = self._snapshots[table_name].values()
+        if active_only:
+            return [i for i in items if i.get("active")]
+        return list(items)
+
+    def _version_fresh(self, now: float) -> bool:
+        return (
+            self._version is not None
+            and self._checked_at is not None
+            and now - self._checked_at < self.check_interval
+        )
+
+    def _check_version(self, client: "DynamoDBClient", now: float):
+        version = get_catalog_version(client)
+        self.version_checks += 1
+
+        if version != self._version:
+            self._invalidate()
+            self._version = version
+
+        self._checked_at = now
+
+    def get_version(self) -> int:
+        # the current catalog version, checked without loading any table
+        with self._lock:
+            now = time.monotonic()
+            if not self._version_fresh(now):
+                self._check_version(U.get_client(service_name="dynamodb"), now)
+            return self._version
+
+    async def get_version_async(self) -> int:
+        if self._version_fresh(time.monotonic()):
+            return self._version
+        return await aio.run_blocking(self.get_version)
+
+    def _refresh(self, table_name: str, now: float) -> bool:
+        # called with the lock held, false when the snapshot was already fresh
+        if self._fresh(table_name, now):
+            return False
+
+        client = U.get_client(service_name="dynamodb")
+
+        self._check_version(client, now)
+
+        if table_name in self._snapshots:
+            return False
+
+        self._snapshots[table_name] = {
+            item["id"]: item
+            for item in stripe_utils.query_and_extract_items_from_statement(
+                client, f'select * from "{table_name}"'
+            )
+        }
+        self.loads += 1
+        return True
+
+    def get_items(
+        self, table_name: str, active_only: bool = True
+    ) -> List[Dict[str, Any]]:
+        with self._lock:
+            if not self._refresh(table_name, time.monotonic()):
+                self.hits += 1
+            return self._items(table_name, active_only)
+
+    async def get_items_async(
+        self, table_name: str, active_only: bool = True
+    ) -> List[Dict[str, Any]]:
+        if self._fresh(table_name, time.monotonic()):
+            self.hits += 1
+            return self._items(table_name, active_only)
+        return await aio.run_blocking(self.get_items, table_name, active_only)
+
+    def _lookup(
+        self, table_name: str, item_ids: Iterable[str]
+    ) -> Dict[str, Dict[str, Any]]:
+        snapshot = self._snapshots[table_name]
+        return {i: snapshot[i] for i in item_ids if i in snapshot}
+
+    def get_items_by_id(
+        self, table_name: str, item_ids: Iterable[str]
+    ) -> Dict[str, Dict[str, Any]]:
+        # active and inactive items by id, ids missing from the table are left out
+        with self._lock:
+            if not self._refresh(table_name, time.monotonic()):
+                self.hits += 1
+            return self._lookup(table_name, item_ids)
+
+    async def get_items_by_id_async(
+        self, table_name: str, item_ids: Iterable[str]
+    ) -> Dict[str, Dict[str, Any]]:
+        if self._fresh(table_name, time.monotonic()):
+            self.hits += 1
+            return self._lookup(table_name, item_ids)
+        return await aio.run_blocking(self.get_items_by_id, table_name, item_ids)
+
+    def _encode(self, table_name: str) -> Dict[str, bytes]:
+        # encodes the items that are new to the snapshot or were patched
+        encoded = self._encoded.setdefault(table_name, {})
+        for item_id, item in self._snapshots[table_name].items():
+            if item_id not in encoded:
+                encoded[item_id] = encode_catalog_item(table_name, item)
+                self.encodes += 1
+        return encoded
+
+    def get_body(self, table_name: str, active_only: bool = True) -> Tuple[bytes, int]:
+        # json array of the table items, ready to be sent as a response body,
+        # with the catalog version it was built at
+        with self._lock:
+            if not self._refresh(table_name, time.monotonic()):
+                self.hits += 1
+            body = self._bodies.get((table_name, active_only))
+            if body is None:
+                encoded = self._encode(table_name)
+                body = self._bodies[(table_name, active_only)] = (
+                    join_catalog_items(
+                        encoded[i["id"]] for i in self._items(table_name, active_only)
+                    ),
+                    self._version,
+                )
+            return body
+
+    async def get_body_async(
+        self, table_name: str, active_only: bool = True
+    ) -> Tuple[bytes, int]:
+        if self._fresh(table_name, time.monotonic()):
+            body = self._bodies.get((table_name, active_only))
+            if body is not None:
+                self.hits += 1
+                return body
+        return await aio.run_blocking(self.get_body, table_name, active_only)
+
+    def apply(
+        self,
+        table_name: str,
+        operation: str,
+        item: Dict[str, Any],
+        version: int,
+    ):
+        with self._lock:
+            # only patch when the snapshot was current right before this write
+            if self._version != version - 1:
+                self._invalidate()
+                return
+            self._version = version
+            snapshot = self._snapshots.get(table_name)
+            if snapshot is None:
+                return
+            if operation == "deleted":
+                snapshot.pop(item["id"], None)
+            else:
+                snapshot[item["id"]] = item
+            # re-encoded with the next response body
+            self._encoded.get(table_name, {}).pop(item["id"], None)
+            for active_only in (True, False):
+                self._bodies.pop((table_name, active_only), None)
+            self.patches += 1
+
+    def _invalidate(self):
+        if self._snapshots:
+            self.invalidations += 1
+        self._snapshots = {}
+        self._encoded = {}
+        self._bodies = {}
+        self._version = None
+        self._checked_at = None
+
+    def clear(self):
+        with self._lock:
+            self._invalidate()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self._version,
+            "tables": {k: len(v) for k, v in self._snapshots.items()},
+            "body_bytes": sum(len(b) for b, _ in self._bodies.values()),
+            "hits": self.hits,
+            "version_checks": self.version_checks,
+            "loads": self.loads,
+            "patches": self.patches,
+            "invalidations": self.invalidations,
+            "encodes": self.encodes,
+        }
+
+
+catalog_cache = CatalogCache()
+
+
+# ---------------------------------------------------------------------------- #
+#                                product details                               #
+# ---------------------------------------------------------------------------- #
+
+# the product fields shown next to purchases, read per product id instead of
+# loading the product table
+PRODUCT_DETAIL_ATTRIBUTES = ("images", "name")
+PRODUCT_DETAIL_CACHE_SIZE = int(os.environ.get("PRODUCT_DETAIL_CACHE_SIZE", 1024))
+PRODUCT_DETAIL_CACHE_TTL = float(os.environ.get("PRODUCT_DETAIL_CACHE_TTL", 300))
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_SIZE = 100
+
+
+def batch_get_product_details(
+    client: "DynamoDBClient", product_ids: List[str]
+) -> Dict[str, Dict[str, Any]]:
+    attribute_names = {f"#{a}": a for a in ("id",) + PRODUCT_DETAIL_ATTRIBUTES}
+    details: Dict[str, Dict[str, Any]] = {}
+    for start in range(0, len(product_ids), BATCH_GET_SIZE):
+        request = {
+            tables.PRODUCT_TABLE_NAME: {
+                "Keys": [
+                    {"id": {"S": product_id}}
+                    for product_id in product_ids[start : start + BATCH_GET_SIZE]
+                ],
+                "ProjectionExpression": ", ".join(attribute_names),
+                "ExpressionAttributeNames": attribute_names,
+            }
+        }
+        attempt = 0
+        while request:
+            response = client.batch_get_item(RequestItems=request)
+            for item in response["Responses"].get(tables.PRODUCT_TABLE_NAME, []):
+                detail = dynamodb.decode_item(item)
+                details[detail.pop("id")] = detail
+            request = response.get("UnprocessedKeys")
+            if request:
+                time.sleep(random.uniform(0, min(5, 0.05 * 2**attempt)))
+                attempt += 1
+    return details
+
+
+# bounded lru of product details keyed by product id, ids that are not in the
+# table are remembered as well so a deleted product is not looked up every time
+
+
+class ProductDetailCache:
+    def __init__(
+        self,
+        maxsize: int = PRODUCT_DETAIL_CACHE_SIZE,
+        ttl: float = PRODUCT_DETAIL_CACHE_TTL,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, Tuple[float, Optional[Dict[str, Any]]]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.batch_calls = 0
+
+    def _lookup(
+        self, product_ids: Iterable[str]
+    ) -> Tuple[Dict[str, Dict[str, Any]], List[str]]:
+        found: Dict[str, Dict[str, Any]] = {}
+        missing: List[str] = []
+        now = time.monotonic()
+        with self._lock:
+            for product_id in dict.fromkeys(product_ids):
+                entry = self._entries.get(product_id)
+                if entry is None or now - entry[0] >= self.ttl:
+                    missing.append(product_id)
+                    continue
+                self._entries.move_to_end(product_id)
+                self.hits += 1
+                if entry[1] is not None:
+                    found[product_id] = entry[1]
+        return found, missing
+
+    def _fetch(self, product_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        fetched = batch_get_product_details(
+            U.get_client(service_name="dynamodb"), product_ids
+        )
+        with self._lock:
+            self.misses += len(product_ids)
+            self.batch_calls += -(-len(product_ids) // BATCH_GET_SIZE)
+            for product_id in product_ids:
+                self._entries[product_id] = (now, fetched.get(product_id))
+                self._entries.move_to_end(product_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return fetched
+
+    def get_many(self, product_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        found, missing = self._lookup(product_ids)
+        if missing:
+            found.update(self._fetch(missing))
+        return found
+
+    async def get_many_async(
+        self, product_ids: Iterable[str]
+    ) -> Dict[str, Dict[str, Any]]:
+        found, missing = self._lookup(product_ids)
+        if missing:
+            found.update(await aio.run_blocking(self._fetch, missing))
+        return found
+
+    def invalidate(self, product_id: str):
+        with self._lock:
+            self._entries.pop(product_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "batch_calls": self.batch_calls,
+        }
+
+
+product_detail_cache = ProductDetailCache()
+
+
+# ---------------------------------------------------------------------------- #
+#                                catalog writes                                #
+# ---------------------------------------------------------------------------- #
+
+
+def with_price_tiers(price: Dict[str, Any]) -> Dict[str, Any]:
+    # events leave out the tiers of a tiered price, they are needed to price carts
+    if price.get("billing_scheme") != "tiered" or price.get("tiers") is not None:
+        return price
+    expanded = U.get_stripe().Price.retrieve(price["id"], expand=["tiers"])
+    return {**price, "tiers": expanded["tiers"]}
+
+
+def process_catalog_event(
+    event_data: Dict[str, Any],
+    table: str,
+    operation: Literal["created", "updated", "deleted"],
+) -> Dict[str, Any]:
+    if table == tables.PRICE_TABLE_NAME and operation != "deleted":
+        event_data["data"]["object"] = with_price_tiers(event_data["data"]["object"])
+
+    response = stripe_utils.process_stripe_crud_event(
+        event_data=event_data, table=table, operation=operation
+    )
+
+    version = bump_catalog_version(U.get_client(service_name="dynamodb"))
+
+    # store the item the same way a table read would return it
+    item = dynamodb.decode_item(dynamodb.encode_item(event_data["data"]["object"]))
+
+    catalog_cache.apply(table, operation, item, version)
+    if table == tables.PRODUCT_TABLE_NAME:
+        product_detail_cache.invalidate(item["id"])
+
+    return response
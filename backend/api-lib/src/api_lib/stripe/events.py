@@ -0,0 +1,381 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from api_lib import utils as U
+from api_lib.stripe import catalog, tables
+from api_lib.stripe import utils as stripe_utils
+
+# set on the deployed functions, without it events go to a local sqlite file
+WEBHOOK_QUEUE_URL = os.environ.get("WEBHOOK_QUEUE_URL")
+WEBHOOK_QUEUE_PATH = os.environ.get(
+    "WEBHOOK_QUEUE_PATH",
+    f"/tmp/{U.COMPANY}-{U.DEVELOPMENT_ENVIRONMENT}-webhook-events.sqlite3",
+)
+
+# how many local events are drained per batch and how long a received event stays
+# hidden before it is handed out again
+WEBHOOK_WORKER_BATCH_SIZE = int(os.environ.get("WEBHOOK_WORKER_BATCH_SIZE", 100))
+WEBHOOK_VISIBILITY_TIMEOUT = float(os.environ.get("WEBHOOK_VISIBILITY_TIMEOUT", 60))
+
+# applied event ids are remembered in the state table for longer than stripe
+# keeps retrying a delivery (3 days)
+EVENT_DEDUP_PREFIX = "event#"
+EVENT_DEDUP_TTL = int(os.environ.get("EVENT_DEDUP_TTL", 7 * 24 * 60 * 60))
+
+
+class QueuedEvent(NamedTuple):
+    message_id: str
+    event: Dict[str, Any]
+    enqueued_at: float
+
+
+# ---------------------------------------------------------------------------- #
+#                                 event queues                                 #
+# ---------------------------------------------------------------------------- #
+
+
+class SQSEventQueue:
+    # deployed queue, drained by the sqs event source of the worker function
+
+    def __init__(self, queue_url: str):
+        self.queue_url = queue_url
+
+    def send(self, body: str) -> str:
+        return U.get_client(service_name="sqs").send_message(
+            QueueUrl=self.queue_url, MessageBody=body
+        )["MessageId"]
+
+    def depth(self) -> int:
+        attributes = U.get_client(service_name="sqs").get_queue_attributes(
+            QueueUrl=self.queue_url,
+            AttributeNames=[
+                "ApproximateNumberOfMessages",
+                "ApproximateNumberOfMessagesNotVisible",
+            ],
+        )["Attributes"]
+        return sum(int(v) for v in attributes.values())
+
+
+class SQLiteEventQueue:
+    # local stand in for development and tests, received rows are leased until
+    # deleted or until the visibility timeout hands them out again
+
+    def __init__(
+        self, path: str, visibility_timeout: float = WEBHOOK_VISIBILITY_TIMEOUT
+    ):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute("""create table if not exists webhook_events (
+                    id integer primary key autoincrement,
+                    body text not null,
+                    enqueued_at real not null,
+                    visible_at real not null
+                )""")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as connection:
+            with connection:
+                yield connection
+
+    def send(self, body: str) -> str:
+        now = time.time()
+        with self._lock, self._connect() as connection:
+            cursor = connection.execute(
+                "insert into webhook_events (body, enqueued_at, visible_at) "
+                "values (?, ?, ?)",
+                (body, now, now),
+            )
+            return str(cursor.lastrowid)
+
+    def receive(self, max_messages: int) -> List[QueuedEvent]:
+        now = time.time()
+        with self._lock, self._connect() as connection:
+            rows = connection.execute(
+                "select id, body, enqueued_at from webhook_events "
+                "where visible_at <= ? order by id limit ?",
+                (now, max_messages),
+            ).fetchall()
+            connection.executemany(
+                "update webhook_events set visible_at = ? where id = ?",
+                [(now + self.visibility_timeout, row[0]) for row in rows],
+            )
+        return [QueuedEvent(str(row[0]), json.loads(row[1]), row[2]) for row in rows]
+
+    def delete(self, message_ids: List[str]):
+        with self._lock, self._connect() as connection:
+            connection.executemany(
+                "delete from webhook_events where id = ?",
+                [(int(message_id),) for message_id in message_ids],
+            )
+
+    def depth(self) -> int:
+        with self._connect() as connection:
+            (count,) = connection.execute(
+                "select count(*) from webhook_events"
+            ).fetchone()
+        return count
+
+
+_event_queue = None
+_event_queue_lock = threading.Lock()
+
+
+def get_event_queue():
+    global _event_queue
+    if _event_queue is None:
+        with _event_queue_lock:
+            if _event_queue is None:
+                if WEBHOOK_QUEUE_URL:
+                    _event_queue = SQSEventQueue(WEBHOOK_QUEUE_URL)
+                else:
+                    _event_queue = SQLiteEventQueue(WEBHOOK_QUEUE_PATH)
+    return _event_queue
+
+
+# ---------------------------------------------------------------------------- #
+#                                 queue metrics                                #
+# ---------------------------------------------------------------------------- #
+
+
+class EventQueueMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.received = 0
+        self.processed = 0
+        self.coalesced = 0
+        self.ignored = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.stale = 0
+        self.last_lag: Optional[float] = None
+        self.max_lag: Optional[float] = None
+
+    def record_enqueued(self):
+        with self._lock:
+            self.enqueued += 1
+
+    def record_duplicate(self):
+        with self._lock:
+            self.duplicates += 1
+
+    def record_stale(self):
+        with self._lock:
+            self.stale += 1
+
+    def record_batch(
+        self,
+        received: int,
+        processed: int,
+        failed: int,
+        ignored: int,
+        lags: List[float],
+    ):
+        with self._lock:
+            self.received += received
+            self.processed += processed
+            self.failed += failed
+            self.ignored += ignored
+            self.coalesced += received - processed - failed - ignored
+            if lags:
+                self.last_lag = lags[-1]
+                self.max_lag = max(lags + [self.max_lag or 0.0])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enqueued": self.enqueued,
+                "received": self.received,
+                "processed": self.processed,
+                "coalesced": self.coalesced,
+                "ignored": self.ignored,
+                "failed": self.failed,
+                "duplicates": self.duplicates,
+                "stale": self.stale,
+                "last_lag_seconds": self.last_lag,
+                "max_lag_seconds": self.max_lag,
+            }
+
+
+event_queue_metrics = EventQueueMetrics()
+
+
+# ---------------------------------------------------------------------------- #
+#                                 event worker                                 #
+# ---------------------------------------------------------------------------- #
+
+
+def claim_event(event_id: str) -> bool:
+    # false when the event was already applied by an earlier delivery
+    client = U.get_client(service_name="dynamodb")
+    try:
+        client.put_item(
+            TableName=tables.STATE_TABLE_NAME,
+            Item={
+                "id": {"S": f"{EVENT_DEDUP_PREFIX}{event_id}"},
+                "expires_at": {"N": str(int(time.time()) + EVENT_DEDUP_TTL)},
+            },
+            ConditionExpression="attribute_not_exists(id)",
+        )
+    except client.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+
+def release_event(event_id: str):
+    U.get_client(service_name="dynamodb").delete_item(
+        TableName=tables.STATE_TABLE_NAME,
+        Key={"id": {"S": f"{EVENT_DEDUP_PREFIX}{event_id}"}},
+    )
+
+
+def handle_event(event: Dict[str, Any]):
+    if not claim_event(event["id"]):
+        event_queue_metrics.record_duplicate()
+        return {"message": f"event {event['id']} already applied"}
+
+    try:
+        return apply_event(event)
+    except stripe_utils.StaleEventError:
+        event_queue_metrics.record_stale()
+        return {"message": f"event {event['id']} is older than the stored object"}
+    except Exception:
+        # let a redelivery apply the event
+        release_event(event["id"])
+        raise
+
+
+# the objects whose created, updated and deleted events are mirrored to a table
+CRUD_EVENT_OBJECTS = ("product", "price", "customer")
+
+
+def event_handler_key(event: Dict[str, Any]) -> Optional[str]:
+    # events with the same key for the same object supersede each other, none
+    # for the event types that are not handled
+    event_type = event["type"].split(".")[0]
+    if event_type in CRUD_EVENT_OBJECTS:
+        return event_type
+    if event["type"] == "checkout.session.completed":
+        return event["type"]
+    return None
+
+
+def apply_event(event: Dict[str, Any]):
+    event_type, *fields = event["type"].split(".")
+
+    response = {"message": f"event type {event['type']} not handled"}
+
+    if event_type in CRUD_EVENT_OBJECTS:
+        table = f"{U.COMPANY}-{U.DEVELOPMENT_ENVIRONMENT}-{event_type}"
+        response = (
+            catalog.process_catalog_event
+            if table in tables.CATALOG_TABLE_NAMES
+            else stripe_utils.process_stripe_crud_event
+        )(event_data=event, table=table, operation=fields[-1])
+
+    if event["type"] == "checkout.session.completed":
+        response = stripe_utils.process_checkout_session_completed_event(
+            event_data=event,
+            line_items=stripe_utils.list_all_line_items(event["data"]["object"]["id"]),
+        )
+
+    return response
+
+
+def coalesce_events(
+    messages: List[QueuedEvent],
+) -> List[Tuple[QueuedEvent, List[str]]]:
+    # several events of the same handler for the same object collapse into the
+    # newest one, which is returned with the ids of every message it stands for.
+    # events that are not handled are left out.
+    groups: Dict[Tuple[str, str, str], Tuple[QueuedEvent, List[str]]] = {}
+    for message in messages:
+        handler_key = event_handler_key(message.event)
+        if handler_key is None:
+            continue
+        data_object = message.event["data"]["object"]
+        key = (
+            handler_key,
+            data_object.get("object", ""),
+            data_object.get("id", message.message_id),
+        )
+        if key not in groups:
+            groups[key] = (message, [message.message_id])
+            continue
+        newest, message_ids = groups[key]
+        message_ids.append(message.message_id)
+        if message.event["created"] >= newest.event["created"]:
+            groups[key] = (message, message_ids)
+    return list(groups.values())
+
+
+def process_queued_events(messages: List[QueuedEvent]) -> List[str]:
+    # returns the ids of the messages that failed and have to be retried
+    failed: List[str] = []
+    processed = 0
+    lags = []
+    groups = coalesce_events(messages)
+    for message, message_ids in groups:
+        try:
+            handle_event(message.event)
+        except Exception as e:
+            print(f"ERROR: webhook event {message.event.get('id')} failed: {e}")
+            failed.extend(message_ids)
+            continue
+        processed += 1
+        lags.append(time.time() - message.enqueued_at)
+
+    event_queue_metrics.record_batch(
+        received=len(messages),
+        processed=processed,
+        failed=len(failed),
+        ignored=len(messages) - sum(len(ids) for _, ids in groups),
+        lags=lags,
+    )
+    return failed
+
+
+def drain_event_queue(
+    queue: SQLiteEventQueue, max_batches: Optional[int] = None
+) -> int:
+    drained = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        messages = queue.receive(WEBHOOK_WORKER_BATCH_SIZE)
+        if not messages:
+            break
+        failed = set(process_queued_events(messages))
+        queue.delete([m.message_id for m in messages if m.message_id not in failed])
+        drained += len(messages) - len(failed)
+        batches += 1
+    return drained
+
+
+def is_sqs_event(event: Any) -> bool:
+    return (
+        isinstance(event, dict)
+        and bool(event.get("Records"))
+        and event["Records"][0].get("eventSource") == "aws:sqs"
+    )
+
+
+def handle_sqs_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    messages = [
+        QueuedEvent(
+            record["messageId"],
+            json.loads(record["body"]),
+            int(record["attributes"]["SentTimestamp"]) / 1000,
+        )
+        for record in event["Records"]
+    ]
+    failed = process_queued_events(messages)
+    # partial batch response, only the failed messages become visible again
+    return {"batchItemFailures": [{"itemIdentifier": i} for i in failed]}
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+
+from api_lib import aio
+from api_lib import utils as U
+from api_lib.stripe import tables
+
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb import DynamoDBClient
+
+# prefix of the state items marking a checkout session as counted
+POPULARITY_MARKER_PREFIX = "popularity#"
+
+# TransactWriteItems accepts at most 100 actions, one is the marker
+MAX_PRODUCTS_PER_TRANSACTION = 99
+
+# how long the scanned counters are served before the table is scanned again
+PRODUCT_POPULARITY_CACHE_TTL = float(os.environ.get("PRODUCT_POPULARITY_CACHE_TTL", 30))
+
+
+def count_checkout_session_quantities(
+    checkout_session: Dict[str, Any],
+) -> Dict[str, int]:
+    quantities: Dict[str, int] = {}
+    for line_item in checkout_session.get("line_items") or []:
+        product_id = line_item["price"]["product"]
+        quantities[product_id] = quantities.get(product_id, 0) + int(
+            line_item["quantity"]
+        )
+    return quantities
+
+
+def is_checkout_session_complete(checkout_session: Dict[str, Any]) -> bool:
+    # open and expired sessions are carts that were never bought
+    return checkout_session.get("status") == "complete"
+
+
+def record_checkout_session_popularity(
+    client: "DynamoDBClient", checkout_session: Dict[str, Any]
+) -> bool:
+    if not is_checkout_session_complete(checkout_session):
+        return False
+
+    # the counters and the marker are written in one transaction so a replayed
+    # session fails the marker condition instead of being counted twice
+    quantities = list(count_checkout_session_quantities(checkout_session).items())
+
+    recorded = False
+
+    for chunk, start in enumerate(
+        range(0, len(quantities), MAX_PRODUCTS_PER_TRANSACTION)
+    ):
+        marker = f"{POPULARITY_MARKER_PREFIX}{checkout_session['id']}#{chunk}"
+        try:
+            client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Put": {
+                            "TableName": tables.STATE_TABLE_NAME,
+                            "Item": {"id": {"S": marker}},
+                            "ConditionExpression": "attribute_not_exists(id)",
+                        }
+                    }
+                ]
+                + [
+                    {
+                        "Update": {
+                            "TableName": tables.PRODUCT_POPULARITY_TABLE_NAME,
+                            "Key": {"id": {"S": product_id}},
+                            "UpdateExpression": "ADD quantity :quantity",
+                            "ExpressionAttributeValues": {
+                                ":quantity": {"N": str(quantity)}
+                            },
+                        }
+                    }
+                    for product_id, quantity in quantities[
+                        start : start + MAX_PRODUCTS_PER_TRANSACTION
+                    ]
+                ]
+            )
+            recorded = True
+        except client.exceptions.TransactionCanceledException as e:
+            reasons = e.response.get("CancellationReasons", [])
+            if not reasons or reasons[0].get("Code") != "ConditionalCheckFailed":
+                raise
+
+    return recorded
+
+
+def get_product_popularity_counters() -> Dict[str, int]:
+    client = U.get_client(service_name="dynamodb")
+    counters = {}
+    for page in client.get_paginator("scan").paginate(
+        TableName=tables.PRODUCT_POPULARITY_TABLE_NAME,
+        ProjectionExpression="id, quantity",
+    ):
+        for item in page["Items"]:
+            counters[item["id"]["S"]] = int(item.get("quantity", {"N": "0"})["N"])
+    return counters
+
+
+class PopularityCountersCache:
+    # the counters with a digest of their values, the digest tags the ranking
+    # responses built from them
+
+    def __init__(self, ttl: float = PRODUCT_POPULARITY_CACHE_TTL):
+        self.ttl = ttl
+        self._counters: Optional[Tuple[Dict[str, int], str]] = None
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+
+    def _fresh(self, now: float) -> bool:
+        return self._loaded_at is not None and now - self._loaded_at < self.ttl
+
+    def get(self) -> Tuple[Dict[str, int], str]:
+        with self._lock:
+            now = time.monotonic()
+            if self._fresh(now):
+                self.hits += 1
+                return self._counters
+            counters = get_product_popularity_counters()
+            digest = hashlib.blake2b(
+                json.dumps(sorted(counters.items())).encode(), digest_size=8
+            ).hexdigest()
+            self._counters = (counters, digest)
+            self._loaded_at = now
+            self.loads += 1
+            return self._counters
+
+    async def get_async(self) -> Tuple[Dict[str, int], str]:
+        if self._fresh(time.monotonic()):
+            self.hits += 1
+            return self._counters
+        return await aio.run_blocking(self.get)
+
+    def clear(self):
+        with self._lock:
+            self._counters = None
+            self._loaded_at = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "products": len(self._counters[0]) if self._counters else 0,
+            "hits": self.hits,
+            "loads": self.loads,
+        }
+
+
+popularity_counters_cache = PopularityCountersCache()
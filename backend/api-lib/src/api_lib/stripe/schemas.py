@@ -47,6 +47,7 @@ class Price(BaseModel):
     type: Optional[str]
     unit_amount: Optional[int]
     unit_amount_decimal: Optional[str]
+    tiers: Optional[List[Dict[str, Any]]] = None
 
 
 class RankedProduct(BaseModel):
@@ -54,3 +55,21 @@ class RankedProduct(BaseModel):
     images: List[str]
     name: str
     quantity: int
+
+
+class PriceItem(BaseModel):
+    price: str
+    quantity: int
+
+
+class CartQuoteLineItem(BaseModel):
+    price: str
+    product: str
+    quantity: int
+    amount: Optional[int]
+
+
+class CartQuote(BaseModel):
+    currency: str
+    amount_total: Optional[int]
+    line_items: List[CartQuoteLineItem]
@@ -4,5 +4,33 @@ CHECKOUT_SESSION_COMPLETE_TABLE = (
     f"{U.COMPANY}-{U.DEVELOPMENT_ENVIRONMENT}-checkout-session-completed"
 )
 
+# sparse customer/created index over the completed checkout sessions, guest
+# checkouts never set the attribute so they stay out of the index
+PURCHASE_HISTORY_INDEX_NAME = "customer-created"
+PURCHASE_HISTORY_CUSTOMER_ATTRIBUTE = "history_customer"
+
 PRODUCT_TABLE_NAME = f"{U.COMPANY}-{U.DEVELOPMENT_ENVIRONMENT}-product"
 PRICE_TABLE_NAME = f"{U.COMPANY}-{U.DEVELOPMENT_ENVIRONMENT}-price"
+CUSTOMER_TABLE_NAME = f"{U.COMPANY}-{U.DEVELOPMENT_ENVIRONMENT}-customer"
+PRODUCT_POPULARITY_TABLE_NAME = (
+    f"{U.COMPANY}-{U.DEVELOPMENT_ENVIRONMENT}-product-popularity"
+)
+
+STATE_TABLE_NAME = f"{U.COMPANY}-{U.DEVELOPMENT_ENVIRONMENT}-state"
+
+# tables whose contents make up the public catalog
+CATALOG_TABLE_NAMES = (PRODUCT_TABLE_NAME, PRICE_TABLE_NAME)
+
+# id of the state item stamped on every catalog write
+CATALOG_VERSION_ID = "catalog-version"
+
+# key attributes of the tables declared in the cdk stack, partition key first, so
+# writes never need a describe_table call to find them
+TABLE_KEY_NAMES = {
+    CHECKOUT_SESSION_COMPLETE_TABLE: ("id", "customer"),
+    PRODUCT_TABLE_NAME: ("id",),
+    PRICE_TABLE_NAME: ("id",),
+    CUSTOMER_TABLE_NAME: ("id",),
+    PRODUCT_POPULARITY_TABLE_NAME: ("id",),
+    STATE_TABLE_NAME: ("id",),
+}
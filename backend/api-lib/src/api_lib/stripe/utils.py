@@ -1,10 +1,69 @@
-from typing import Any, Dict, List, Literal, TypeVar, Optional
-from mypy_boto3_dynamodb import DynamoDBClient
+import base64
+import json
+import os
+import threading
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Tuple,
+    TypeVar,
+    Optional,
+)
+
+from api_lib.stripe import popularity, tables
+
+from api_lib import dynamodb, utils as U
+
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb import DynamoDBClient
+
+# key schemas of tables missing from the registry, described once per process
+_described_key_names: Dict[str, Tuple[str, ...]] = {}
+_described_key_names_lock = threading.Lock()
+
+
+def get_table_key_names(client: "DynamoDBClient", table: str) -> Tuple[str, ...]:
+    key_names = tables.TABLE_KEY_NAMES.get(table) or _described_key_names.get(table)
+    if key_names is not None:
+        return key_names
+    with _described_key_names_lock:
+        if table not in _described_key_names:
+            schema = client.describe_table(TableName=table)["Table"]["KeySchema"]
+            _described_key_names[table] = tuple(
+                k["AttributeName"]
+                for k in sorted(schema, key=lambda k: k["KeyType"] != "HASH")
+            )
+        return _described_key_names[table]
+
+
+# created timestamp of the event that last wrote an item, older deliveries are
+# rejected by a condition on it
+EVENT_CREATED_ATTRIBUTE = "_event_created"
+
+# fingerprint the stripe sync stores of the object it last wrote, the sync skips
+# objects whose fingerprint is unchanged so a webhook update has to clear it
+FINGERPRINT_ATTRIBUTE = "_fingerprint"
+
+
+# a deleted object leaves a tombstone in the state table holding the created
+# timestamp of the delete event, older creates and updates delivered after it are
+# rejected. kept for as long as stripe keeps events.
+DELETED_OBJECT_PREFIX = "deleted#"
+DELETED_OBJECT_TTL = int(os.environ.get("DELETED_OBJECT_TTL", 30 * 24 * 60 * 60))
 
-import stripe
-from api_lib.stripe import tables
 
-from api_lib import utils as U
+class StaleEventError(Exception):
+    pass
+
+
+def deleted_object_id(table: str, object_id: str) -> str:
+    return f"{DELETED_OBJECT_PREFIX}{table}#{object_id}"
 
 
 def process_stripe_crud_event(
@@ -14,18 +73,62 @@ def process_stripe_crud_event(
 ) -> Dict[str, Any]:
     client = U.get_client(service_name="dynamodb")
     deserialized_data = event_data["data"]["object"]
-    serialized_data = U.type_serializer.serialize(deserialized_data)["M"]
+    serialized_data = dynamodb.encode_item(deserialized_data)
+
+    # events can arrive out of order, only apply one that is at least as new as
+    # the event that produced the stored item
+    condition = {}
+    event_created = None
+    if event_data.get("created") is not None:
+        event_created = {"N": str(event_data["created"])}
+        serialized_data[EVENT_CREATED_ATTRIBUTE] = event_created
+        condition = {
+            "ConditionExpression": (
+                f"attribute_not_exists(#{EVENT_CREATED_ATTRIBUTE}) "
+                f"OR #{EVENT_CREATED_ATTRIBUTE} <= :event_created"
+            ),
+            "ExpressionAttributeNames": {
+                f"#{EVENT_CREATED_ATTRIBUTE}": EVENT_CREATED_ATTRIBUTE
+            },
+            "ExpressionAttributeValues": {":event_created": event_created},
+        }
+
+    def write(action: Literal["Put", "Update"], request: Dict[str, Any]):
+        if not condition:
+            if action == "Put":
+                return client.put_item(**request)
+            return client.update_item(**request)
+        # the write and the check that the object was not deleted by a newer
+        # event succeed or fail together
+        return client.transact_write_items(
+            TransactItems=[
+                {
+                    "ConditionCheck": {
+                        "TableName": tables.STATE_TABLE_NAME,
+                        "Key": {
+                            "id": {
+                                "S": deleted_object_id(table, deserialized_data["id"])
+                            }
+                        },
+                        "ConditionExpression": (
+                            "attribute_not_exists(id) OR #created < :event_created"
+                        ),
+                        "ExpressionAttributeNames": {"#created": "created"},
+                        "ExpressionAttributeValues": {":event_created": event_created},
+                    }
+                },
+                {action: request},
+            ]
+        )
 
     def create():
-        return client.put_item(
-            TableName=table,
-            Item=serialized_data,
+        return write(
+            "Put",
+            {"TableName": table, "Item": serialized_data, **condition},
         )
 
     def update():
-        described = client.describe_table(TableName=table)
-
-        keys = [key["AttributeName"] for key in described["Table"]["KeySchema"]]
+        keys = get_table_key_names(client, table)
 
         key_items = {k: serialized_data[k] for k in keys}
 
@@ -47,24 +150,60 @@ def process_stripe_crud_event(
 
         update_expression = update_expression.rstrip(", ")
 
-        return client.update_item(
-            TableName=table,
-            Key=key_items,
-            UpdateExpression=update_expression,
-            ExpressionAttributeValues=attribute_values,
-            ExpressionAttributeNames=expression_attribute_names,
+        update_expression += f" remove #{FINGERPRINT_ATTRIBUTE}"
+        expression_attribute_names[f"#{FINGERPRINT_ATTRIBUTE}"] = FINGERPRINT_ATTRIBUTE
+
+        if condition:
+            attribute_values.update(condition["ExpressionAttributeValues"])
+            expression_attribute_names.update(condition["ExpressionAttributeNames"])
+
+        return write(
+            "Update",
+            {
+                "TableName": table,
+                "Key": key_items,
+                "UpdateExpression": update_expression,
+                "ExpressionAttributeValues": attribute_values,
+                "ExpressionAttributeNames": expression_attribute_names,
+                **(
+                    {"ConditionExpression": condition["ConditionExpression"]}
+                    if condition
+                    else {}
+                ),
+            },
         )
 
     def delete() -> Dict[str, Any]:
-        described = client.describe_table(TableName=table)
-
-        schema = described["Table"]["KeySchema"]
+        keys = get_table_key_names(client, table)
+
+        # the tombstone is written first so an older event arriving while the
+        # item is removed is already rejected
+        if condition:
+            client.put_item(
+                TableName=tables.STATE_TABLE_NAME,
+                Item={
+                    "id": {"S": deleted_object_id(table, deserialized_data["id"])},
+                    "created": event_created,
+                    "expires_at": {"N": str(int(time.time()) + DELETED_OBJECT_TTL)},
+                },
+                ConditionExpression=(
+                    "attribute_not_exists(id) OR #created <= :event_created"
+                ),
+                ExpressionAttributeNames={"#created": "created"},
+                ExpressionAttributeValues={":event_created": event_created},
+            )
 
-        keys = [v["AttributeName"] for v in schema]
+        if all(k in serialized_data for k in keys):
+            return client.delete_item(
+                TableName=table, Key={k: serialized_data[k] for k in keys}, **condition
+            )
 
+        # the object does not carry its sort key, remove every item under the
+        # partition key
         items = client.query(
             TableName=table,
-            KeyConditionExpression=f"{keys[0]} = :a0",
+            KeyConditionExpression="#key = :a0",
+            ExpressionAttributeNames={"#key": keys[0]},
             ExpressionAttributeValues={":a0": serialized_data[keys[0]]},
         )["Items"]
 
@@ -72,49 +211,121 @@ def process_stripe_crud_event(
 
         for item in items:
             responses.append(
-                client.delete_item(TableName=table, Key={k: item[k] for k in keys})
+                client.delete_item(
+                    TableName=table, Key={k: item[k] for k in keys}, **condition
+                )
             )
         return responses
 
     response = "Nothing"
 
-    match operation:
-        case "created":
-            response = create()
-        case "updated":
-            response = update()
-        case "deleted":
-            response = delete()
-    client.close()
+    try:
+        match operation:
+            case "created":
+                response = create()
+            case "updated":
+                response = update()
+            case "deleted":
+                response = delete()
+    except client.exceptions.ConditionalCheckFailedException as e:
+        raise StaleEventError(
+            f"{table} already holds a newer event than {event_data.get('id')}"
+        ) from e
+    except client.exceptions.TransactionCanceledException as e:
+        reasons = e.response.get("CancellationReasons", [])
+        if not any(r.get("Code") == "ConditionalCheckFailed" for r in reasons):
+            raise
+        raise StaleEventError(
+            f"{table} already holds a newer event than {event_data.get('id')}"
+            " or the object was deleted"
+        ) from e
     return response
 
 
-def process_checkout_session_completed_event(event_data: Dict[str, Any]):
-    checkout_table = tables.CHECKOUT_SESSION_COMPLETE_TABLE
-    event_data["data"]["object"]["line_items"] = (
-        stripe.checkout.Session.list_line_items(
-            event_data["data"]["object"]["id"]
-        )["data"]
+# a single page covers almost every session, the default of 10 would truncate
+LINE_ITEMS_PAGE_SIZE = 100
+
+
+def list_all_line_items(checkout_session_id: str) -> List[Dict[str, Any]]:
+    stripe = U.get_stripe()
+    page = stripe.checkout.Session.list_line_items(
+        checkout_session_id, limit=LINE_ITEMS_PAGE_SIZE
     )
+    line_items = list(page["data"])
+    while page["has_more"]:
+        page = stripe.checkout.Session.list_line_items(
+            checkout_session_id,
+            limit=LINE_ITEMS_PAGE_SIZE,
+            starting_after=line_items[-1]["id"],
+        )
+        line_items.extend(page["data"])
+    return line_items
+
+
+def process_checkout_session_completed_event(
+    event_data: Dict[str, Any], line_items: Optional[List[Dict[str, Any]]] = None
+):
+    checkout_table = tables.CHECKOUT_SESSION_COMPLETE_TABLE
+    if line_items is None:
+        line_items = list_all_line_items(event_data["data"]["object"]["id"])
+    event_data["data"]["object"]["line_items"] = line_items
     if event_data["data"]["object"]["customer"] is None:
         event_data["data"]["object"]["customer"] = "N/A"
-    return process_stripe_crud_event(
+    else:
+        event_data["data"]["object"][tables.PURCHASE_HISTORY_CUSTOMER_ATTRIBUTE] = (
+            event_data["data"]["object"]["customer"]
+        )
+    response = process_stripe_crud_event(
         event_data=event_data, table=checkout_table, operation="created"
     )
+    popularity.record_checkout_session_popularity(
+        U.get_client(service_name="dynamodb"), event_data["data"]["object"]
+    )
+    return response
 
 
 T = TypeVar("T")
 
 
-def query_and_extract_items_from_statement(
-    client: DynamoDBClient, statement: str
-) -> Dict[str, any]:
-    serialized_products = client.execute_statement(Statement=statement)["Items"]
+def iter_pages_from_statement(
+    client: "DynamoDBClient",
+    statement: str,
+    page_size: Optional[int] = None,
+    attributes: Optional[Iterable[str]] = None,
+) -> Iterator[List[Dict[str, Any]]]:
+    # follow NextToken so results past the 1 MB page limit are not dropped
+    kwargs = {"Statement": statement}
+    if page_size is not None:
+        kwargs["Limit"] = page_size
+
+    while True:
+        response = client.execute_statement(**kwargs)
+
+        yield [dynamodb.decode_item(S, attributes) for S in response["Items"]]
+
+        if "NextToken" not in response:
+            break
+
+        kwargs["NextToken"] = response["NextToken"]
 
-    return [
-        {k: U.type_deserializer.deserialize(v) for k, v in S.items()}
-        for S in serialized_products
-    ]
+
+def iter_items_from_statement(
+    client: "DynamoDBClient",
+    statement: str,
+    page_size: Optional[int] = None,
+    attributes: Optional[Iterable[str]] = None,
+) -> Iterator[Dict[str, Any]]:
+    for page in iter_pages_from_statement(client, statement, page_size, attributes):
+        yield from page
+
+
+def query_and_extract_items_from_statement(
+    client: "DynamoDBClient",
+    statement: str,
+    page_size: Optional[int] = None,
+    attributes: Optional[Iterable[str]] = None,
+) -> List[Dict[str, Any]]:
+    return list(iter_items_from_statement(client, statement, page_size, attributes))
 
 
 def get_table_items(
@@ -129,20 +340,81 @@ def get_table_items(
     else:
         statement = f'select * from "{table_name}"'
 
-    deserialized_products = query_and_extract_items_from_statement(client, statement)
+    # only the fields of the model are decoded when one is given
+    attributes = model.model_fields if model is not None else None
+    deserialized_products = query_and_extract_items_from_statement(
+        client, statement, attributes=attributes
+    )
 
     if model is not None:
         return [model(**p) for p in deserialized_products]
     return [p for p in deserialized_products]
 
 
-def get_line_items():
+def iter_line_items(page_size: Optional[int] = None) -> Iterator[Dict[str, Any]]:
     client = U.get_client(service_name="dynamodb")
     checkout_session_table = tables.CHECKOUT_SESSION_COMPLETE_TABLE
     statement = f'select line_items from "{checkout_session_table}"'
-    line_items = []
-    [
-        line_items.extend(line_item["line_items"])
-        for line_item in query_and_extract_items_from_statement(client, statement)
-    ]
-    return line_items
+    for item in iter_items_from_statement(client, statement, page_size):
+        yield from item["line_items"]
+
+
+def get_line_items():
+    return list(iter_line_items())
+
+
+def encode_cursor(last_evaluated_key: Dict[str, Any]) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps(last_evaluated_key, separators=(",", ":")).encode()
+    ).decode()
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(key, dict):
+        raise ValueError("invalid cursor")
+    return key
+
+
+def iter_purchase_history_pages(
+    client: "DynamoDBClient",
+    customer_id: str,
+    page_size: int,
+    exclusive_start_key: Optional[Dict[str, Any]] = None,
+) -> Iterator[Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]]:
+    # newest first from the sparse customer/created index, each page is yielded
+    # with the key to resume after it
+    kwargs = {
+        "TableName": tables.CHECKOUT_SESSION_COMPLETE_TABLE,
+        "IndexName": tables.PURCHASE_HISTORY_INDEX_NAME,
+        "KeyConditionExpression": "#customer = :customer",
+        "ExpressionAttributeNames": {
+            "#customer": tables.PURCHASE_HISTORY_CUSTOMER_ATTRIBUTE
+        },
+        "ExpressionAttributeValues": {":customer": {"S": customer_id}},
+        "ProjectionExpression": "created, line_items",
+        "ScanIndexForward": False,
+        "Limit": page_size,
+    }
+
+    if exclusive_start_key is not None:
+        if exclusive_start_key.get(tables.PURCHASE_HISTORY_CUSTOMER_ATTRIBUTE) != {
+            "S": customer_id
+        }:
+            raise ValueError("invalid cursor")
+        kwargs["ExclusiveStartKey"] = exclusive_start_key
+
+    while True:
+        response = client.query(**kwargs)
+
+        last_evaluated_key = response.get("LastEvaluatedKey")
+
+        yield [dynamodb.decode_item(S) for S in response["Items"]], last_evaluated_key
+
+        if last_evaluated_key is None:
+            break
+
+        kwargs["ExclusiveStartKey"] = last_evaluated_key
@@ -3,9 +3,8 @@ from typing import Annotated, List, Literal, Optional, Dict, Any
 from fastapi import Depends
 from fastapi.routing import APIRouter
 from pydantic import BaseModel
-import stripe
 
-from api_lib import oauth2, utils
+from api_lib import aio, identity, oauth2, utils
 
 router = APIRouter()
 
@@ -35,18 +34,29 @@ async def get_user(
 ) -> UserResponse:
     client = utils.get_client("cognito-idp")
 
-    user_details = client.get_user(AccessToken=access_token)
+    user_details = await aio.run_blocking(client.get_user, AccessToken=access_token)
 
     user_attributes = utils.parse_user_attributes(user_details)
 
-    if "custom:stripe_customer_id" not in user_attributes:
-        stripe_customer_id = stripe.Customer.create()
-        client.update_user_attributes(
+    if identity.STRIPE_CUSTOMER_ID_ATTRIBUTE not in user_attributes:
+        stripe = await utils.get_stripe_async()
+        stripe_customer_id = await stripe.Customer.create_async()
+        await aio.run_blocking(
+            client.update_user_attributes,
             AccessToken=access_token,
             UserAttributes=[
-                {"Name": "custom:stripe_customer_id", "Value": stripe_customer_id["id"]}
+                {
+                    "Name": identity.STRIPE_CUSTOMER_ID_ATTRIBUTE,
+                    "Value": stripe_customer_id["id"],
+                }
             ],
         )
-        user_details = client.get_user(AccessToken=access_token)
+        user_details = await aio.run_blocking(client.get_user, AccessToken=access_token)
+        user_attributes = utils.parse_user_attributes(user_details)
+
+    # prime the resolver so purchase endpoints skip their own get_user call
+    identity.customer_identity_resolver.remember(
+        user_attributes["sub"], user_attributes[identity.STRIPE_CUSTOMER_ID_ATTRIBUTE]
+    )
 
     return UserResponse(**user_details)
@@ -1,22 +1,39 @@
 import enum
+import hashlib
 import os
+import threading
 import time
-from typing import Any, Dict, List, Literal, Optional, overload
+import types
+from collections import OrderedDict
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    overload,
+)
 
 import boto3
-import boto3.dynamodb.types
-import requests
-import stripe
-from fastapi import HTTPException
+import boto3.session
+import botocore.client
+import botocore.config
+from fastapi import HTTPException, Response
 from jose import jwk, jwt
 from jose.utils import base64url_decode
-from mypy_boto3_cognito_idp import CognitoIdentityProviderClient
-from mypy_boto3_dynamodb import DynamoDBClient
-from mypy_boto3_ssm import SSMClient
-from starlette.status import HTTP_401_UNAUTHORIZED
+from starlette.status import HTTP_304_NOT_MODIFIED, HTTP_401_UNAUTHORIZED
 
-type_deserializer = boto3.dynamodb.types.TypeDeserializer()
-type_serializer = boto3.dynamodb.types.TypeSerializer()
+from api_lib import aio
+
+if TYPE_CHECKING:
+    from mypy_boto3_cognito_idp import CognitoIdentityProviderClient
+    from mypy_boto3_dynamodb import DynamoDBClient
+    from mypy_boto3_ssm import SSMClient
 
 COMPANY = os.environ.get("COMPANY", "my-test-company-name")
 
@@ -49,45 +66,183 @@ class SSMParameterName(enum.Enum):
         return self.value
 
 
+# ---------------------------------------------------------------------------- #
+#                             boto3 client registry                            #
+# ---------------------------------------------------------------------------- #
+
+BOTO3_MAX_POOL_CONNECTIONS = int(os.environ.get("BOTO3_MAX_POOL_CONNECTIONS", 50))
+BOTO3_CONNECT_TIMEOUT = float(os.environ.get("BOTO3_CONNECT_TIMEOUT", 2))
+BOTO3_READ_TIMEOUT = float(os.environ.get("BOTO3_READ_TIMEOUT", 10))
+BOTO3_MAX_ATTEMPTS = int(os.environ.get("BOTO3_MAX_ATTEMPTS", 5))
+BOTO3_TCP_KEEPALIVE = os.environ.get("BOTO3_TCP_KEEPALIVE", "true").lower() == "true"
+
+client_config = botocore.config.Config(
+    max_pool_connections=BOTO3_MAX_POOL_CONNECTIONS,
+    connect_timeout=BOTO3_CONNECT_TIMEOUT,
+    read_timeout=BOTO3_READ_TIMEOUT,
+    retries={"mode": "adaptive", "max_attempts": BOTO3_MAX_ATTEMPTS},
+    tcp_keepalive=BOTO3_TCP_KEEPALIVE,
+)
+
+
+# one client per service per process, clients are thread safe once created so
+# they are shared across threads and reused by warm lambda invocations
+
+
+class ClientRegistry:
+    def __init__(self, config: botocore.config.Config = client_config):
+        self.config = config
+        self._session: Optional[boto3.session.Session] = None
+        self._clients: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self.created: Dict[str, int] = {}
+        self.reused: Dict[str, int] = {}
+
+    def get(self, service_name: str):
+        with self._lock:
+            client = self._clients.get(service_name)
+            if client is not None:
+                self.reused[service_name] = self.reused.get(service_name, 0) + 1
+                return client
+            # sessions are not thread safe, so creation happens under the lock
+            if self._session is None:
+                self._session = boto3.session.Session()
+            client = self._session.client(service_name, config=self.config)
+            self._clients[service_name] = client
+            self.created[service_name] = self.created.get(service_name, 0) + 1
+            return client
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+            self._session = None
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"created": dict(self.created), "reused": dict(self.reused)}
+
+
+client_registry = ClientRegistry()
+
+
 # ---------------------------------------------------------------------------- #
 #                         type hints for boto3 clients                         #
 # ---------------------------------------------------------------------------- #
 
 
 @overload
-def get_client(service_name: Literal["ssm"]) -> SSMClient: ...
+def get_client(service_name: Literal["ssm"]) -> "SSMClient": ...
 
 
 @overload
-def get_client(service_name: Literal["dynamodb"]) -> DynamoDBClient: ...
+def get_client(service_name: Literal["dynamodb"]) -> "DynamoDBClient": ...
 
 
 @overload
 def get_client(
     service_name: Literal["cognito-idp"],
-) -> CognitoIdentityProviderClient: ...
+) -> "CognitoIdentityProviderClient": ...
 
 
-def get_client(service_name: Literal["ssm", "cognito-idp", "dynamodb"]):
-    return boto3.client(service_name)
+@overload
+def get_client(service_name: Literal["sqs"]) -> botocore.client.BaseClient: ...
+
+
+def get_client(service_name: Literal["ssm", "cognito-idp", "dynamodb", "sqs"]):
+    return client_registry.get(service_name)
 
 
 # ---------------------------------------------------------------------------- #
 #                              get ssm parameters                              #
 # ---------------------------------------------------------------------------- #
 
-
-def get_ssm_parameter_value(parameter_name: SSMParameterName, max_retries=5) -> str:
-    client = get_client("ssm")
-    retries = 0
-    while retries < max_retries:
-        retrieved = client.get_parameter(Name=parameter_name)
-        if "Parameter" in retrieved:
-            return retrieved["Parameter"]["Value"]
-        time.sleep(2**retries)
-        retries += 1
-    client.close()
-    return None
+SSM_PARAMETER_CACHE_TTL = float(os.environ.get("SSM_PARAMETER_CACHE_TTL", 300))
+
+# GetParameters accepts at most 10 names per call
+SSM_GET_PARAMETERS_BATCH_SIZE = 10
+
+
+class SSMParameterStore:
+    def __init__(
+        self,
+        parameter_names: Iterable[str],
+        ttl: float = SSM_PARAMETER_CACHE_TTL,
+    ):
+        self.parameter_names = list(dict.fromkeys(parameter_names))
+        self.ttl = ttl
+        self._values: Dict[str, Optional[str]] = {}
+        self._loaded_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.batch_calls = 0
+
+    def _fresh(self, parameter_name: str, now: float) -> bool:
+        loaded_at = self._loaded_at.get(parameter_name)
+        return loaded_at is not None and now - loaded_at < self.ttl
+
+    def _load(self, parameter_names: List[str], now: float):
+        client = get_client("ssm")
+        for i in range(0, len(parameter_names), SSM_GET_PARAMETERS_BATCH_SIZE):
+            names = parameter_names[i : i + SSM_GET_PARAMETERS_BATCH_SIZE]
+            retrieved = client.get_parameters(Names=names, WithDecryption=True)
+            self.batch_calls += 1
+            for parameter in retrieved["Parameters"]:
+                self._values[parameter["Name"]] = parameter["Value"]
+                self._loaded_at[parameter["Name"]] = now
+            for name in retrieved.get("InvalidParameters", []):
+                print(f"WARNING: ssm parameter {name} does not exist")
+                self._values.pop(name, None)
+                self._loaded_at.pop(name, None)
+
+    def get(self, parameter_name: str) -> Optional[str]:
+        parameter_name = str(parameter_name)
+        with self._lock:
+            now = time.monotonic()
+            if self._fresh(parameter_name, now):
+                self.hits += 1
+                return self._values[parameter_name]
+
+            self.misses += 1
+
+            # refresh every stale known parameter in the same round trip
+            stale = [n for n in self.parameter_names if not self._fresh(n, now)]
+            if parameter_name not in stale:
+                stale.append(parameter_name)
+            self._load(stale, now)
+
+            return self._values.get(parameter_name)
+
+    async def get_async(self, parameter_name: str) -> Optional[str]:
+        parameter_name = str(parameter_name)
+        loaded_at = self._loaded_at.get(parameter_name)
+        if loaded_at is not None and time.monotonic() - loaded_at < self.ttl:
+            self.hits += 1
+            return self._values.get(parameter_name)
+        return await aio.run_blocking(self.get, parameter_name)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+            self._loaded_at = {}
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "parameters": len(self._values),
+            "hits": self.hits,
+            "misses": self.misses,
+            "batch_calls": self.batch_calls,
+        }
+
+
+ssm_parameter_store = SSMParameterStore(p.value for p in SSMParameterName)
+
+
+def get_ssm_parameter_value(parameter_name: SSMParameterName) -> str:
+    return ssm_parameter_store.get(parameter_name)
+
+
+async def get_ssm_parameter_value_async(parameter_name: SSMParameterName) -> str:
+    return await ssm_parameter_store.get_async(parameter_name)
 
 
 def get_api_url() -> str:
@@ -98,7 +253,23 @@ def get_api_url() -> str:
 #                            set the stripe api key                            #
 # ---------------------------------------------------------------------------- #
 
-stripe.api_key = get_ssm_parameter_value(SSMParameterName.SSM_STRIPE_SECRET_KEY.value)
+# stripe takes about a second to import and its key lives in ssm, both are
+# deferred to the first route that talks to stripe instead of every cold start
+
+
+def get_stripe() -> types.ModuleType:
+    import stripe
+
+    if stripe.api_key is None:
+        stripe.api_key = get_ssm_parameter_value(
+            SSMParameterName.SSM_STRIPE_SECRET_KEY.value
+        )
+    return stripe
+
+
+async def get_stripe_async() -> types.ModuleType:
+    return await aio.run_blocking(get_stripe)
+
 
 # ---------------------------------------------------------------------------- #
 #                               handle jwt token                               #
@@ -107,13 +278,31 @@ stripe.api_key = get_ssm_parameter_value(SSMParameterName.SSM_STRIPE_SECRET_KEY.
 JWK = Dict[str, str]
 JWKS = Dict[str, List[JWK]]
 
+JWKS_CACHE_TTL = float(os.environ.get("JWKS_CACHE_TTL", 3600))
+JWKS_UNKNOWN_KID_REFRESH_INTERVAL = float(
+    os.environ.get("JWKS_UNKNOWN_KID_REFRESH_INTERVAL", 30)
+)
+# after a failed refresh the previous keys are served for this long before the
+# jwks is fetched again
+JWKS_REFRESH_FAILURE_BACKOFF = float(os.environ.get("JWKS_REFRESH_FAILURE_BACKOFF", 30))
+
 
 def get_user_pool_token_signing_key() -> JWKS:
+    import requests
+
     return requests.get(
         get_ssm_parameter_value(SSMParameterName.USER_POOL_SIGNING_KEY.value)
     ).json()
 
 
+async def get_user_pool_token_signing_key_async() -> JWKS:
+    url = await get_ssm_parameter_value_async(
+        SSMParameterName.USER_POOL_SIGNING_KEY.value
+    )
+    response = await aio.get_http_client().get(url)
+    return response.json()
+
+
 def get_hmac_key(token: str, jwks: JWKS) -> Optional[JWK]:
     kid = jwt.get_unverified_header(token).get("kid")
     for key in jwks.get("keys", []):
@@ -121,20 +310,274 @@ def get_hmac_key(token: str, jwks: JWKS) -> Optional[JWK]:
             return key
 
 
-def verify_jwt(token: str) -> bool:
+# process wide store of the constructed user pool signing keys keyed by kid, the
+# jwks document is re-fetched when the ttl lapses or an unknown kid shows up
+
+
+class JWKSKeyStore:
+    def __init__(
+        self,
+        fetch_jwks: Callable[[], JWKS] = get_user_pool_token_signing_key,
+        fetch_jwks_async: Callable[
+            [], Awaitable[JWKS]
+        ] = get_user_pool_token_signing_key_async,
+        ttl: float = JWKS_CACHE_TTL,
+        unknown_kid_refresh_interval: float = JWKS_UNKNOWN_KID_REFRESH_INTERVAL,
+        refresh_failure_backoff: float = JWKS_REFRESH_FAILURE_BACKOFF,
+    ):
+        self.fetch_jwks = fetch_jwks
+        self.fetch_jwks_async = fetch_jwks_async
+        self.ttl = ttl
+        self.unknown_kid_refresh_interval = unknown_kid_refresh_interval
+        self.refresh_failure_backoff = refresh_failure_backoff
+        self._keys: Dict[str, Any] = {}
+        self._fetched_at: Optional[float] = None
+        self._failed_at: Optional[float] = None
+        self._unknown_kid_refreshed_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def _expired(self, now: float) -> bool:
+        return self._fetched_at is None or now - self._fetched_at >= self.ttl
+
+    def _backing_off(self, now: float) -> bool:
+        # only with keys to fall back on, without them every request retries
+        return (
+            bool(self._keys)
+            and self._failed_at is not None
+            and now - self._failed_at < self.refresh_failure_backoff
+        )
+
+    def _lookup(self, kid: Optional[str], now: float) -> Tuple[Optional[Any], bool]:
+        # returns the key and whether the jwks document should be re-fetched
+        backing_off = self._backing_off(now)
+        if kid in self._keys and (backing_off or not self._expired(now)):
+            self.hits += 1
+            return self._keys[kid], False
+
+        self.misses += 1
+
+        if backing_off:
+            return None, False
+
+        if self._expired(now):
+            return None, True
+
+        if (
+            self._unknown_kid_refreshed_at is None
+            or now - self._unknown_kid_refreshed_at >= self.unknown_kid_refresh_interval
+        ):
+            # rate limit re-fetches triggered by unknown or forged kids
+            self._unknown_kid_refreshed_at = now
+            return None, True
+
+        return None, False
+
+    def _apply(self, jwks: JWKS, now: float):
+        self._keys = {
+            key["kid"]: jwk.construct(key)
+            for key in jwks.get("keys", [])
+            if "kid" in key
+        }
+        self._fetched_at = now
+        self._failed_at = None
+        self.refreshes += 1
+
+    def _refresh_failed(self, e: Exception, now: float):
+        self.refresh_failures += 1
+        self._failed_at = now
+        # keep serving the previous keys, cognito rotates them rarely
+        if not self._keys:
+            raise e
+        print(f"WARNING: failed to refresh the jwks, {e}")
+
+    def get_key(self, kid: Optional[str]) -> Optional[Any]:
+        with self._lock:
+            now = time.monotonic()
+            key, refresh = self._lookup(kid, now)
+            if not refresh:
+                return key
+            try:
+                self._apply(self.fetch_jwks(), now)
+            except Exception as e:
+                self._refresh_failed(e, now)
+            return self._keys.get(kid)
+
+    async def get_key_async(self, kid: Optional[str]) -> Optional[Any]:
+        with self._lock:
+            now = time.monotonic()
+            key, refresh = self._lookup(kid, now)
+        if not refresh:
+            return key
+        try:
+            jwks = await self.fetch_jwks_async()
+        except Exception as e:
+            with self._lock:
+                self._refresh_failed(e, now)
+                return self._keys.get(kid)
+        with self._lock:
+            # a concurrent request may have refreshed the keys while we waited
+            if self._fetched_at is None or self._fetched_at < now:
+                self._apply(jwks, now)
+            return self._keys.get(kid)
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._failed_at = None
+            self._unknown_kid_refreshed_at = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "keys": len(self._keys),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+        }
+
+
+jwks_key_store = JWKSKeyStore()
+
+VERIFIED_TOKEN_CACHE_SIZE = int(os.environ.get("VERIFIED_TOKEN_CACHE_SIZE", 1024))
+
+# bounded lru of verified tokens, keyed by the token hash so raw tokens are not
+# kept in memory, entries expire at the exp claim of the token
+
+
+class VerifiedTokenCache:
+    def __init__(self, maxsize: int = VERIFIED_TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        key = self._key(token)
+        with self._lock:
+            claims = self._entries.get(key)
+            if claims is None:
+                self.misses += 1
+                return None
+            if claims["exp"] <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return claims
+
+    def put(self, token: str, claims: Dict[str, Any]):
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = claims
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+verified_token_cache = VerifiedTokenCache()
+
+
+def verify_signature_with_key(token: str, public_key: Optional[Any]) -> bool:
+    if public_key is None:
+        raise ValueError("No pubic key found!")
+
+    message, encoded_signature = token.rsplit(".", 1)
+
+    return public_key.verify(
+        message.encode(), base64url_decode(encoded_signature.encode())
+    )
+
+
+def verify_jwt_signature(token: str) -> bool:
+    kid = jwt.get_unverified_header(token).get("kid")
+
+    return verify_signature_with_key(token, jwks_key_store.get_key(kid))
+
+
+def validate_access_token_claims(claims: Dict[str, Any], client_id: str):
+    if not isinstance(claims.get("exp"), (int, float)) or claims["exp"] <= time.time():
+        raise ValueError("Token has expired")
+
+    if claims.get("token_use") != "access":
+        raise ValueError("Token is not an access token")
+
+    if claims.get("client_id") != client_id:
+        raise ValueError("Token was not issued for this client")
+
+
+def verify_and_decode_jwt(token: str) -> Dict[str, Any]:
+    claims = verified_token_cache.get(token)
+
+    if claims is not None:
+        return claims
+
     try:
-        jwks = get_user_pool_token_signing_key()
-        hmac_key = get_hmac_key(token, jwks)
+        if not verify_jwt_signature(token):
+            raise ValueError("Signature verification failed")
+
+        claims = jwt.get_unverified_claims(token)
 
-        if not hmac_key:
-            raise ValueError("No pubic key found!")
+        validate_access_token_claims(
+            claims,
+            get_ssm_parameter_value(SSMParameterName.USER_POOL_CLIENT_ID.value),
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=HTTP_401_UNAUTHORIZED,
+            detail=f"Invalid token, {e}",
+        )
+
+    verified_token_cache.put(token, claims)
+
+    return claims
+
+
+async def verify_and_decode_jwt_async(token: str) -> Dict[str, Any]:
+    claims = verified_token_cache.get(token)
+
+    if claims is not None:
+        return claims
+
+    try:
+        kid = jwt.get_unverified_header(token).get("kid")
 
-        hmac_key = jwk.construct(get_hmac_key(token, jwks))
+        public_key = await jwks_key_store.get_key_async(kid)
 
-        message, encoded_signature = token.rsplit(".", 1)
+        if not verify_signature_with_key(token, public_key):
+            raise ValueError("Signature verification failed")
 
-        return hmac_key.verify(
-            message.encode(), base64url_decode(encoded_signature.encode())
+        claims = jwt.get_unverified_claims(token)
+
+        validate_access_token_claims(
+            claims,
+            await get_ssm_parameter_value_async(
+                SSMParameterName.USER_POOL_CLIENT_ID.value
+            ),
         )
     except Exception as e:
         raise HTTPException(
@@ -142,6 +585,18 @@ def verify_jwt(token: str) -> bool:
             detail=f"Invalid token, {e}",
         )
 
+    verified_token_cache.put(token, claims)
+
+    return claims
+
+
+def verify_jwt(token: str) -> bool:
+    return bool(verify_and_decode_jwt(token))
+
+
+async def verify_jwt_async(token: str) -> bool:
+    return bool(await verify_and_decode_jwt_async(token))
+
 
 # ---------------------------------------------------------------------------- #
 #                                 boto3 helpers                                #
@@ -156,3 +611,29 @@ def parse_user_attributes(user: dict[str, Any]) -> dict[str, Any]:
         value = attribute["Value"]
         output[key] = value
     return output
+
+
+# ---------------------------------------------------------------------------- #
+#                                 http caching                                 #
+# ---------------------------------------------------------------------------- #
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match uses the weak comparison, a W/ prefix does not matter
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")
+    )
+
+
+def cache_headers(etag: str, cache_control: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": cache_control}
+
+
+def not_modified_response(etag: str, cache_control: str) -> Response:
+    return Response(
+        status_code=HTTP_304_NOT_MODIFIED, headers=cache_headers(etag, cache_control)
+    )
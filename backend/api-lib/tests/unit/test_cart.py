@@ -0,0 +1,306 @@
+import pytest
+import stripe
+from fastapi.testclient import TestClient
+
+from api_lib import utils as general_utils
+from api_lib.main import app
+from api_lib.stripe import _stripe, cart, catalog, schemas, tables
+
+
+def price(price_id="price_1", **fields):
+    p = {
+        "id": price_id,
+        "object": "price",
+        "active": True,
+        "billing_scheme": "per_unit",
+        "currency": "usd",
+        "custom_unit_amount": None,
+        "product": "prod_1",
+        "recurring": None,
+        "tiers_mode": None,
+        "transform_quantity": None,
+        "type": "one_time",
+        "unit_amount": 1000,
+        "unit_amount_decimal": "1000",
+    }
+    p.update(fields)
+    return p
+
+
+def tiered(tiers_mode):
+    return price(
+        billing_scheme="tiered",
+        tiers_mode=tiers_mode,
+        unit_amount=None,
+        unit_amount_decimal=None,
+        tiers=[
+            {
+                "up_to": 5,
+                "unit_amount": 500,
+                "unit_amount_decimal": "500",
+                "flat_amount": 1000,
+                "flat_amount_decimal": "1000",
+            },
+            {
+                "up_to": 10,
+                "unit_amount": 450,
+                "unit_amount_decimal": "450",
+                "flat_amount": None,
+                "flat_amount_decimal": None,
+            },
+            {
+                "up_to": None,
+                "unit_amount": 400,
+                "unit_amount_decimal": "400",
+                "flat_amount": None,
+                "flat_amount_decimal": None,
+            },
+        ],
+    )
+
+
+def items(*line_items):
+    return [schemas.PriceItem(price=p, quantity=q) for p, q in line_items]
+
+
+def error_types(e):
+    return [(error["type"], error["loc"]) for error in e.value.errors]
+
+
+class TestLineItemAmount:
+    def test_per_unit(self):
+        assert cart.line_item_amount(price(), 3) == 3000
+
+    def test_decimal_unit_amount_rounds_half_up(self):
+        assert cart.line_item_amount(price(unit_amount_decimal="0.5"), 3) == 2
+        assert cart.line_item_amount(price(unit_amount_decimal="12.345"), 2) == 25
+        assert cart.line_item_amount(price(unit_amount_decimal="12.3"), 2) == 25
+
+    def test_decimal_unit_amount_is_preferred(self):
+        p = price(unit_amount=None, unit_amount_decimal="0.25")
+        assert cart.line_item_amount(p, 10) == 3
+
+    @pytest.mark.parametrize(
+        "rounding,quantity,amount", [("up", 11, 2000), ("down", 11, 1000)]
+    )
+    def test_transform_quantity(self, rounding, quantity, amount):
+        p = price(transform_quantity={"divide_by": 10, "round": rounding})
+        assert cart.line_item_amount(p, quantity) == amount
+
+    @pytest.mark.parametrize(
+        "quantity,amount",
+        [(3, 2500), (5, 3500), (6, 3950), (10, 5750), (12, 6550)],
+    )
+    def test_graduated_tiers(self, quantity, amount):
+        assert cart.line_item_amount(tiered("graduated"), quantity) == amount
+
+    @pytest.mark.parametrize(
+        "quantity,amount",
+        [(3, 2500), (5, 3500), (6, 2700), (10, 4500), (12, 4800)],
+    )
+    def test_volume_tiers(self, quantity, amount):
+        assert cart.line_item_amount(tiered("volume"), quantity) == amount
+
+    def test_decimal_tier_amounts(self):
+        p = tiered("volume")
+        p["tiers"][0].update(unit_amount_decimal="0.5", flat_amount_decimal="0.5")
+        assert cart.line_item_amount(p, 2) == 2
+
+    def test_unknown_amounts(self):
+        assert (
+            cart.line_item_amount(price(custom_unit_amount={"minimum": 1}), 1) is None
+        )
+        assert cart.line_item_amount({**tiered("graduated"), "tiers": None}, 1) is None
+        assert (
+            cart.line_item_amount(price(unit_amount=None, unit_amount_decimal=None), 1)
+            is None
+        )
+
+
+class TestQuoteCart:
+    def test_total(self):
+        line_items = items(("price_1", 2), ("price_2", 12))
+        prices = [price(), tiered("graduated")]
+        assert cart.quote_cart(line_items, prices) == {
+            "currency": "usd",
+            "amount_total": 8550,
+            "line_items": [
+                {
+                    "price": "price_1",
+                    "product": "prod_1",
+                    "quantity": 2,
+                    "amount": 2000,
+                },
+                {
+                    "price": "price_2",
+                    "product": "prod_1",
+                    "quantity": 12,
+                    "amount": 6550,
+                },
+            ],
+        }
+
+    def test_unknown_line_amount_makes_the_total_unknown(self):
+        line_items = items(("price_1", 2), ("price_2", 1))
+        prices = [price(), price("price_2", custom_unit_amount={"minimum": 1})]
+        assert cart.quote_cart(line_items, prices)["amount_total"] is None
+
+
+class TestValidateCart:
+    prices = {
+        "price_1": price(),
+        "price_eur": price("price_eur", currency="eur"),
+        "price_inactive": price("price_inactive", active=False),
+        "price_recurring": price("price_recurring", recurring={"interval": "month"}),
+        "price_2": price("price_2", product="prod_2"),
+    }
+    products = {
+        "prod_1": {"id": "prod_1", "active": True},
+        "prod_2": {"id": "prod_2", "active": False},
+    }
+
+    def validate(self, *line_items):
+        return cart.validate_cart(items(*line_items), self.prices, self.products)
+
+    def test_valid_cart_returns_prices_in_order(self):
+        assert self.validate(("price_1", 1), ("price_1", 2)) == [
+            self.prices["price_1"],
+            self.prices["price_1"],
+        ]
+
+    def test_empty_cart(self):
+        with pytest.raises(cart.CartError) as e:
+            self.validate()
+        assert error_types(e) == [("cart_empty", ["body"])]
+
+    def test_cart_too_large(self):
+        with pytest.raises(cart.CartError) as e:
+            self.validate(*[("price_1", 1)] * (cart.CART_MAX_LINE_ITEMS + 1))
+        assert error_types(e) == [("cart_too_large", ["body"])]
+
+    @pytest.mark.parametrize("quantity", [0, -1, cart.CART_MAX_QUANTITY + 1])
+    def test_quantity_out_of_range(self, quantity):
+        with pytest.raises(cart.CartError) as e:
+            self.validate(("price_1", quantity))
+        assert error_types(e) == [("quantity_out_of_range", ["body", 0, "quantity"])]
+
+    @pytest.mark.parametrize(
+        "price_id,error_type",
+        [
+            ("price_unknown", "price_not_found"),
+            ("price_inactive", "price_inactive"),
+            ("price_2", "product_inactive"),
+            ("price_recurring", "price_recurring"),
+        ],
+    )
+    def test_price_errors(self, price_id, error_type):
+        with pytest.raises(cart.CartError) as e:
+            self.validate(("price_1", 1), (price_id, 1))
+        assert error_types(e) == [(error_type, ["body", 1, "price"])]
+        assert e.value.errors[0]["input"] == price_id
+
+    def test_currency_mismatch(self):
+        with pytest.raises(cart.CartError) as e:
+            self.validate(("price_1", 1), ("price_eur", 1))
+        assert error_types(e) == [("currency_mismatch", ["body", 1, "price"])]
+
+    def test_every_error_is_listed(self):
+        with pytest.raises(cart.CartError) as e:
+            self.validate(("price_unknown", 0), ("price_inactive", 1))
+        assert error_types(e) == [
+            ("quantity_out_of_range", ["body", 0, "quantity"]),
+            ("price_not_found", ["body", 0, "price"]),
+            ("price_inactive", ["body", 1, "price"]),
+        ]
+
+
+class TestCheckoutRoutes:
+    client = TestClient(app)
+
+    @pytest.fixture(autouse=True)
+    def mirror(self, monkeypatch):
+        tables_items = {
+            tables.PRICE_TABLE_NAME: {"price_1": price()},
+            tables.PRODUCT_TABLE_NAME: {"prod_1": {"id": "prod_1", "active": True}},
+        }
+        self.catalog_reads = []
+
+        async def get_items_by_id_async(table_name, item_ids):
+            self.catalog_reads.append(table_name)
+            items = tables_items[table_name]
+            return {i: items[i] for i in item_ids if i in items}
+
+        monkeypatch.setattr(
+            catalog.catalog_cache, "get_items_by_id_async", get_items_by_id_async
+        )
+
+        async def get_stripe_async():
+            return stripe
+
+        monkeypatch.setattr(general_utils, "get_stripe_async", get_stripe_async)
+
+    def test_quote(self):
+        response = self.client.post(
+            "/stripe/checkout-quote", json=[{"price": "price_1", "quantity": 2}]
+        )
+        assert response.status_code == 200
+        assert response.json()["amount_total"] == 2000
+
+    def test_bad_cart_is_rejected_without_calling_stripe(self, monkeypatch):
+        async def create_async(**kwargs):
+            raise AssertionError("stripe was called")
+
+        monkeypatch.setattr(stripe.checkout.Session, "create_async", create_async)
+
+        response = self.client.post(
+            "/stripe/create-public-checkout-session",
+            json=[{"price": "price_unknown", "quantity": 1}],
+        )
+        assert response.status_code == 422
+        assert response.json() == {
+            "detail": [
+                {
+                    "type": "price_not_found",
+                    "loc": ["body", 0, "price"],
+                    "msg": "unknown price",
+                    "input": "price_unknown",
+                }
+            ]
+        }
+
+    def test_empty_cart_does_not_read_the_catalog(self):
+        response = self.client.post("/stripe/checkout-quote", json=[])
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["type"] == "cart_empty"
+        assert self.catalog_reads == []
+
+    @pytest.mark.parametrize(
+        "error,status_code,error_type",
+        [
+            (
+                stripe.InvalidRequestError(
+                    "No such price", "line_items", code="resource_missing"
+                ),
+                400,
+                "resource_missing",
+            ),
+            (stripe.APIConnectionError("connection reset"), 502, "stripe_error"),
+        ],
+    )
+    def test_stripe_errors(self, monkeypatch, error, status_code, error_type):
+        async def create_async(**kwargs):
+            raise error
+
+        monkeypatch.setattr(stripe.checkout.Session, "create_async", create_async)
+
+        response = self.client.post(
+            "/stripe/create-public-checkout-session",
+            json=[{"price": "price_1", "quantity": 1}],
+        )
+        assert response.status_code == status_code
+        assert response.json()["detail"]["type"] == error_type
+
+    def test_stripe_error_shape(self):
+        e = _stripe.stripe_error(stripe, stripe.APIError("upstream failed"))
+        assert e.status_code == 502
+        assert e.detail == {"type": "stripe_error", "msg": "upstream failed"}
@@ -0,0 +1,151 @@
+import math
+import pathlib
+from decimal import Decimal
+
+import pytest
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+from api_lib import dynamodb
+
+type_serializer = TypeSerializer()
+type_deserializer = TypeDeserializer()
+
+ITEM = {
+    "id": "cs_1",
+    "active": True,
+    "livemode": False,
+    "created": 1700000000,
+    "amount": Decimal("-12.5"),
+    "customer": None,
+    "metadata": {"nested": {"deeper": [1, "two", None, {"three": True}]}},
+    "line_items": [
+        {"price": {"id": "price_1", "unit_amount": 1000}, "quantity": 2},
+        {"price": {"id": "price_2", "unit_amount": 0}, "quantity": 1},
+    ],
+    "empty_map": {},
+    "empty_list": [],
+    "tags": {"a", "b"},
+    "sizes": {1, 2, Decimal("3.5")},
+    "blob": b"\x00\x01",
+    "blobs": {b"x", b"y"},
+}
+
+
+def boto3_encode(value):
+    return type_serializer.serialize(value)["M"]
+
+
+def boto3_decode(item):
+    return {k: type_deserializer.deserialize(v) for k, v in item.items()}
+
+
+def normalize(item):
+    # set order is not part of the wire format
+    if isinstance(item, dict):
+        if set(item) <= {"SS", "NS", "BS"} and len(item) == 1:
+            return {k: sorted(v) for k, v in item.items()}
+        return {k: normalize(v) for k, v in item.items()}
+    if isinstance(item, list):
+        return [normalize(v) for v in item]
+    return item
+
+
+class TestParity:
+    def test_encode_matches_boto3(self):
+        assert normalize(dynamodb.encode_item(ITEM)) == normalize(boto3_encode(ITEM))
+
+    def test_decode_matches_boto3(self):
+        assert dynamodb.decode_item(boto3_encode(ITEM)) == boto3_decode(
+            boto3_encode(ITEM)
+        )
+
+    def test_round_trip(self):
+        assert dynamodb.decode_item(dynamodb.encode_item(ITEM)) == ITEM
+
+    def test_projection(self):
+        item = boto3_encode(ITEM)
+        assert dynamodb.decode_item(item, ["id", "line_items", "missing"]) == {
+            "id": "cs_1",
+            "line_items": ITEM["line_items"],
+        }
+
+
+class TestNumbers:
+    @pytest.mark.parametrize("value", ["0", "-7", "1700000000", "12345678901234567890"])
+    def test_integers_decode_to_int(self, value):
+        decoded = dynamodb.decode_value({"N": value})
+        assert type(decoded) is int
+        assert decoded == type_deserializer.deserialize({"N": value})
+
+    @pytest.mark.parametrize("value", ["0.1", "-12.5", "1E+3", "1e3", "2.5e-3", "1.0"])
+    def test_fractions_and_exponents_decode_to_float(self, value):
+        decoded = dynamodb.decode_value({"N": value})
+        assert type(decoded) is float
+        assert Decimal(repr(decoded)) == type_deserializer.deserialize({"N": value})
+
+    def test_large_fractions_lose_precision(self):
+        decoded = dynamodb.decode_value({"N": "12345678901234567.5"})
+        assert decoded == 12345678901234568.0
+
+    @pytest.mark.parametrize("value", [0.1, -12.5, 1e20, 2.5e-3])
+    def test_floats_round_trip(self, value):
+        assert dynamodb.decode_value(dynamodb.encode_value(value)) == value
+
+    @pytest.mark.parametrize(
+        "value",
+        [math.inf, -math.inf, math.nan, Decimal("Infinity"), Decimal("NaN")],
+    )
+    def test_non_finite_numbers_raise(self, value):
+        with pytest.raises(TypeError):
+            dynamodb.encode_value(value)
+
+    def test_bool_is_not_a_number(self):
+        assert dynamodb.encode_value(True) == {"BOOL": True}
+        assert dynamodb.encode_value(0) == {"N": "0"}
+        assert dynamodb.decode_value({"BOOL": False}) is False
+        assert dynamodb.encode_value([True, 1]) == type_serializer.serialize([True, 1])
+
+    def test_bool_set_raises(self):
+        with pytest.raises(TypeError):
+            dynamodb.encode_value({True, 2})
+
+
+class TestTypes:
+    @pytest.mark.parametrize("value", [set(), frozenset()])
+    def test_empty_set_raises(self, value):
+        # boto3 encodes an empty set as an empty NS that dynamodb rejects with a
+        # ValidationException, it is refused before the request instead
+        with pytest.raises(TypeError):
+            dynamodb.encode_value(value)
+        with pytest.raises(TypeError):
+            dynamodb.encode_item({"id": "cs_1", "tags": value})
+
+    def test_null(self):
+        assert dynamodb.encode_value(None) == {"NULL": True}
+        assert dynamodb.decode_value({"NULL": True}) is None
+
+    def test_mapping_subclass_encodes_as_map(self):
+        class StripeLike(dict):
+            pass
+
+        value = StripeLike(id="prod_1", nested=StripeLike(a=1))
+        assert dynamodb.encode_value(value) == {
+            "M": {"id": {"S": "prod_1"}, "nested": {"M": {"a": {"N": "1"}}}}
+        }
+
+    def test_unknown_attribute_value_raises(self):
+        with pytest.raises(TypeError):
+            dynamodb.decode_value({"X": "1"})
+
+    def test_unsupported_type_raises(self):
+        with pytest.raises(TypeError):
+            dynamodb.encode_value(object())
+
+
+def test_sync_stripe_copy_is_identical():
+    backend = pathlib.Path(__file__).resolve().parents[3]
+    api_codec = backend / "api-lib" / "src" / "api_lib" / "dynamodb.py"
+    sync_codec = (
+        backend / "lambdas" / "sync-stripe" / "src" / "sync_stripe" / "dynamodb.py"
+    )
+    assert api_codec.read_text() == sync_codec.read_text()
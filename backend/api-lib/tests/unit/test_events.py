@@ -0,0 +1,108 @@
+from api_lib.stripe import events
+
+
+def queued(message_id, event_type, object_id, created, object_name=None):
+    return events.QueuedEvent(
+        message_id=message_id,
+        event={
+            "id": f"evt_{message_id}",
+            "type": event_type,
+            "created": created,
+            "data": {
+                "object": {
+                    "id": object_id,
+                    "object": object_name or event_type.rsplit(".", 1)[0],
+                }
+            },
+        },
+        enqueued_at=0.0,
+    )
+
+
+class TestCoalesceEvents:
+    def test_newest_catalog_event_supersedes_older(self):
+        groups = events.coalesce_events(
+            [
+                queued("1", "product.created", "prod_1", 1),
+                queued("2", "product.updated", "prod_1", 3),
+                queued("3", "product.updated", "prod_1", 2),
+            ]
+        )
+        assert [(m.message_id, ids) for m, ids in groups] == [("2", ["1", "2", "3"])]
+
+    def test_objects_are_not_merged(self):
+        groups = events.coalesce_events(
+            [
+                queued("1", "product.updated", "prod_1", 1),
+                queued("2", "product.updated", "prod_2", 1),
+                queued("3", "price.updated", "prod_1", 1),
+            ]
+        )
+        assert [m.message_id for m, _ in groups] == ["1", "2", "3"]
+
+    def test_unhandled_event_does_not_swallow_completed_session(self):
+        groups = events.coalesce_events(
+            [
+                queued(
+                    "1",
+                    "checkout.session.completed",
+                    "cs_1",
+                    1,
+                    object_name="checkout.session",
+                ),
+                queued(
+                    "2",
+                    "checkout.session.async_payment_succeeded",
+                    "cs_1",
+                    2,
+                    object_name="checkout.session",
+                ),
+            ]
+        )
+        assert [(m.event["type"], ids) for m, ids in groups] == [
+            ("checkout.session.completed", ["1"])
+        ]
+
+
+class TestProcessQueuedEvents:
+    def test_completed_session_is_handled_and_unhandled_events_acked(self, monkeypatch):
+        handled = []
+        monkeypatch.setattr(events, "handle_event", lambda e: handled.append(e["id"]))
+
+        failed = events.process_queued_events(
+            [
+                queued(
+                    "1",
+                    "checkout.session.completed",
+                    "cs_1",
+                    1,
+                    object_name="checkout.session",
+                ),
+                queued(
+                    "2",
+                    "checkout.session.async_payment_succeeded",
+                    "cs_1",
+                    2,
+                    object_name="checkout.session",
+                ),
+            ]
+        )
+
+        assert handled == ["evt_1"]
+        assert failed == []
+
+    def test_failed_event_fails_every_message_it_stands_for(self, monkeypatch):
+        def fail(event):
+            raise RuntimeError("boom")
+
+        monkeypatch.setattr(events, "handle_event", fail)
+
+        failed = events.process_queued_events(
+            [
+                queued("1", "price.created", "price_1", 1),
+                queued("2", "price.updated", "price_1", 2),
+                queued("3", "invoice.paid", "in_1", 3),
+            ]
+        )
+
+        assert failed == ["1", "2"]
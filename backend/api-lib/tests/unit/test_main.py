@@ -0,0 +1,43 @@
+from fastapi.testclient import TestClient
+
+from api_lib import utils
+from api_lib.main import app
+from api_lib.stripe import events
+
+
+class TestMetrics:
+    def get(self, token=None):
+        # the bearer token travels in the authorization cookie
+        cookies = {"Authorization": f"Bearer {token}"} if token else None
+        return TestClient(app, cookies=cookies).get("/metrics")
+
+    def test_requires_a_token(self, monkeypatch):
+        def get_event_queue():
+            raise AssertionError("the queue was read")
+
+        monkeypatch.setattr(events, "get_event_queue", get_event_queue)
+
+        assert self.get().status_code == 401
+
+    def test_invalid_token_is_rejected(self, monkeypatch):
+        async def verify_jwt_async(token):
+            return False
+
+        monkeypatch.setattr(utils, "verify_jwt_async", verify_jwt_async)
+
+        assert self.get("invalid").status_code == 401
+
+    def test_valid_token(self, monkeypatch):
+        async def verify_jwt_async(token):
+            return {"sub": "user"}
+
+        class Queue:
+            def depth(self):
+                return 3
+
+        monkeypatch.setattr(utils, "verify_jwt_async", verify_jwt_async)
+        monkeypatch.setattr(events, "get_event_queue", Queue)
+
+        response = self.get("ok")
+        assert response.status_code == 200
+        assert response.json()["webhook_queue"]["depth"] == 3
@@ -0,0 +1,117 @@
+import boto3
+import pytest
+from moto import mock_aws
+
+from api_lib import dynamodb, utils as general_utils
+from api_lib.stripe import tables
+from api_lib.stripe import utils as stripe_utils
+
+
+def event(event_type, created, **fields):
+    return {
+        "id": f"evt_{created}",
+        "type": event_type,
+        "created": created,
+        "data": {"object": {"id": "prod_1", "object": "product", **fields}},
+    }
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        client = boto3.client("dynamodb")
+        for table in [tables.PRODUCT_TABLE_NAME, tables.STATE_TABLE_NAME]:
+            client.create_table(
+                TableName=table,
+                KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+                AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}],
+                BillingMode="PAY_PER_REQUEST",
+            )
+        monkeypatch.setattr(general_utils, "get_client", lambda service_name: client)
+        yield client
+
+
+def apply(event_data, operation):
+    return stripe_utils.process_stripe_crud_event(
+        event_data=event_data, table=tables.PRODUCT_TABLE_NAME, operation=operation
+    )
+
+
+def get_product(client):
+    item = client.get_item(
+        TableName=tables.PRODUCT_TABLE_NAME, Key={"id": {"S": "prod_1"}}
+    ).get("Item")
+    return item and dynamodb.decode_item(item)
+
+
+class TestProcessStripeCrudEvent:
+    def test_older_update_is_rejected(self, client):
+        apply(event("product.created", 100, name="a"), "created")
+        apply(event("product.updated", 300, name="c"), "updated")
+        with pytest.raises(stripe_utils.StaleEventError):
+            apply(event("product.updated", 200, name="b"), "updated")
+        assert get_product(client)["name"] == "c"
+
+    @pytest.mark.parametrize(
+        "event_type,operation",
+        [("product.updated", "updated"), ("product.created", "created")],
+    )
+    def test_delete_followed_by_older_event(self, client, event_type, operation):
+        apply(event("product.created", 100, name="a"), "created")
+        apply(event("product.deleted", 200), "deleted")
+
+        with pytest.raises(stripe_utils.StaleEventError):
+            apply(event(event_type, 150, name="b"), operation)
+        # a tie goes to the delete
+        with pytest.raises(stripe_utils.StaleEventError):
+            apply(event(event_type, 200, name="b"), operation)
+        assert get_product(client) is None
+
+    def test_newer_event_after_delete_is_applied(self, client):
+        apply(event("product.created", 100, name="a"), "created")
+        apply(event("product.deleted", 200), "deleted")
+        apply(event("product.updated", 300, name="c"), "updated")
+        assert get_product(client)["name"] == "c"
+
+    def test_older_delete_keeps_the_newer_tombstone(self, client):
+        apply(event("product.deleted", 200), "deleted")
+        with pytest.raises(stripe_utils.StaleEventError):
+            apply(event("product.deleted", 100), "deleted")
+        with pytest.raises(stripe_utils.StaleEventError):
+            apply(event("product.updated", 150, name="b"), "updated")
+        assert get_product(client) is None
+
+    def test_update_clears_the_sync_fingerprint(self, client):
+        # the sync stored s1, a webhook applies s2 and stripe reverts to s1, the
+        # next sync must not skip the write on a fingerprint of s1
+        s1 = {"id": "prod_1", "object": "product", "name": "a"}
+        client.put_item(
+            TableName=tables.PRODUCT_TABLE_NAME,
+            Item={
+                **dynamodb.encode_item(s1),
+                stripe_utils.FINGERPRINT_ATTRIBUTE: {"S": "fingerprint of s1"},
+            },
+        )
+        apply(event("product.updated", 200, name="b"), "updated")
+
+        product = get_product(client)
+        assert product["name"] == "b"
+        assert stripe_utils.FINGERPRINT_ATTRIBUTE not in product
+
+    def test_tombstone_expires(self, client):
+        apply(event("product.deleted", 200), "deleted")
+        tombstone = client.get_item(
+            TableName=tables.STATE_TABLE_NAME,
+            Key={
+                "id": {
+                    "S": stripe_utils.deleted_object_id(
+                        tables.PRODUCT_TABLE_NAME, "prod_1"
+                    )
+                }
+            },
+        )["Item"]
+        assert tombstone["created"] == {"N": "200"}
+        assert "expires_at" in tombstone
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from api_lib import utils
+
+JWKS = {"keys": [{"kid": "k1", "kty": "oct", "k": "c2VjcmV0", "alg": "HS256"}]}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FlakyJWKS:
+    def __init__(self):
+        self.calls = 0
+        self.failing = False
+
+    def __call__(self):
+        self.calls += 1
+        if self.failing:
+            raise ConnectionError("cognito unreachable")
+        return JWKS
+
+    async def fetch_async(self):
+        return self()
+
+
+class TestJWKSKeyStore:
+    @pytest.fixture
+    def clock(self, monkeypatch):
+        clock = Clock()
+        monkeypatch.setattr(utils.time, "monotonic", clock)
+        return clock
+
+    @pytest.fixture
+    def fetch(self):
+        return FlakyJWKS()
+
+    @pytest.fixture
+    def store(self, fetch):
+        return utils.JWKSKeyStore(
+            fetch_jwks=fetch,
+            fetch_jwks_async=fetch.fetch_async,
+            ttl=60,
+            unknown_kid_refresh_interval=10,
+            refresh_failure_backoff=30,
+        )
+
+    def test_failed_refresh_serves_stale_keys_until_the_backoff_passes(
+        self, clock, fetch, store
+    ):
+        assert store.get_key("k1") is not None
+        fetch.failing = True
+
+        clock.now += 61
+        assert store.get_key("k1") is not None
+        assert fetch.calls == 2
+
+        # expired, but no fetch while backing off
+        for _ in range(5):
+            clock.now += 5
+            assert store.get_key("k1") is not None
+            assert store.get_key("unknown") is None
+        assert fetch.calls == 2
+
+        clock.now += 6
+        assert store.get_key("k1") is not None
+        assert fetch.calls == 3
+
+        fetch.failing = False
+        clock.now += 31
+        assert store.get_key("k1") is not None
+        assert fetch.calls == 4
+        assert store.stats()["refresh_failures"] == 2
+
+    def test_async_failed_refresh_backs_off(self, clock, fetch, store):
+        assert asyncio.run(store.get_key_async("k1")) is not None
+        fetch.failing = True
+
+        clock.now += 61
+        for _ in range(3):
+            assert asyncio.run(store.get_key_async("k1")) is not None
+        assert fetch.calls == 2
+
+    def test_first_fetch_failure_raises_every_time(self, clock, fetch, store):
+        fetch.failing = True
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                store.get_key("k1")
+        assert fetch.calls == 2
@@ -3,12 +3,27 @@ from typing import List, Literal
 
 from aws_cdk import Stack, RemovalPolicy
 from aws_cdk import aws_cognito as cognito
+from aws_cdk import aws_lambda as L
 from aws_cdk import aws_ssm as ssm
 
 from constructs import Construct
 
 from infrastructure import utils
 
+# copies the stripe customer id attribute into the access token so the api can
+# resolve the customer without a get_user round trip
+PRE_TOKEN_GENERATION_HANDLER = """
+def handler(event, context):
+    customer_id = event["request"]["userAttributes"].get("custom:stripe_customer_id")
+    if customer_id:
+        event["response"]["claimsAndScopeOverrideDetails"] = {
+            "accessTokenGeneration": {
+                "claimsToAddOrOverride": {"stripe_customer_id": customer_id}
+            }
+        }
+    return event
+"""
+
 
 class InfrastructureStack(Stack):
     def __init__(
@@ -17,13 +32,19 @@ class InfrastructureStack(Stack):
         construct_id: str,
         identity_providers: List[Literal["facebook"]] = ["facebook"],
         api_url: str = None,
+        access_token_claims: bool = utils.COGNITO_ACCESS_TOKEN_CLAIMS,
         **kwargs,
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         # ------------------------- Initialize the User pool ------------------------- #
 
-        user_pool = self.create_user_pool()
+        user_pool = self.create_user_pool(access_token_claims)
+
+        # ---------------- add the stripe customer id to access tokens --------------- #
+
+        if access_token_claims:
+            self.add_pre_token_generation_trigger(user_pool)
 
         # ------------------------- create identity providers ------------------------ #
 
@@ -148,13 +169,32 @@ class InfrastructureStack(Stack):
             scopes=["email", "public_profile"],
         )
 
-    def create_user_pool(self: Stack) -> cognito.UserPool:
+    def add_pre_token_generation_trigger(self, user_pool: cognito.UserPool) -> None:
+        pre_token_generation = L.Function(
+            self,
+            "pre_token_generation",
+            runtime=L.Runtime.PYTHON_3_10,
+            handler="index.handler",
+            code=L.Code.from_inline(PRE_TOKEN_GENERATION_HANDLER),
+        )
+
+        user_pool.add_trigger(
+            cognito.UserPoolOperation.PRE_TOKEN_GENERATION_CONFIG,
+            pre_token_generation,
+            cognito.LambdaVersion.V2_0,
+        )
+
+    def create_user_pool(
+        self: Stack, access_token_claims: bool = False
+    ) -> cognito.UserPool:
         return cognito.UserPool(
             self,
             "user_pool",
             user_pool_name=f"{utils.COMPANY}-{utils.DEVELOPMENT_ENVIRONMENT}-user-pool",
             account_recovery=cognito.AccountRecovery.PHONE_WITHOUT_MFA_AND_EMAIL,
-            advanced_security_mode=None,
+            advanced_security_mode=(
+                cognito.AdvancedSecurityMode.AUDIT if access_token_claims else None
+            ),
             auto_verify=cognito.AutoVerifiedAttrs(email=True, phone=False),
             custom_attributes={
                 "stripe_customer_id": cognito.StringAttribute(mutable=True),
@@ -10,6 +10,8 @@ from aws_cdk import (
 from aws_cdk import aws_dynamodb as dynamodb
 from aws_cdk import aws_iam as iam
 from aws_cdk import aws_lambda as L
+from aws_cdk import aws_lambda_event_sources as lambda_event_sources
+from aws_cdk import aws_sqs as sqs
 from aws_cdk import aws_ssm as ssm
 from constructs import Construct
 
@@ -60,6 +62,44 @@ class InfrastructureStack(Stack):
             **shared_lambda_kwargs,
         )
 
+        # create the webhook worker, it shares the api code and applies the queued
+        # stripe events in batches
+        webhook_worker = L.Function(
+            self,
+            f"{company_and_environment}_webhook_worker",
+            timeout=Duration.seconds(60),
+            code=L.Code.from_asset("../api-lib/dist/lambda.zip"),
+            **shared_lambda_kwargs,
+        )
+
+        # durable queue between the webhook endpoint and the worker, failing
+        # events are retried a few times before landing in the dead letter queue
+        webhook_dead_letter_queue = sqs.Queue(
+            self,
+            f"{company_and_environment}-webhook-events-dlq",
+            retention_period=Duration.days(14),
+        )
+        webhook_queue = sqs.Queue(
+            self,
+            f"{company_and_environment}-webhook-events",
+            visibility_timeout=Duration.seconds(6 * 60),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=5, queue=webhook_dead_letter_queue
+            ),
+        )
+        webhook_queue.grant_send_messages(api)
+        webhook_queue.grant(api, "sqs:GetQueueAttributes")
+        webhook_worker.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                webhook_queue,
+                batch_size=100,
+                max_batching_window=Duration.seconds(5),
+                report_batch_item_failures=True,
+            )
+        )
+        for lambda_object in (api, webhook_worker):
+            lambda_object.add_environment("WEBHOOK_QUEUE_URL", webhook_queue.queue_url)
+
         # create the sync-stripe lambda function
         sync_stripe = L.Function(
             self,
@@ -74,6 +114,7 @@ class InfrastructureStack(Stack):
             "price",
             "customer",
             "checkout-session-completed",
+            "product-popularity",
         ):
             if table_name == "checkout-session-completed":
                 sort_key = dynamodb.Attribute(
@@ -87,24 +128,61 @@ class InfrastructureStack(Stack):
                 self, f"{company_and_environment}-{table_name}", sort_key=sort_key
             )
 
+            if table_name == "checkout-session-completed":
+                # sparse index serving a single customer's history newest first,
+                # guest checkouts never set history_customer so they are left out
+                table.add_global_secondary_index(
+                    index_name="customer-created",
+                    partition_key=dynamodb.Attribute(
+                        name="history_customer", type=dynamodb.AttributeType.STRING
+                    ),
+                    sort_key=dynamodb.Attribute(
+                        name="created", type=dynamodb.AttributeType.NUMBER
+                    ),
+                    projection_type=dynamodb.ProjectionType.INCLUDE,
+                    non_key_attributes=["line_items"],
+                )
+
             table.grant_read_write_data(api)
+            table.grant_read_write_data(webhook_worker)
             table.grant_read_write_data(sync_stripe)
 
-            api.add_to_role_policy(
-                iam.PolicyStatement(
-                    actions=[
-                        "dynamodb:PartiQLSelect",
-                        "dynamodb:PartiQLInsert",
-                        "dynamodb:PartiQLUpdate",
-                        "dynamodb:PartiQLDelete",
-                    ],
-                    resources=[table.table_arn],
+            for lambda_object in (api, webhook_worker):
+                lambda_object.add_to_role_policy(
+                    iam.PolicyStatement(
+                        actions=[
+                            "dynamodb:PartiQLSelect",
+                            "dynamodb:PartiQLInsert",
+                            "dynamodb:PartiQLUpdate",
+                            "dynamodb:PartiQLDelete",
+                        ],
+                        resources=[table.table_arn],
+                    )
                 )
-            )
+
+        # small key value table holding the catalog version and other state items
+        state_table = dynamodb.TableV2(
+            self,
+            f"{company_and_environment}-state",
+            table_name=f"{company_and_environment}-state",
+            partition_key=dynamodb.Attribute(
+                name="id", type=dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute="expires_at",
+            removal_policy=(
+                RemovalPolicy.DESTROY
+                if "dev" in utils.DEVELOPMENT_ENVIRONMENT
+                else None
+            ),
+        )
+
+        state_table.grant_read_write_data(api)
+        state_table.grant_read_write_data(webhook_worker)
+        state_table.grant_read_write_data(sync_stripe)
 
         # allow the lambda to access the various ssm parameters
         get_parameter_policy_statement = iam.PolicyStatement(
-            actions=["ssm:GetParameter"],
+            actions=["ssm:GetParameter", "ssm:GetParameters"],
             effect=iam.Effect.ALLOW,
             resources=[
                 f"arn:aws:ssm:{self.region}:{self.account}:parameter/{utils.COMPANY}/{utils.DEVELOPMENT_ENVIRONMENT}/*",
@@ -119,7 +197,7 @@ class InfrastructureStack(Stack):
         )
 
         # apply policies to lambda functions
-        for lambda_object in (api, sync_stripe):
+        for lambda_object in (api, webhook_worker, sync_stripe):
             lambda_object.add_to_role_policy(get_parameter_policy_statement)
             lambda_object.add_to_role_policy(http_policy_statement)
 
@@ -135,7 +213,8 @@ class InfrastructureStack(Stack):
                     L.HttpMethod.POST,
                     L.HttpMethod.DELETE,
                 ],
-                allowed_headers=["Authorization", "Content-Type"],
+                allowed_headers=["Authorization", "Content-Type", "If-None-Match"],
+                exposed_headers=["X-Next-Cursor", "ETag"],
                 allow_credentials=True,
             ),
         )
@@ -4,6 +4,11 @@ import pathlib as pt
 COMPANY = os.environ.get("COMPANY", "my-test-company-name")
 DEVELOPMENT_ENVIRONMENT = os.environ.get("DEVELOPMENT_ENVIRONMENT", "dev")
 
+# adding claims to access tokens requires the cognito advanced security features
+COGNITO_ACCESS_TOKEN_CLAIMS = (
+    os.environ.get("COGNITO_ACCESS_TOKEN_CLAIMS", "false").lower() == "true"
+)
+
 
 def get_root_folder():
     return pt.Path(__file__).parents[1]
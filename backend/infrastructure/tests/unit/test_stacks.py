@@ -23,3 +23,23 @@ class TestCognito:
 
     def test_all_smm_parameters_exist(self):
         self.template.resource_count_is("AWS::SSM::Parameter", 5)
+
+
+class TestCognitoAccessTokenClaims:
+    app = core.App()
+    stack = cognito.InfrastructureStack(
+        app, "CognitoAccessTokenClaimsStack", access_token_claims=True
+    )
+    template = assertions.Template.from_stack(stack)
+
+    def test_pre_token_generation_function_exists(self):
+        self.template.resource_count_is("AWS::Lambda::Function", 1)
+
+    def test_pre_token_generation_trigger(self):
+        self.template.has_resource_properties(
+            "AWS::Cognito::UserPool",
+            {
+                "LambdaConfig": {"PreTokenGenerationConfig": {"LambdaVersion": "V2_0"}},
+                "UserPoolAddOns": {"AdvancedSecurityMode": "AUDIT"},
+            },
+        )
@@ -1,15 +1,55 @@
-from sync_stripe import utils
+import argparse
+
+from sync_stripe import popularity, utils
 
 
 def handler(event, context):
-    main()
+    event = event or {}
+    main(
+        full=bool(event.get("full", False)),
+        rebuild_popularity=bool(event.get("rebuild_popularity", False)),
+        backfill_history=bool(event.get("backfill_history", False)),
+    )
     return {"message": "completed successfully"}
 
 
-def main():
-    utils.sync_completed_checkout_sessions()
-    utils.sync_product_price_customer_table()
+def main(
+    full: bool = False,
+    rebuild_popularity: bool = False,
+    backfill_history: bool = False,
+):
+    utils.sync_completed_checkout_sessions(full=full)
+    utils.sync_product_price_customer_table(full=full)
+    if rebuild_popularity:
+        popularity.rebuild_product_popularity()
+    if backfill_history:
+        utils.backfill_purchase_history_index()
 
 
 if __name__ == "__main__":
-    handler((), {})
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="ignore the sync checkpoints and re-read everything from stripe",
+    )
+    parser.add_argument(
+        "--rebuild-popularity",
+        action="store_true",
+        help="recompute the product popularity counters from the checkout sessions",
+    )
+    parser.add_argument(
+        "--backfill-history",
+        action="store_true",
+        help="index checkout sessions written before the purchase history index",
+    )
+    args = parser.parse_args()
+
+    handler(
+        {
+            "full": args.full,
+            "rebuild_popularity": args.rebuild_popularity,
+            "backfill_history": args.backfill_history,
+        },
+        {},
+    )
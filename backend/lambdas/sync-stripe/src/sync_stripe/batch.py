@@ -0,0 +1,134 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List
+
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb import DynamoDBClient
+
+# BatchWriteItem accepts at most 25 requests per call
+BATCH_WRITE_SIZE = 25
+
+BATCH_WRITE_CONCURRENCY = int(os.environ.get("BATCH_WRITE_CONCURRENCY", 8))
+BATCH_WRITE_MAX_ATTEMPTS = int(os.environ.get("BATCH_WRITE_MAX_ATTEMPTS", 10))
+BATCH_WRITE_BASE_DELAY = float(os.environ.get("BATCH_WRITE_BASE_DELAY", 0.05))
+BATCH_WRITE_MAX_DELAY = float(os.environ.get("BATCH_WRITE_MAX_DELAY", 5))
+
+
+class BatchWriter:
+    # groups puts and deletes into BatchWriteItem calls sent from a worker pool,
+    # unprocessed items are retried with full jitter backoff. at most twice the
+    # pool size of batches are in flight so memory stays bounded.
+
+    def __init__(
+        self, client: "DynamoDBClient", concurrency: int = BATCH_WRITE_CONCURRENCY
+    ):
+        self._client = client
+        self._concurrency = concurrency
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="sync-stripe-batch"
+        )
+        self._pending: Dict[str, Dict[Any, Dict[str, Any]]] = {}
+        self._futures: List[Future] = []
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._written = 0
+        self._batches = 0
+        self._retries = 0
+
+    def __enter__(self) -> "BatchWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if exc_info[0] is None:
+                self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def put(
+        self,
+        table_name: str,
+        item: Dict[str, Any],
+        key_names: Iterable[str] = ("id",),
+    ):
+        key = tuple(str(item[k]) for k in sorted(key_names))
+        self._add(table_name, key, {"PutRequest": {"Item": item}})
+
+    def delete(self, table_name: str, key: Dict[str, Any]):
+        self._add(
+            table_name,
+            tuple(str(key[k]) for k in sorted(key)),
+            {"DeleteRequest": {"Key": key}},
+        )
+
+    def _add(self, table_name: str, key: Any, request: Dict[str, Any]):
+        # a batch may not hold two requests for the same key, the latest wins
+        pending = self._pending.setdefault(table_name, {})
+        pending.pop(key, None)
+        pending[key] = request
+        if len(pending) >= BATCH_WRITE_SIZE:
+            self._send(table_name)
+
+    def _send(self, table_name: str):
+        requests = list(self._pending.pop(table_name, {}).values())
+        if requests:
+            self._track(self._executor.submit(self._write, table_name, requests))
+
+    def _track(self, future: Future):
+        self._futures.append(future)
+        if len(self._futures) >= 2 * self._concurrency:
+            self._futures.pop(0).result()
+
+    def _write(self, table_name: str, requests: List[Dict[str, Any]]):
+        for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+            response = self._client.batch_write_item(
+                RequestItems={table_name: requests}
+            )
+            unprocessed = response.get("UnprocessedItems", {}).get(table_name, [])
+            with self._lock:
+                self._batches += 1
+                self._written += len(requests) - len(unprocessed)
+            if not unprocessed:
+                return
+            with self._lock:
+                self._retries += 1
+            requests = unprocessed
+            time.sleep(
+                random.uniform(
+                    0, min(BATCH_WRITE_MAX_DELAY, BATCH_WRITE_BASE_DELAY * 2**attempt)
+                )
+            )
+        raise RuntimeError(
+            f"{len(requests)} items for {table_name} were still unprocessed "
+            f"after {BATCH_WRITE_MAX_ATTEMPTS} attempts"
+        )
+
+    def flush(self):
+        for table_name in list(self._pending):
+            self._send(table_name)
+        while self._futures:
+            self._futures.pop(0).result()
+
+    def stats(self) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self._started
+        with self._lock:
+            return {
+                "written": self._written,
+                "batches": self._batches,
+                "retries": self._retries,
+                "seconds": round(elapsed, 3),
+                "items_per_second": (
+                    round(self._written / elapsed, 1) if elapsed > 0 else 0.0
+                ),
+            }
+
+    def report(self, name: str):
+        stats = self.stats()
+        print(
+            f"INFO: wrote {stats['written']} {name} items in {stats['batches']} "
+            f"batches with {stats['retries']} retries in {stats['seconds']}s "
+            f"({stats['items_per_second']} items/s)"
+        )
@@ -0,0 +1,141 @@
+from typing import TYPE_CHECKING, Any, Dict, Iterator
+
+from sync_stripe import batch, dynamodb, utils
+
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb import DynamoDBClient
+
+# prefix of the state items marking a checkout session as counted, shared with
+# the api webhook so replays from either side are only counted once
+POPULARITY_MARKER_PREFIX = "popularity#"
+
+# TransactWriteItems accepts at most 100 actions, one is the marker
+MAX_PRODUCTS_PER_TRANSACTION = 99
+
+
+def count_checkout_session_quantities(
+    checkout_session: Dict[str, Any],
+) -> Dict[str, int]:
+    quantities: Dict[str, int] = {}
+    for line_item in checkout_session.get("line_items") or []:
+        product_id = line_item["price"]["product"]
+        quantities[product_id] = quantities.get(product_id, 0) + int(
+            line_item["quantity"]
+        )
+    return quantities
+
+
+def marker_ids(checkout_session_id: str, product_count: int) -> Iterator[str]:
+    chunks = -(-max(product_count, 1) // MAX_PRODUCTS_PER_TRANSACTION)
+    for chunk in range(chunks):
+        yield f"{POPULARITY_MARKER_PREFIX}{checkout_session_id}#{chunk}"
+
+
+def is_checkout_session_complete(checkout_session: Dict[str, Any]) -> bool:
+    # open and expired sessions are carts that were never bought
+    return checkout_session.get("status") == "complete"
+
+
+def record_checkout_session_popularity(
+    client: "DynamoDBClient", checkout_session: Dict[str, Any]
+) -> bool:
+    if not is_checkout_session_complete(checkout_session):
+        return False
+
+    # the counters and the marker are written in one transaction so a replayed
+    # session fails the marker condition instead of being counted twice
+    quantities = list(count_checkout_session_quantities(checkout_session).items())
+
+    recorded = False
+
+    for marker, start in zip(
+        marker_ids(checkout_session["id"], len(quantities)),
+        range(0, len(quantities), MAX_PRODUCTS_PER_TRANSACTION),
+    ):
+        try:
+            client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Put": {
+                            "TableName": utils.DynamoDBTables.STATE.value,
+                            "Item": {"id": {"S": marker}},
+                            "ConditionExpression": "attribute_not_exists(id)",
+                        }
+                    }
+                ]
+                + [
+                    {
+                        "Update": {
+                            "TableName": utils.DynamoDBTables.PRODUCT_POPULARITY.value,
+                            "Key": {"id": {"S": product_id}},
+                            "UpdateExpression": "ADD quantity :quantity",
+                            "ExpressionAttributeValues": {
+                                ":quantity": {"N": str(quantity)}
+                            },
+                        }
+                    }
+                    for product_id, quantity in quantities[
+                        start : start + MAX_PRODUCTS_PER_TRANSACTION
+                    ]
+                ]
+            )
+            recorded = True
+        except client.exceptions.TransactionCanceledException as e:
+            reasons = e.response.get("CancellationReasons", [])
+            if not reasons or reasons[0].get("Code") != "ConditionalCheckFailed":
+                raise
+
+    return recorded
+
+
+def rebuild_product_popularity():
+    # recompute the counters from the raw checkout sessions, webhooks arriving
+    # while the rebuild runs may need a second rebuild to be reflected
+    client = utils.get_client("dynamodb")
+
+    counters: Dict[str, int] = {}
+    markers = []
+
+    for page in client.get_paginator("scan").paginate(
+        TableName=utils.DynamoDBTables.CHECKOUT_SESSION_COMPLETED.value,
+        ProjectionExpression="id, line_items, #status",
+        ExpressionAttributeNames={"#status": "status"},
+    ):
+        for item in page["Items"]:
+            checkout_session = dynamodb.decode_item(item)
+            if not is_checkout_session_complete(checkout_session):
+                continue
+            quantities = count_checkout_session_quantities(checkout_session)
+            for product_id, quantity in quantities.items():
+                counters[product_id] = counters.get(product_id, 0) + quantity
+            markers.extend(marker_ids(checkout_session["id"], len(quantities)))
+
+    stale = [
+        item["id"]["S"]
+        for page in client.get_paginator("scan").paginate(
+            TableName=utils.DynamoDBTables.PRODUCT_POPULARITY.value,
+            ProjectionExpression="id",
+        )
+        for item in page["Items"]
+        if item["id"]["S"] not in counters
+    ]
+
+    with batch.BatchWriter(client) as writer:
+        for product_id, quantity in counters.items():
+            writer.put(
+                utils.DynamoDBTables.PRODUCT_POPULARITY.value,
+                {"id": {"S": product_id}, "quantity": {"N": str(quantity)}},
+            )
+        for product_id in stale:
+            writer.delete(
+                utils.DynamoDBTables.PRODUCT_POPULARITY.value,
+                {"id": {"S": product_id}},
+            )
+        for marker in markers:
+            writer.put(utils.DynamoDBTables.STATE.value, {"id": {"S": marker}})
+    writer.report("popularity")
+
+    print(
+        f"INFO: rebuilt popularity for {len(counters)} products "
+        f"from {len(markers)} checkout session markers"
+    )
@@ -1,16 +1,34 @@
 import enum
+import hashlib
+import itertools
+import json
 import os
+import random
+import threading
 import time
-from typing import Literal, overload
+import types
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    overload,
+)
 
 import boto3
-import boto3.dynamodb.types
-import stripe
-from mypy_boto3_dynamodb import DynamoDBClient
-from mypy_boto3_ssm import SSMClient
+import boto3.session
+import botocore.config
 
-type_deserializer = boto3.dynamodb.types.TypeDeserializer()
-type_serializer = boto3.dynamodb.types.TypeSerializer()
+from sync_stripe import batch, dynamodb, popularity
+
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb import DynamoDBClient
+    from mypy_boto3_ssm import SSMClient
 
 COMPANY = os.environ.get("COMPANY", "my-test-company-name")
 DEVELOPMENT_LOCATION = os.environ.get("DEVELOPMENT_LOCATION", "local")
@@ -53,96 +71,660 @@ class DynamoDBTables(enum.Enum):
     PRICE = f"{COMPANY_AND_ENVIRONMENT}-price"
     CUSTOMER = f"{COMPANY_AND_ENVIRONMENT}-customer"
     CHECKOUT_SESSION_COMPLETED = f"{COMPANY_AND_ENVIRONMENT}-checkout-session-completed"
+    STATE = f"{COMPANY_AND_ENVIRONMENT}-state"
+    PRODUCT_POPULARITY = f"{COMPANY_AND_ENVIRONMENT}-product-popularity"
+
+
+# attribute keying the sparse customer/created index used by the purchase history
+# endpoint, only set for checkouts that belong to a customer
+PURCHASE_HISTORY_CUSTOMER_ATTRIBUTE = "history_customer"
+
+# id of the state item stamped on every catalog write, read by the api catalog cache
+CATALOG_VERSION_ID = "catalog-version"
 
 
 # ---------------------------------------------------------------------------- #
 #                                client methods                                #
 # ---------------------------------------------------------------------------- #
 
+BOTO3_MAX_POOL_CONNECTIONS = int(os.environ.get("BOTO3_MAX_POOL_CONNECTIONS", 50))
+BOTO3_CONNECT_TIMEOUT = float(os.environ.get("BOTO3_CONNECT_TIMEOUT", 2))
+BOTO3_READ_TIMEOUT = float(os.environ.get("BOTO3_READ_TIMEOUT", 10))
+BOTO3_MAX_ATTEMPTS = int(os.environ.get("BOTO3_MAX_ATTEMPTS", 5))
+BOTO3_TCP_KEEPALIVE = os.environ.get("BOTO3_TCP_KEEPALIVE", "true").lower() == "true"
+
+client_config = botocore.config.Config(
+    max_pool_connections=BOTO3_MAX_POOL_CONNECTIONS,
+    connect_timeout=BOTO3_CONNECT_TIMEOUT,
+    read_timeout=BOTO3_READ_TIMEOUT,
+    retries={"mode": "adaptive", "max_attempts": BOTO3_MAX_ATTEMPTS},
+    tcp_keepalive=BOTO3_TCP_KEEPALIVE,
+)
+
+
+# one client per service per process, clients are thread safe once created so
+# they are shared across threads and reused by warm lambda invocations
+
+
+class ClientRegistry:
+    def __init__(self, config: botocore.config.Config = client_config):
+        self.config = config
+        self._session: Optional[boto3.session.Session] = None
+        self._clients: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self.created: Dict[str, int] = {}
+        self.reused: Dict[str, int] = {}
+
+    def get(self, service_name: str):
+        with self._lock:
+            client = self._clients.get(service_name)
+            if client is not None:
+                self.reused[service_name] = self.reused.get(service_name, 0) + 1
+                return client
+            # sessions are not thread safe, so creation happens under the lock
+            if self._session is None:
+                self._session = boto3.session.Session()
+            client = self._session.client(service_name, config=self.config)
+            self._clients[service_name] = client
+            self.created[service_name] = self.created.get(service_name, 0) + 1
+            return client
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+            self._session = None
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"created": dict(self.created), "reused": dict(self.reused)}
+
+
+client_registry = ClientRegistry()
+
 
 @overload
-def get_client(service_name: Literal["ssm"]) -> SSMClient: ...
+def get_client(service_name: Literal["ssm"]) -> "SSMClient": ...
 
 
 @overload
-def get_client(service_name: Literal["dynamodb"]) -> DynamoDBClient: ...
+def get_client(service_name: Literal["dynamodb"]) -> "DynamoDBClient": ...
 
 
 def get_client(service_name: Literal["ssm", "dynamodb"]):
-    return boto3.client(service_name)
+    return client_registry.get(service_name)
 
 
 # ---------------------------------------------------------------------------- #
 #                               parameter helpers                              #
 # ---------------------------------------------------------------------------- #
 
+SSM_PARAMETER_CACHE_TTL = float(os.environ.get("SSM_PARAMETER_CACHE_TTL", 300))
+
+# GetParameters accepts at most 10 names per call
+SSM_GET_PARAMETERS_BATCH_SIZE = 10
 
-def get_ssm_parameter_value(parameter_name: SSMParameterName, max_retries=5) -> str:
-    client = get_client("ssm")
-    retries = 0
-    while retries < max_retries:
-        retrieved = client.get_parameter(Name=parameter_name)
-        if "Parameter" in retrieved:
-            return retrieved["Parameter"]["Value"]
-        time.sleep(2**retries)
-        retries += 1
-    client.close()
-    return None
+
+class SSMParameterStore:
+    def __init__(
+        self,
+        parameter_names: Iterable[str],
+        ttl: float = SSM_PARAMETER_CACHE_TTL,
+    ):
+        self.parameter_names = list(dict.fromkeys(parameter_names))
+        self.ttl = ttl
+        self._values: Dict[str, Optional[str]] = {}
+        self._loaded_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.batch_calls = 0
+
+    def _fresh(self, parameter_name: str, now: float) -> bool:
+        loaded_at = self._loaded_at.get(parameter_name)
+        return loaded_at is not None and now - loaded_at < self.ttl
+
+    def _load(self, parameter_names: List[str], now: float):
+        client = get_client("ssm")
+        for i in range(0, len(parameter_names), SSM_GET_PARAMETERS_BATCH_SIZE):
+            names = parameter_names[i : i + SSM_GET_PARAMETERS_BATCH_SIZE]
+            retrieved = client.get_parameters(Names=names, WithDecryption=True)
+            self.batch_calls += 1
+            for parameter in retrieved["Parameters"]:
+                self._values[parameter["Name"]] = parameter["Value"]
+                self._loaded_at[parameter["Name"]] = now
+            for name in retrieved.get("InvalidParameters", []):
+                print(f"WARNING: ssm parameter {name} does not exist")
+                self._values.pop(name, None)
+                self._loaded_at.pop(name, None)
+
+    def get(self, parameter_name: str) -> Optional[str]:
+        parameter_name = str(parameter_name)
+        with self._lock:
+            now = time.monotonic()
+            if self._fresh(parameter_name, now):
+                self.hits += 1
+                return self._values[parameter_name]
+
+            self.misses += 1
+
+            # refresh every stale known parameter in the same round trip
+            stale = [n for n in self.parameter_names if not self._fresh(n, now)]
+            if parameter_name not in stale:
+                stale.append(parameter_name)
+            self._load(stale, now)
+
+            return self._values.get(parameter_name)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+            self._loaded_at = {}
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "parameters": len(self._values),
+            "hits": self.hits,
+            "misses": self.misses,
+            "batch_calls": self.batch_calls,
+        }
+
+
+ssm_parameter_store = SSMParameterStore(p.value for p in SSMParameterName)
+
+
+def get_ssm_parameter_value(parameter_name: SSMParameterName) -> str:
+    return ssm_parameter_store.get(parameter_name)
 
 
 # ---------------------------------------------------------------------------- #
 #                            set the stripe api key                            #
 # ---------------------------------------------------------------------------- #
 
-stripe.api_key = get_ssm_parameter_value(SSMParameterName.SSM_STRIPE_SECRET_KEY.value)
+# set on first use so the module imports without reaching ssm
+
+
+def get_stripe() -> types.ModuleType:
+    import stripe
+
+    if stripe.api_key is None:
+        stripe.api_key = get_ssm_parameter_value(
+            SSMParameterName.SSM_STRIPE_SECRET_KEY.value
+        )
+    return stripe
+
+
+# ---------------------------------------------------------------------------- #
+#                                catalog version                               #
+# ---------------------------------------------------------------------------- #
+
+
+def bump_catalog_version(client: "DynamoDBClient") -> int:
+    updated = client.update_item(
+        TableName=DynamoDBTables.STATE.value,
+        Key={"id": {"S": CATALOG_VERSION_ID}},
+        UpdateExpression="ADD #version :one SET updated_at = :now",
+        ExpressionAttributeNames={"#version": "version"},
+        ExpressionAttributeValues={
+            ":one": {"N": "1"},
+            ":now": {"N": str(int(time.time()))},
+        },
+        ReturnValues="UPDATED_NEW",
+    )
+    return int(updated["Attributes"]["version"]["N"])
+
+
+# ---------------------------------------------------------------------------- #
+#                               sync checkpoints                               #
+# ---------------------------------------------------------------------------- #
+
+SYNC_CHECKPOINT_PREFIX = "sync-checkpoint#"
+
+# stripe keeps events for 30 days, a catalog checkpoint not confirmed by a run in
+# that time falls back to a full sync
+STRIPE_EVENT_RETENTION = 29 * 24 * 60 * 60
+
+CATALOG_EVENT_TYPES = [
+    "product.created",
+    "product.updated",
+    "product.deleted",
+    "price.created",
+    "price.updated",
+    "price.deleted",
+    "customer.created",
+    "customer.updated",
+    "customer.deleted",
+]
+
+
+def get_sync_checkpoint(
+    client: "DynamoDBClient", resource: str
+) -> Optional[Dict[str, Any]]:
+    item = client.get_item(
+        TableName=DynamoDBTables.STATE.value,
+        Key={"id": {"S": f"{SYNC_CHECKPOINT_PREFIX}{resource}"}},
+        ConsistentRead=True,
+    ).get("Item")
+    if item is None:
+        return None
+    return dynamodb.decode_item(item)
+
+
+def put_sync_checkpoint(
+    client: "DynamoDBClient", resource: str, created: int, object_id: Optional[str]
+):
+    item = {
+        "id": {"S": f"{SYNC_CHECKPOINT_PREFIX}{resource}"},
+        "created": {"N": str(created)},
+        "updated_at": {"N": str(int(time.time()))},
+    }
+    if object_id is not None:
+        item["object_id"] = {"S": object_id}
+    client.put_item(TableName=DynamoDBTables.STATE.value, Item=item)
+
 
 # ---------------------------------------------------------------------------- #
 #                                 sync methods                                 #
 # ---------------------------------------------------------------------------- #
 
+STRIPE_LIST_PAGE_SIZE = 100
 
-def sync_product_price_customer_table():
-    client = get_client("dynamodb")
-    for name in ("product", "price", "customer"):
-        table_name = getattr(DynamoDBTables, name.upper()).value
-        objects = getattr(stripe, name.capitalize()).list(limit=100)["data"]
-        serialized_products = [p["M"] for p in type_serializer.serialize(objects)["L"]]
-        for product in serialized_products:
-            update_keys = [k for k in product.keys() if k != "id"]
-            client.update_item(
-                TableName=table_name,
-                Key={"id": product["id"]},
-                ExpressionAttributeNames={f"#{k}": k for k in update_keys},
-                ExpressionAttributeValues={f":{k}": product[k] for k in update_keys},
-                UpdateExpression=f"SET {', '.join([f'#{k}=:{k}' for k in update_keys])}",
+CATALOG_SYNC_OBJECTS = ("product", "price", "customer")
+
+# list responses and events leave out the tiers of a tiered price unless expanded,
+# the api prices carts with them
+CATALOG_SYNC_LIST_KWARGS = {"price": {"expand": ["data.tiers"]}}
+
+
+# attribute holding a hash of the mirrored stripe object, compared before writing
+# so unchanged objects cost a projected read instead of a full write
+FINGERPRINT_ATTRIBUTE = "_fingerprint"
+
+# created timestamp of the event behind a stored item, the api webhook only
+# overwrites an item with an event at least as new
+EVENT_CREATED_ATTRIBUTE = "_event_created"
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_SIZE = 100
+
+
+def serialize_stripe_object(stripe_object: Dict[str, Any]) -> Dict[str, Any]:
+    return dynamodb.encode_item(stripe_object)
+
+
+def fingerprint_stripe_object(stripe_object: Dict[str, Any]) -> str:
+    encoded = json.dumps(
+        stripe_object, sort_keys=True, separators=(",", ":"), default=str
+    ).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def get_stored_fingerprints(
+    client: "DynamoDBClient", table_name: str, object_ids: List[str]
+) -> Dict[str, Optional[str]]:
+    # ids missing from the result are not mirrored yet, items written before
+    # fingerprints existed map to None
+    fingerprints: Dict[str, Optional[str]] = {}
+    for start in range(0, len(object_ids), BATCH_GET_SIZE):
+        request = {
+            table_name: {
+                "Keys": [
+                    {"id": {"S": object_id}}
+                    for object_id in object_ids[start : start + BATCH_GET_SIZE]
+                ],
+                "ProjectionExpression": "id, #fingerprint",
+                "ExpressionAttributeNames": {"#fingerprint": FINGERPRINT_ATTRIBUTE},
+            }
+        }
+        attempt = 0
+        while request:
+            response = client.batch_get_item(RequestItems=request)
+            for item in response["Responses"].get(table_name, []):
+                fingerprints[item["id"]["S"]] = item.get(FINGERPRINT_ATTRIBUTE, {}).get(
+                    "S"
+                )
+            request = response.get("UnprocessedKeys")
+            if request:
+                time.sleep(random.uniform(0, min(5, 0.05 * 2**attempt)))
+                attempt += 1
+    return fingerprints
+
+
+def write_changed_objects(
+    client: "DynamoDBClient",
+    writer: batch.BatchWriter,
+    table_name: str,
+    stripe_objects: List[Tuple[Dict[str, Any], int]],
+    changes: Dict[str, int],
+):
+    # each object comes with the created timestamp of the newest event it reflects
+    stored = get_stored_fingerprints(
+        client, table_name, [o["id"] for o, _ in stripe_objects]
+    )
+    for stripe_object, event_created in stripe_objects:
+        fingerprint = fingerprint_stripe_object(stripe_object)
+        if stripe_object["id"] not in stored:
+            changes["new"] += 1
+        elif stored[stripe_object["id"]] == fingerprint:
+            changes["unchanged"] += 1
+            continue
+        else:
+            changes["changed"] += 1
+        item = serialize_stripe_object(stripe_object)
+        item[FINGERPRINT_ATTRIBUTE] = {"S": fingerprint}
+        item[EVENT_CREATED_ATTRIBUTE] = {"N": str(event_created)}
+        writer.put(table_name, item)
+
+
+def report_sync_rate(name: str, count: int, started: float):
+    elapsed = time.perf_counter() - started
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print(
+        f"INFO: synced {count} {name} objects in {elapsed:.2f}s ({rate:.1f} objects/s)"
+    )
+
+
+def report_sync_changes(name: str, changes: Dict[str, int]):
+    print(
+        f"INFO: {name}: "
+        + ", ".join(f"{count} {change}" for change, count in changes.items())
+    )
+
+
+def empty_changes() -> Dict[str, int]:
+    return {"new": 0, "changed": 0, "unchanged": 0, "deleted": 0}
+
+
+def with_price_tiers(price: Dict[str, Any]) -> Dict[str, Any]:
+    if price.get("billing_scheme") != "tiered" or price.get("tiers") is not None:
+        return price
+    expanded = get_stripe().Price.retrieve(price["id"], expand=["tiers"])
+    return {**price, "tiers": expanded["tiers"]}
+
+
+def sync_full_catalog(client: "DynamoDBClient") -> Dict[str, Dict[str, int]]:
+    stripe = get_stripe()
+
+    # the newest event is read before listing so nothing written during the
+    # listing is missed by the next incremental run
+    latest_events = stripe.Event.list(limit=1, types=CATALOG_EVENT_TYPES)["data"]
+
+    changes = {}
+    with batch.BatchWriter(client) as writer:
+        for name in CATALOG_SYNC_OBJECTS:
+            table_name = getattr(DynamoDBTables, name.upper()).value
+            started = time.perf_counter()
+            changes[name] = empty_changes()
+            # auto pagination only holds one page of objects at a time, each
+            # page is compared against the stored fingerprints and the changed
+            # objects are queued for a batch before the next page is requested
+            objects = (
+                getattr(stripe, name.capitalize())
+                .list(
+                    limit=STRIPE_LIST_PAGE_SIZE,
+                    **CATALOG_SYNC_LIST_KWARGS.get(name, {}),
+                )
+                .auto_paging_iter()
+            )
+            while page := list(itertools.islice(objects, STRIPE_LIST_PAGE_SIZE)):
+                # a listed object reflects every event created before the listing
+                listed_at = int(time.time())
+                write_changed_objects(
+                    client,
+                    writer,
+                    table_name,
+                    [(o, listed_at) for o in page],
+                    changes[name],
+                )
+            report_sync_rate(name, sum(changes[name].values()), started)
+            report_sync_changes(name, changes[name])
+    writer.report("catalog")
+
+    if latest_events:
+        put_sync_checkpoint(
+            client, "catalog", latest_events[0]["created"], latest_events[0]["id"]
+        )
+    else:
+        put_sync_checkpoint(client, "catalog", int(time.time()), None)
+
+    return changes
+
+
+def sync_catalog_events(
+    client: "DynamoDBClient", checkpoint: Dict[str, Any]
+) -> Dict[str, Dict[str, int]]:
+    stripe = get_stripe()
+    started = time.perf_counter()
+
+    # events arrive newest first, the first event seen for an object holds its
+    # latest state so older events for the same object are skipped
+    events = stripe.Event.list(
+        limit=STRIPE_LIST_PAGE_SIZE,
+        types=CATALOG_EVENT_TYPES,
+        created={"gte": int(checkpoint["created"])},
+    )
+    newest_event = None
+    latest_events: Dict[str, Any] = {}
+    for event in events.auto_paging_iter():
+        if event["id"] == checkpoint.get("object_id"):
+            break
+        if newest_event is None:
+            newest_event = event
+        latest_events.setdefault(event["data"]["object"]["id"], event)
+
+    changes = {name: empty_changes() for name in CATALOG_SYNC_OBJECTS}
+    updated: Dict[str, List[Tuple[Dict[str, Any], int]]] = {
+        name: [] for name in CATALOG_SYNC_OBJECTS
+    }
+    with batch.BatchWriter(client) as writer:
+        for object_id, event in latest_events.items():
+            name, _, operation = event["type"].partition(".")
+            if operation == "deleted":
+                writer.delete(
+                    getattr(DynamoDBTables, name.upper()).value,
+                    {"id": {"S": object_id}},
+                )
+                changes[name]["deleted"] += 1
+            elif name == "price":
+                updated[name].append(
+                    (with_price_tiers(event["data"]["object"]), event["created"])
+                )
+            else:
+                updated[name].append((event["data"]["object"], event["created"]))
+        for name, stripe_objects in updated.items():
+            write_changed_objects(
+                client,
+                writer,
+                getattr(DynamoDBTables, name.upper()).value,
+                stripe_objects,
+                changes[name],
             )
+    writer.report("catalog")
+
+    for name in CATALOG_SYNC_OBJECTS:
+        report_sync_rate(name, sum(changes[name].values()), started)
+        report_sync_changes(name, changes[name])
 
-    client.close()
+    # written even when nothing changed, updated_at records the successful run
+    if newest_event is not None:
+        put_sync_checkpoint(
+            client, "catalog", newest_event["created"], newest_event["id"]
+        )
+    else:
+        put_sync_checkpoint(
+            client, "catalog", checkpoint["created"], checkpoint.get("object_id")
+        )
 
+    return changes
 
-def sync_completed_checkout_sessions():
+
+def sync_product_price_customer_table(
+    full: bool = False,
+) -> Dict[str, Dict[str, int]]:
     client = get_client("dynamodb")
-    checkout_sessions = stripe.checkout.Session.list(limit=100)["data"]
+
+    checkpoint = None if full else get_sync_checkpoint(client, "catalog")
+
+    # every event after a run is still listed while that run is recent enough,
+    # however old the newest catalog event is
+    if (
+        checkpoint is not None
+        and time.time() - int(checkpoint.get("updated_at", checkpoint["created"]))
+        < STRIPE_EVENT_RETENTION
+    ):
+        changes = sync_catalog_events(client, checkpoint)
+    else:
+        changes = sync_full_catalog(client)
+
+    # products and prices changed, let the api instances reload their catalog
+    if any(
+        changes[name][change]
+        for name in ("product", "price")
+        for change in ("new", "changed", "deleted")
+    ):
+        bump_catalog_version(client)
+
+    return changes
+
+
+# an expanded session embeds the first page of its line items, longer lists are
+# completed with these many concurrent list_line_items calls
+LINE_ITEM_FETCH_CONCURRENCY = int(os.environ.get("LINE_ITEM_FETCH_CONCURRENCY", 8))
+
+
+def list_remaining_line_items(
+    checkout_session_id: str, starting_after: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    kwargs = {"limit": STRIPE_LIST_PAGE_SIZE}
+    if starting_after is not None:
+        kwargs["starting_after"] = starting_after
+    return list(
+        get_stripe()
+        .checkout.Session.list_line_items(checkout_session_id, **kwargs)
+        .auto_paging_iter()
+    )
+
+
+def complete_line_items(checkout_sessions: List[Dict[str, Any]]):
+    # replace the embedded line item list objects with plain lists, following
+    # the truncated ones in parallel
+    truncated = []
     for checkout_session in checkout_sessions:
-        if checkout_session["customer"] is None:
-            checkout_session["customer"] = "N/A"
-        checkout_session["line_items"] = stripe.checkout.Session.list_line_items(
-            checkout_session["id"]
-        )["data"]
-        serialized_checkout_session = type_serializer.serialize(checkout_session)["M"]
-        update_keys = [
-            k for k in checkout_session.keys() if k != "id" and k != "customer"
-        ]
-        client.update_item(
-            TableName=DynamoDBTables.CHECKOUT_SESSION_COMPLETED.value,
-            Key={
-                "id": serialized_checkout_session["id"],
-                "customer": serialized_checkout_session["customer"],
-            },
-            ExpressionAttributeNames={f"#{k}": k for k in update_keys},
-            ExpressionAttributeValues={
-                f":{k}": serialized_checkout_session[k] for k in update_keys
-            },
-            UpdateExpression=f"SET {', '.join([f'#{k}=:{k}' for k in update_keys])}",
+        embedded = checkout_session.get("line_items")
+        if embedded is None:
+            truncated.append((checkout_session, None))
+            checkout_session["line_items"] = []
+            continue
+        checkout_session["line_items"] = list(embedded["data"])
+        if embedded["has_more"]:
+            truncated.append(
+                (checkout_session, checkout_session["line_items"][-1]["id"])
+            )
+
+    if not truncated:
+        return
+
+    with ThreadPoolExecutor(
+        max_workers=min(LINE_ITEM_FETCH_CONCURRENCY, len(truncated))
+    ) as executor:
+        remaining = executor.map(
+            lambda t: list_remaining_line_items(t[0]["id"], t[1]), truncated
         )
-    client.close()
+        for (checkout_session, _), line_items in zip(truncated, remaining):
+            checkout_session["line_items"].extend(line_items)
+
+
+def sync_completed_checkout_sessions(full: bool = False) -> int:
+    client = get_client("dynamodb")
+
+    checkpoint = None if full else get_sync_checkpoint(client, "checkout-session")
+
+    list_kwargs = {"limit": STRIPE_LIST_PAGE_SIZE, "expand": ["data.line_items"]}
+    if checkpoint is not None:
+        list_kwargs["created"] = {"gte": int(checkpoint["created"])}
+
+    started = time.perf_counter()
+    count = 0
+    newest_session = None
+    oldest_open_created = None
+    page = get_stripe().checkout.Session.list(**list_kwargs)
+    reached_checkpoint = False
+    with batch.BatchWriter(client) as writer:
+        while not reached_checkpoint:
+            checkout_sessions = []
+            for checkout_session in page["data"]:
+                if checkpoint is not None and checkout_session["id"] == checkpoint.get(
+                    "object_id"
+                ):
+                    reached_checkpoint = True
+                    break
+                checkout_sessions.append(checkout_session)
+
+            complete_line_items(checkout_sessions)
+
+            for checkout_session in checkout_sessions:
+                if newest_session is None:
+                    newest_session = checkout_session
+                if checkout_session["status"] == "open":
+                    oldest_open_created = checkout_session["created"]
+                if checkout_session["customer"] is None:
+                    checkout_session["customer"] = "N/A"
+                else:
+                    checkout_session[PURCHASE_HISTORY_CUSTOMER_ATTRIBUTE] = (
+                        checkout_session["customer"]
+                    )
+                writer.put(
+                    DynamoDBTables.CHECKOUT_SESSION_COMPLETED.value,
+                    serialize_stripe_object(checkout_session),
+                    key_names=("id", "customer"),
+                )
+                # counter transactions stay serial, concurrent transactions on
+                # the same product counter would cancel each other
+                popularity.record_checkout_session_popularity(client, checkout_session)
+                count += 1
+
+            if not page["has_more"]:
+                break
+            page = page.next_page()
+    writer.report("checkout session")
+
+    report_sync_rate("checkout session", count, started)
+
+    # sessions can still complete while open, so the checkpoint never moves past
+    # the oldest open session and the next run lists it again
+    if oldest_open_created is not None:
+        put_sync_checkpoint(client, "checkout-session", oldest_open_created, None)
+    elif newest_session is not None:
+        put_sync_checkpoint(
+            client,
+            "checkout-session",
+            newest_session["created"],
+            newest_session["id"],
+        )
+
+    return count
+
+
+def backfill_purchase_history_index():
+    # sessions written before the customer/created index existed lack the index
+    # attribute, copy the customer across so they show up in the history
+    client = get_client("dynamodb")
+    paginator = client.get_paginator("scan")
+    backfilled = 0
+    for page in paginator.paginate(
+        TableName=DynamoDBTables.CHECKOUT_SESSION_COMPLETED.value,
+        ProjectionExpression="id, customer",
+        FilterExpression="attribute_not_exists(#history) AND customer <> :guest",
+        ExpressionAttributeNames={"#history": PURCHASE_HISTORY_CUSTOMER_ATTRIBUTE},
+        ExpressionAttributeValues={":guest": {"S": "N/A"}},
+    ):
+        for item in page["Items"]:
+            client.update_item(
+                TableName=DynamoDBTables.CHECKOUT_SESSION_COMPLETED.value,
+                Key={"id": item["id"], "customer": item["customer"]},
+                ExpressionAttributeNames={
+                    "#history": PURCHASE_HISTORY_CUSTOMER_ATTRIBUTE
+                },
+                ExpressionAttributeValues={":customer": item["customer"]},
+                UpdateExpression="SET #history = :customer",
+            )
+            backfilled += 1
+    print(f"INFO: backfilled the purchase history index for {backfilled} sessions")
@@ -14,10 +14,20 @@ type PastPurchase = {
     },
 }
 
-const getPastPurchases = async (setPastPurchase: (purchases: PastPurchase[]) => void) => {
+type PastPurchasePage = {
+    purchases: PastPurchase[],
+    nextCursor: string | null,
+}
+
+// the history is paged, X-Next-Cursor is set while older purchases remain
+const getPastPurchases = async (cursor: string | null): Promise<PastPurchasePage> => {
     try {
+        const url = new URL('/stripe/current-user-past-purchases', endpointURL)
+        if (cursor !== null) {
+            url.searchParams.append("cursor", cursor)
+        }
         const response = await fetch(
-            `${endpointURL}/stripe/current-user-past-purchases`, {
+            url.toString(), {
             method: "GET",
             credentials: "include"
         }
@@ -26,7 +36,7 @@ const getPastPurchases = async (setPastPurchase: (purchases: PastPurchase[]) =>
             throw Error(`Response Status: ${response.status}`)
         }
         const data = await response.json()
-        setPastPurchase(data)
+        return { purchases: data, nextCursor: response.headers.get("X-Next-Cursor") }
 
     } catch (e) {
         throw (e as Error).message
@@ -39,11 +49,21 @@ const getPastPurchases = async (setPastPurchase: (purchases: PastPurchase[]) =>
 
 const Recent = () => {
     const [pastPurchases, setPastPurchases] = useState<Array<PastPurchase>>(new Array<PastPurchase>())
+    const [nextCursor, setNextCursor] = useState<string | null>(null)
+    const [loaded, setLoaded] = useState(false)
     const context = useContext(AppContext);
+
+    const loadPastPurchases = async (cursor: string | null) => {
+        const page = await getPastPurchases(cursor)
+        setPastPurchases((previous) => (cursor === null ? page.purchases : previous.concat(page.purchases)))
+        setNextCursor(page.nextCursor)
+    }
+
     useEffect(() => {
 
-        if (context.authorized && pastPurchases.length === 0) {
-            getPastPurchases(setPastPurchases)
+        if (context.authorized && !loaded) {
+            setLoaded(true)
+            loadPastPurchases(null)
         }
     }
     )
@@ -65,6 +85,13 @@ const Recent = () => {
                             </div>
                         ))
                     }
+                    {
+                        (nextCursor !== null) ?
+                            <button type="button" onClick={() => loadPastPurchases(nextCursor)} className="self-start border p-2 rounded-md bg-slate-100 hover:bg-slate-200">
+                                show older purchases
+                            </button>
+                            : null
+                    }
                 </div>
                 : <p>login to view past purchases </p>
         }
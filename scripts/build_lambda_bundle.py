@@ -0,0 +1,420 @@
+"""
+Build a slim, precompiled lambda zip for one of the python backends.
+
+Only the runtime dependencies pinned in requirements.lock are installed, as
+manylinux wheels for the lambda runtime. Packages the runtime already provides
+(boto3), type checking stubs and the local development server are left out
+together with everything only they depend on. Tests, stub files, caches and
+install records are stripped and the bundle is compiled to bytecode for the
+target python, so cold starts never compile from source on the read only
+lambda filesystem. A size and import time report is printed at the end.
+
+    python3 scripts/build_lambda_bundle.py backend/api-lib --python .venv/bin/python
+"""
+
+import argparse
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import zipfile
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+# installed by the lambda python runtime, /var/task comes first on the path so a
+# bundled copy would only shadow it
+RUNTIME_PROVIDED_PACKAGES = {"boto3", "botocore", "s3transfer", "jmespath"}
+
+# only used by mypy and editors
+TYPE_CHECKING_PACKAGES = {"mypy", "boto3-stubs", "botocore-stubs"}
+TYPE_CHECKING_PREFIXES = ("mypy-boto3", "types-")
+
+# pulled in by fastapi for `fastapi dev`, the function is served by mangum
+DEVELOPMENT_SERVER_PACKAGES = {"fastapi-cli", "uvicorn"}
+
+STRIPPED_DIRECTORIES = {"__pycache__", "tests", "test"}
+STRIPPED_SUFFIXES = (".pyi", ".pyc", ".pyo")
+# license files are kept, METADATA is read by importlib.metadata at runtime
+STRIPPED_DIST_INFO_FILES = {
+    "RECORD",
+    "INSTALLER",
+    "REQUESTED",
+    "WHEEL",
+    "direct_url.json",
+}
+
+PLATFORMS = {"x86_64": "manylinux2014_x86_64", "arm64": "manylinux2014_aarch64"}
+
+# fixed timestamp so unchanged sources produce an identical zip
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def normalize(name: str) -> str:
+    return name.lower().replace("_", "-").replace(".", "-")
+
+
+# ---------------------------------------------------------------------------- #
+#                             runtime requirements                             #
+# ---------------------------------------------------------------------------- #
+
+
+def parse_lock(path: str) -> Dict[str, Tuple[str, Set[str]]]:
+    # name -> (pinned requirement, packages that pull it in) from a rye lock
+    packages: Dict[str, Tuple[str, Set[str]]] = {}
+    current = None
+    in_via = False
+    with open(path) as f:
+        for line in f:
+            stripped = line.strip()
+            if not stripped or stripped.startswith("-e"):
+                continue
+            if not line.startswith((" ", "#")):
+                current = normalize(stripped.split("==")[0])
+                packages[current] = (stripped, set())
+                in_via = False
+            elif current is not None and stripped.startswith("# via"):
+                via = stripped[len("# via") :].strip()
+                if via:
+                    packages[current][1].add(normalize(via))
+                in_via = not via
+            elif current is not None and in_via and stripped.startswith("#   "):
+                packages[current][1].add(normalize(stripped[1:].strip()))
+    return packages
+
+
+def is_excluded(name: str, bundle_boto3: bool) -> bool:
+    return (
+        name in TYPE_CHECKING_PACKAGES
+        or name.startswith(TYPE_CHECKING_PREFIXES)
+        or name in DEVELOPMENT_SERVER_PACKAGES
+        or (not bundle_boto3 and name in RUNTIME_PROVIDED_PACKAGES)
+    )
+
+
+def resolve_requirements(
+    packages: Dict[str, Tuple[str, Set[str]]], bundle_boto3: bool
+) -> Tuple[List[str], List[str]]:
+    # a package is dropped with the excluded ones when nothing else needs it
+    excluded = {name for name in packages if is_excluded(name, bundle_boto3)}
+    changed = True
+    while changed:
+        changed = False
+        for name, (_, via) in packages.items():
+            if name not in excluded and via and via <= excluded:
+                excluded.add(name)
+                changed = True
+
+    return (
+        sorted(r for n, (r, _) in packages.items() if n not in excluded),
+        sorted(r for n, (r, _) in packages.items() if n in excluded),
+    )
+
+
+def pip_install(
+    requirements: List[str], target: str, python_version: str, architecture: str
+):
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        f.write("\n".join(requirements))
+    try:
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "pip",
+                "install",
+                "--quiet",
+                "--no-deps",
+                "--no-compile",
+                "--only-binary=:all:",
+                "--implementation=cp",
+                f"--platform={PLATFORMS[architecture]}",
+                f"--python-version={python_version}",
+                f"--target={target}",
+                "--requirement",
+                f.name,
+            ],
+            check=True,
+        )
+    finally:
+        os.remove(f.name)
+
+
+# ---------------------------------------------------------------------------- #
+#                                    bundle                                    #
+# ---------------------------------------------------------------------------- #
+
+
+def directory_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def strip_bundle(bundle: str) -> Dict[str, int]:
+    # returns the bytes removed per kind of file
+    removed = {"directories": 0, "stubs": 0, "dist-info": 0}
+
+    shutil.rmtree(os.path.join(bundle, "bin"), ignore_errors=True)
+
+    for root, directories, names in os.walk(bundle):
+        for directory in list(directories):
+            # a top level package called test is still a package
+            if directory in STRIPPED_DIRECTORIES and root != bundle:
+                path = os.path.join(root, directory)
+                removed["directories"] += directory_size(path)
+                shutil.rmtree(path)
+                directories.remove(directory)
+
+        in_dist_info = root.endswith(".dist-info")
+        for name in names:
+            path = os.path.join(root, name)
+            if name.endswith(STRIPPED_SUFFIXES):
+                removed["stubs"] += os.path.getsize(path)
+                os.remove(path)
+            elif in_dist_info and name in STRIPPED_DIST_INFO_FILES:
+                removed["dist-info"] += os.path.getsize(path)
+                os.remove(path)
+
+    return removed
+
+
+def copy_project(project: str, bundle: str):
+    ignore = shutil.ignore_patterns(*STRIPPED_DIRECTORIES, "*.pyc")
+    source = os.path.join(project, "src")
+    for name in os.listdir(source):
+        if os.path.isdir(os.path.join(source, name)) and name != "__pycache__":
+            shutil.copytree(
+                os.path.join(source, name), os.path.join(bundle, name), ignore=ignore
+            )
+    shutil.copy(os.path.join(project, "entrypoint.py"), bundle)
+
+
+def compile_bundle(python: str, bundle: str):
+    # the hash is not checked against the source, zip timestamps are only
+    # accurate to two seconds and would invalidate timestamp based pycs
+    subprocess.run(
+        [
+            python,
+            "-m",
+            "compileall",
+            "-q",
+            "-j",
+            "0",
+            "--invalidation-mode",
+            "unchecked-hash",
+            bundle,
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def iter_files(bundle: str) -> Iterator[Tuple[str, str]]:
+    for root, directories, names in os.walk(bundle):
+        directories.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            yield path, os.path.relpath(path, bundle)
+
+
+def write_zip(bundle: str, output: str):
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as z:
+        for path, name in iter_files(bundle):
+            info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with open(path, "rb") as f:
+                z.writestr(info, f.read())
+
+
+# ---------------------------------------------------------------------------- #
+#                                    report                                    #
+# ---------------------------------------------------------------------------- #
+
+
+def time_import(
+    python: str, bundle: str, runtime: Optional[str], module: str, runs: int
+) -> float:
+    # fresh isolated interpreters with only the bundle and the runtime provided
+    # packages on the path, like /var/task and /var/runtime on lambda
+    paths = [bundle] + ([runtime] if runtime else [])
+    code = (
+        "import sys, time; "
+        f"sys.path[:0] = {paths!r}; "
+        "start = time.perf_counter(); "
+        f"import {module}; "
+        "print(time.perf_counter() - start)"
+    )
+    timings = []
+    for _ in range(runs):
+        completed = subprocess.run(
+            [python, "-I", "-B", "-c", code],
+            capture_output=True,
+            text=True,
+            cwd=bundle,
+        )
+        if completed.returncode != 0:
+            sys.exit(
+                f"ERROR: importing {module} from the bundle failed\n"
+                f"{completed.stderr}"
+            )
+        timings.append(float(completed.stdout.strip().splitlines()[-1]))
+    return statistics.median(timings)
+
+
+def can_import(architecture: str) -> bool:
+    machine = {"x86_64": "x86_64", "arm64": "aarch64"}[architecture]
+    return sys.platform == "linux" and platform.machine() == machine
+
+
+def print_sizes(bundle: str, output: str, removed: Dict[str, int], top: int):
+    entries = sorted(
+        (
+            (directory_size(os.path.join(bundle, name)), name)
+            for name in os.listdir(bundle)
+            if not name.endswith(".dist-info")
+        ),
+        reverse=True,
+    )
+    files = sum(1 for _ in iter_files(bundle))
+    print(
+        f"\nbundle: {files} files, {directory_size(bundle) / 2**20:.1f} MB unpacked, "
+        f"{os.path.getsize(output) / 2**20:.1f} MB zipped"
+    )
+    print(
+        "stripped: " + ", ".join(f"{v / 2**20:.1f} MB {k}" for k, v in removed.items())
+    )
+    print(f"\n{'largest entries':<50}{'MB':>8}")
+    for size, name in entries[:top]:
+        print(f"{name:<50}{size / 2**20:>8.2f}")
+
+
+# ---------------------------------------------------------------------------- #
+#                                     build                                    #
+# ---------------------------------------------------------------------------- #
+
+
+def find_python(python: Optional[str], python_version: str) -> str:
+    # bytecode is only valid for the interpreter version that wrote it
+    if python is None:
+        if "%d.%d" % sys.version_info[:2] == python_version:
+            return sys.executable
+        python = shutil.which(f"python{python_version}")
+        if python is None:
+            sys.exit(f"ERROR: no python{python_version} found, pass --python")
+    completed = subprocess.run(
+        [python, "-c", "import sys; print('%d.%d' % sys.version_info[:2])"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    if completed.stdout.strip() != python_version:
+        sys.exit(
+            f"ERROR: {python} is python {completed.stdout.strip()}, "
+            f"not {python_version}"
+        )
+    return python
+
+
+def main(
+    project: str,
+    output: Optional[str],
+    python: Optional[str],
+    python_version: str,
+    architecture: str,
+    bundle_boto3: bool,
+    import_module: str,
+    import_runs: int,
+    top: int,
+):
+    project = os.path.abspath(project)
+    output = os.path.abspath(output or os.path.join(project, "dist", "lambda.zip"))
+    python = find_python(python, python_version)
+
+    packages = parse_lock(os.path.join(project, "requirements.lock"))
+    requirements, excluded = resolve_requirements(packages, bundle_boto3)
+    # boto3 and whatever only it needs, installed beside the bundle for the
+    # import check the way the lambda runtime provides them
+    runtime_requirements = sorted(
+        set(excluded) - set(resolve_requirements(packages, bundle_boto3=True)[1])
+    )
+    print(f"INFO: bundling {len(requirements)} requirements for {project}")
+    print(f"INFO: leaving out {', '.join(excluded)}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bundle = os.path.join(workdir, "bundle")
+        pip_install(requirements, bundle, python_version, architecture)
+        removed = strip_bundle(bundle)
+        copy_project(project, bundle)
+
+        importable = can_import(architecture)
+        runtime = None
+        if importable and runtime_requirements:
+            runtime = os.path.join(workdir, "runtime")
+            pip_install(runtime_requirements, runtime, python_version, architecture)
+            compile_bundle(python, runtime)
+
+        if importable:
+            source_seconds = time_import(
+                python, bundle, runtime, import_module, import_runs
+            )
+
+        compile_bundle(python, bundle)
+
+        if os.path.exists(output):
+            os.remove(output)
+        write_zip(bundle, output)
+
+        print_sizes(bundle, output, removed, top)
+        if importable:
+            compiled_seconds = time_import(
+                python, bundle, runtime, import_module, import_runs
+            )
+            print(
+                f"\nimport {import_module} (median of {import_runs}): "
+                f"{source_seconds * 1000:.0f} ms from source, "
+                f"{compiled_seconds * 1000:.0f} ms precompiled"
+            )
+        else:
+            print(f"\nimport check skipped, this is not a {architecture} linux host")
+
+    print(f"\nINFO: wrote {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("project", help="folder with requirements.lock and src")
+    parser.add_argument("--output", help="defaults to <project>/dist/lambda.zip")
+    parser.add_argument(
+        "--python", help="interpreter of the target version used for bytecode"
+    )
+    parser.add_argument("--python-version", default="3.10")
+    parser.add_argument("--architecture", choices=PLATFORMS, default="x86_64")
+    parser.add_argument(
+        "--bundle-boto3",
+        action="store_true",
+        help="ship the locked boto3 instead of the one in the lambda runtime",
+    )
+    parser.add_argument("--import-module", default="entrypoint")
+    parser.add_argument("--import-runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    main(
+        args.project,
+        args.output,
+        args.python,
+        args.python_version,
+        args.architecture,
+        args.bundle_boto3,
+        args.import_module,
+        args.import_runs,
+        args.top,
+    )
@@ -21,6 +21,7 @@ if [[ -n $GITHUB_ACTIONS ]]; then
 fi
 
 # shellcheck disable=SC2155
+bundle_builder="$(realpath "$(dirname -- "${BASH_SOURCE[0]}")")/build_lambda_bundle.py"
 
 cd "$target_folder" || exit
 
@@ -30,41 +31,9 @@ rye sync -f
 
 echo "INFO: Creating zip"
 
-# python -m pip install . -t lib
-
-if [ -d dist ]; then
-    rm -rf dist
-fi
-
-if [ -d lib ]; then
-    rm -rf lib
-fi
-
-mkdir dist
-
-echo "INFO: Moving site-packages to lib"
-cp -r .venv/lib/python*/site-packages lib || exit
-echo "INFO: Finished moving site-packages to lib"
-
-echo "INFO: Copying main package to lib"
-cp -r src/* -t lib || exit
-echo "INFO: Finished copying main package to lib"
-
-echo "INFO: Zipping lib"
-(
-    cd lib || exit
-    zip ../dist/lambda.zip -r . -1 -q
-)
-echo "INFO: Finished zipping lib"
-
-rm -rf lib
-
-echo "INFO: Finished creating zip"
-
-echo "INFO: Adding lambda entrypoint to zip"
-
-zip dist/lambda.zip -u entrypoint.py
+# only the runtime dependencies are bundled, precompiled for the lambda python
+python3 "$bundle_builder" . --python .venv/bin/python || exit
 
 chmod 775 dist/lambda.zip
 
-echo "INFO: Finished adding lambda entrypoint to zip"
\ No newline at end of file
+echo "INFO: Finished creating zip"